@@ -0,0 +1,99 @@
+import binary_puzzle as bp
+import numpy as np
+import importlib
+import time
+
+# Common interface of the AIs. An agent plays the Board in its board attribute
+# and has:
+#  - get_best_move(): the move it would play on its board, None when the game
+#    is over
+#  - take_best_move(): plays that move (and the spawn after it), returns False
+#    when there was no move. The time, effort and memory of each move are
+#    appended to move_stats.
+#  - choose_moves(boards): index in bp.MOVES of the move for every board of an
+#    array of 64-bit boards, -1 for boards without a valid move. Engines that
+#    can vectorize override it, the default searches the boards one by one.
+#  - anytime(deadline): see anytime.py
+# Agents are registered under a name with register_agent, so the experiment
+# runner, the GUI and the move server create them with make_agent(name, ...)
+# instead of knowing each class.
+
+# Name -> agent class
+AGENTS = {}
+
+# Modules registering the built-in agents, imported on first lookup
+AGENT_MODULES = ['greedy_ai', 'expectimax_ai', 'mcts_ai', 'batched_expectimax']
+
+def register_agent(name: str):
+    # Class decorator registering an agent class under name
+    def register(agent_class):
+        AGENTS[name] = agent_class
+        agent_class.agent_name = name
+        return agent_class
+    return register
+
+def _load_agents():
+    for module in AGENT_MODULES:
+        importlib.import_module(module)
+
+def agent_names() -> list:
+    _load_agents()
+    return list(AGENTS)
+
+def get_agent_class(name: str):
+    _load_agents()
+    if name not in AGENTS:
+        raise ValueError(f"Unknown agent {name}, expected one of {', '.join(AGENTS)}")
+    return AGENTS[name]
+
+def make_agent(name: str, board: bp.Board = None, **options):
+    # New agent of the registered name playing board (a new game by default)
+    if board is None:
+        board = bp.Board()
+    return get_agent_class(name)(board, **options)
+
+class Agent:
+    agent_name = None
+    # Stats of the moves played by take_best_move, one dict per move
+    move_stats = None
+
+    def get_best_move(self) -> str:
+        raise NotImplementedError
+
+    def effort(self) -> int:
+        # Work done by the last get_best_move, in nodes expanded or playouts
+        return 0
+
+    def take_best_move(self) -> bool:
+        start_time = time.time()
+        move = self.get_best_move()
+        if self.move_stats is None:
+            self.move_stats = []
+        self.move_stats.append({
+            'time': time.time() - start_time,
+            'effort': self.effort(),
+            # The search's own stores and the successor cache it shares with
+            # the other searches of the process
+            'memory': getattr(self, 'memory_used', 0) + bp.successor_cache_stats()['memory']
+        })
+        if move is None:
+            return False
+        self.board.move(move)
+        return True
+
+    def choose_moves(self, boards: np.ndarray) -> np.ndarray:
+        boards = np.asarray(boards, dtype=np.uint64).reshape(-1)
+        moves = np.full(len(boards), -1, dtype=np.int64)
+        board = self.board
+        try:
+            for i, value in enumerate(boards.tolist()):
+                self.board = bp.Board(value)
+                move = self.get_best_move()
+                if move is not None:
+                    moves[i] = bp.MOVE_INDEX[move]
+        finally:
+            self.board = board
+        return moves
+
+    def __str__(self):
+        return str(self.board)
@@ -1,68 +1,80 @@
 import binary_puzzle as bp
-from greedy_ai import GreedyBoard
-from expectimax_ai import ExpectimaxBoard
-from mcts_ai import MCTSBoard
+from batched_greedy import BatchedGreedyRunner
+from expectimax_ai import DepthSchedule, NodeBudget
+from mcts_ai import UCB1, UCB1Tuned, PUCT
+import agents
 import heuristics
+import memory_budget
+import trajectory
 import numpy as np
 import json
 from datetime import datetime
 import os
 import time
 import multiprocessing
+import sys
 
-def run_game(ai_board, algorithm, params):
-    print(f"\nStarting {algorithm} game with parameters:", end=" ")
-    if algorithm == "greedy":
-        print(f"heuristic={params['heuristic_name']}")
-    elif algorithm == "expectimax":
-        print(f"depth={params['depth']}, heuristic={params['heuristic_name']}")
-    elif algorithm == "mcts":
-        print(f"simulation_time={params['sim_time']:.1f}, exploration={params['exploration']}")
-        
+def run_game(agent, algorithm, variant, record=False):
+    print(f"\nStarting {algorithm} game: {variant}")
+    if record:
+        trajectory.start_recording(agent.board)
+    cache_stats = bp.successor_cache_stats()
     start_time = time.time()
-    while not ai_board.board.is_game_over():
-        ai_board.take_best_move()
+    while not agent.board.is_game_over():
+        agent.take_best_move()
     end_time = time.time()
     
     # Convert board to regular Python list and ensure all numbers are standard Python integers
-    board_data = [[int(cell) for cell in row] for row in ai_board.board.get_2048_board().tolist()]
+    board_data = [[int(cell) for cell in row] for row in agent.board.get_2048_board().tolist()]
     
-    return {
-        'score': int(ai_board.board.score()),  # Convert NumPy integers to Python integers
-        'moves': int(ai_board.board.total_moves),
+    # Per-move stats recorded by Agent.take_best_move
+    move_stats = agent.move_stats or []
+    # Successor cache lookups during the game
+    end_cache_stats = bp.successor_cache_stats()
+    hits = end_cache_stats['hits'] - cache_stats['hits']
+    misses = end_cache_stats['misses'] - cache_stats['misses']
+    result = {
+        'score': int(agent.board.score()),  # Convert NumPy integers to Python integers
+        'moves': int(agent.board.total_moves),
         'board': board_data,
-        'time': float(end_time - start_time)
+        'time': float(end_time - start_time),
+        'effort': int(sum(stats['effort'] for stats in move_stats)),
+        # Memory of the search trees and caches (see memory_budget)
+        'search_memory': int(max((stats['memory'] for stats in move_stats), default=0)),
+        'peak_rss': memory_budget.peak_rss(),
+        'successor_cache_hit_rate': hits / max(1, hits + misses)
     }
+    if record:
+        # Replaced by the game's number in the trajectory file when saved
+        result['trajectory'] = trajectory.finish_recording(agent.board)
+    return result
 
 def run_game_wrapper(args):
-    # Initialize Board's merge_array for this process
+    # Map Board's cached merge_array into this process
     if bp.Board.merge_array is None:
         bp.Board._initialize_merge_array()
     
-    algorithm, original_params = args
-    # Make a copy of params to avoid modifying the original
-    params = original_params.copy()
-    
-    ai_board_class = params.pop('ai_board_class')
-    
-    # Store parameters needed for printing before removing them
-    print_params = {
-        'heuristic_name': params.get('heuristic_name'),
-        'depth': params.get('depth'),
-        'sim_time': params.get('sim_time'),
-        'exploration': params.get('exploration')
-    }
-    
-    # Remove non-constructor parameters
-    params.pop('heuristic_name', None)
-    params.pop('sim_time', None)
-    
-    ai_board = ai_board_class(**params)
-    result = run_game(ai_board, algorithm, print_params)
-    return (algorithm, original_params, result)  # Return original_params instead of modified params
+    # params holds the variant the game belongs to, the options of the agent
+    # and whether to record the game
+    algorithm, params = args
+    agent = agents.make_agent(algorithm, **params['options'])
+    result = run_game(agent, algorithm, params['variant'], params.get('record_trajectory', False))
+    return (algorithm, params, result)
 
-def save_results(algorithm, results):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+def save_trajectories(algorithm, results, timestamp):
+    # Move the recorded games into one trajectory file per algorithm and keep
+    # each game's number in that file in its result
+    filename = f'results/{algorithm}_{timestamp}.trj'
+    with trajectory.TrajectoryWriter(filename) as writer:
+        for games in results.values():
+            for game in games:
+                if 'trajectory' in game:
+                    game['trajectory'] = writer.add_game(game['trajectory'])
+    print(f"\nSaved {algorithm} trajectories to {filename}")
+
+def save_results(algorithm, results, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     if not os.path.exists('results'):
         os.makedirs('results')
     
@@ -85,90 +97,78 @@ def save_results(algorithm, results):
         print(f"Min score: {int(np.min(scores))}")
         print(f"Total time: {float(sum(times)):.2f}s")
 
-def run_experiments(iterations=10):
+def prepare_tasks(iterations=10, record_trajectories=False, extended=False):
+    # Games of the sweep as (agent name, params) tasks for run_game_wrapper.
+    # Results are saved under the variant of their task. extended adds the
+    # adaptive depth expectimax variants and the MCTS selection policies,
+    # 4 + 4 * 5 more variants of iterations games each.
     tasks = []
-    # Prepare tasks for Greedy
-    for i in range(iterations):
-        tasks.append((
-            'greedy',
-            {
-                'ai_board_class': GreedyBoard,
-                'board': bp.Board(),
-                'heuristic': heuristics.score_heuristic,
-                'heuristic_name': 'score_heuristic'
-            }
-        ))
-        tasks.append((
-            'greedy',
-            {
-                'ai_board_class': GreedyBoard,
-                'board': bp.Board(),
-                'heuristic': heuristics.open_cells_heuristic,
-                'heuristic_name': 'open_cells_heuristic'
-            }
-        ))
+    def add_tasks(algorithm, variant, **options):
+        for i in range(iterations):
+            tasks.append((algorithm, {
+                'variant': variant,
+                'options': {'board': bp.Board(), **options},
+                'record_trajectory': record_trajectories
+            }))
     # Prepare tasks for Expectimax
     for depth in range(1, 6):  # Changed from range(1, 5)
-        for i in range(iterations):
-            tasks.append((
-                'expectimax',
-                {
-                    'ai_board_class': ExpectimaxBoard,
-                    'board': bp.Board(),
-                    'depth': depth,
-                    'heuristic': heuristics.score_heuristic,
-                    'heuristic_name': 'score_heuristic'
-                }
-            ))
-            tasks.append((
-                'expectimax',
-                {
-                    'ai_board_class': ExpectimaxBoard,
-                    'board': bp.Board(),
-                    'depth': depth,
-                    'heuristic': heuristics.open_cells_heuristic,
-                    'heuristic_name': 'open_cells_heuristic'
-                }
-            ))
+        for heuristic_name in ['score_heuristic', 'open_cells_heuristic']:
+            add_tasks('expectimax', f"depth_{depth}_{heuristic_name}",
+                      depth=depth, heuristic=getattr(heuristics, heuristic_name))
     # Prepare tasks for MCTS
-    sim_times = np.arange(0.1, 0.6, 0.1)
+    sim_times = [float(sim_time) for sim_time in np.arange(0.1, 0.6, 0.1)]
     for sim_time in sim_times:
-        for i in range(iterations):
-            tasks.append((
-                'mcts',
-                {
-                    'ai_board_class': MCTSBoard,
-                    'board': bp.Board(),
-                    'simulation_time': sim_time,
-                    'heuristic': heuristics.tile_sum_heuristic,
-                    'exploration': 0.1,
-                    'sim_time': sim_time
-                }
-            ))
+        add_tasks('mcts', f"sim_time_{sim_time:.1f}",
+                  simulation_time=sim_time, heuristic=heuristics.tile_sum_heuristic, exploration=0.1)
+    if not extended:
+        return tasks
+    # Prepare tasks for Expectimax with a depth picked per move
+    depth_policies = {'schedule': DepthSchedule(), 'node_budget': NodeBudget()}
+    for policy_name, depth_policy in depth_policies.items():
+        for heuristic_name in ['score_heuristic', 'open_cells_heuristic']:
+            add_tasks('expectimax', f"adaptive_{policy_name}_{heuristic_name}",
+                      depth_policy=depth_policy, heuristic=getattr(heuristics, heuristic_name))
+    # Prepare tasks for MCTS with other selection policies and with
+    # progressive widening of the spawns. MCTSBoard's exploration only applies
+    # to its default selection, the policies are given their own.
+    selections = {
+        'ucb1': {'selection': UCB1(exploration=0.5)},
+        'ucb1_tuned': {'selection': UCB1Tuned(exploration=1.0)},
+        'puct': {'selection': PUCT(exploration=1.0)},
+        'puct_widening': {'selection': PUCT(exploration=1.0), 'widening': (1.0, 0.5)},
+    }
+    for selection_name, options in selections.items():
+        for sim_time in sim_times:
+            add_tasks('mcts', f"{selection_name}_sim_time_{sim_time:.1f}",
+                      simulation_time=sim_time, heuristic=heuristics.tile_sum_heuristic, **options)
+    return tasks
+
+def save_experiment_results(results, iterations=10, record_trajectories=False):
+    # Save the results of the tasks, given in the order of the tasks, along
+    # with the greedy games. Greedy games are cheap enough to all be played
+    # together in this process.
+    greedy_results = {}
+    for heuristic_name in ['score_heuristic', 'open_cells_heuristic']:
+        print(f"\nPlaying {iterations} greedy games with heuristic={heuristic_name}")
+        runner = BatchedGreedyRunner(iterations, getattr(heuristics, heuristic_name), record=record_trajectories)
+        greedy_results[heuristic_name] = runner.run()
+    # Organize and save results by algorithm, variants in the order of the tasks
+    algorithm_results = {'greedy': greedy_results}
+    for algorithm, params, result in results:
+        algorithm_results.setdefault(algorithm, {}).setdefault(params['variant'], []).append(result)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    for algorithm, variants in algorithm_results.items():
+        if record_trajectories:
+            save_trajectories(algorithm, variants, timestamp)
+        save_results(algorithm, variants, timestamp)
+
+def run_experiments(iterations=10, record_trajectories=False, extended=False):
+    tasks = prepare_tasks(iterations, record_trajectories, extended)
     # Run tasks using a multiprocessing Pool
     with multiprocessing.Pool(processes=8) as pool:
         results = pool.map(run_game_wrapper, tasks)
-    # Organize and save results
-    greedy_results = {'score_heuristic': [], 'open_cells_heuristic': []}
-    expectimax_results = {
-        f"depth_{depth}_{heur}": [] 
-        for depth in range(1, 6)  # Changed from range(1, 5)
-        for heur in ['score_heuristic', 'open_cells_heuristic']
-    }
-    mcts_results = {f"sim_time_{sim_time:.1f}": [] for sim_time in sim_times}
-    for algorithm, params, result in results:
-        if algorithm == 'greedy':
-            key = params['heuristic_name']
-            greedy_results[key].append(result)
-        elif algorithm == 'expectimax':
-            key = f"depth_{params['depth']}_{params['heuristic_name']}"
-            expectimax_results[key].append(result)
-        elif algorithm == 'mcts':
-            key = f"sim_time_{params['sim_time']:.1f}"
-            mcts_results[key].append(result)
-    save_results('greedy', greedy_results)
-    save_results('expectimax', expectimax_results)
-    save_results('mcts', mcts_results)
+    save_experiment_results(results, iterations, record_trajectories)
 
 if __name__ == '__main__':
-    run_experiments(100)
+    # python3 analysis.py [--extended]
+    run_experiments(100, extended='--extended' in sys.argv)
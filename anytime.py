@@ -0,0 +1,33 @@
+import time
+from collections import namedtuple
+
+# Anytime interface of the AIs. GreedyBoard, ExpectimaxBoard, MCTSBoard and
+# BatchedExpectimaxBoard have an anytime(deadline) generator that yields a
+# MoveUpdate every time their search has a better answer:
+#  - move: best move found so far (None if the game is over)
+#  - confidence: between 0 and 1, how complete the search is (fraction of the
+#    moves scored for greedy, of the target depth searched for expectimax,
+#    visit share of the move for MCTS)
+#  - effort: nodes expanded, or playouts for MCTS, since the search started
+#  - elapsed: seconds since the search started
+# The first update comes as soon as the valid moves are known, so a move is
+# always available. Searches stop by themselves at the deadline (a time.time()
+# value), and the caller can stop them earlier by no longer iterating.
+
+MoveUpdate = namedtuple('MoveUpdate', ['move', 'confidence', 'effort', 'elapsed'])
+
+class SearchTimeout(Exception):
+    # Raised inside a search when its deadline has passed
+    pass
+
+def best_move_by(ai_board, time_limit: float, callback: callable = None) -> MoveUpdate:
+    # Last update of the AI's anytime search within time_limit seconds.
+    # callback is called with every update as it is published.
+    deadline = time.time() + time_limit
+    update = None
+    for update in ai_board.anytime(deadline):
+        if callback is not None:
+            callback(update)
+        if time.time() >= deadline:
+            break
+    return update
@@ -0,0 +1,134 @@
+import binary_puzzle as bp
+import numpy as np
+import heuristics
+import time
+from anytime import MoveUpdate, SearchTimeout
+from agents import Agent, register_agent
+
+# Breadth-first expectimax. Instead of recursing one board at a time, every
+# ply of the search tree is expanded at once as an array of 64-bit boards:
+#  - max plies apply the 4 moves to the whole frontier with merge table gathers
+#  - chance plies place a 2 and a 4 in every empty cell with nibble masks
+# Boards reached more than once in a ply are only kept once (np.unique), all
+# the leaves are evaluated in one vectorized heuristic call, and the values are
+# folded back up the plies with max and weighted sum reductions.
+# It searches the same tree as ExpectimaxBoard, with the same depth counting.
+# Values are summed in a different order, so moves whose values tie exactly may
+# be broken differently due to rounding.
+
+@register_agent('batched_expectimax')
+class BatchedExpectimaxBoard(Agent):
+    def __init__(self, board: bp.Board, depth: int = 3, heuristic: callable = None):
+        self.board = board
+        self.depth = depth
+        if heuristic is None:
+            heuristic = heuristics.score_heuristic
+        self.heuristic = heuristic
+        self.heuristic_array = heuristics.as_array_heuristic(heuristic)
+        # Number of distinct boards in the tree of the last search
+        self.nodes_expanded = 0
+        # time.time() by which get_best_move must stop (see search)
+        self.deadline = None
+
+    def _expand_max(self, frontier: np.ndarray):
+        # All successors of the frontier, one column per move
+        successors = np.stack([bp.swipe_array(frontier, move) for move in bp.MOVES], axis=1)
+        valid = successors != frontier[:, None]
+        return successors[valid], valid
+
+    def _expand_chance(self, frontier: np.ndarray):
+        # Place a 2 and a 4 in every empty cell. The probability of a child is
+        # 0.9 or 0.1 divided by the number of empty cells of its parent.
+        empty = heuristics.tile_exponents(frontier) == 0
+        parents, cells = np.nonzero(empty)
+        counts = empty.sum(axis=1)[parents]
+        shifts = heuristics.CELL_SHIFTS[cells]
+        twos = frontier[parents] | (np.uint64(1) << shifts)
+        fours = frontier[parents] | (np.uint64(2) << shifts)
+        children = np.concatenate([twos, fours])
+        weights = np.concatenate([0.9 / counts, 0.1 / counts])
+        return children, np.concatenate([parents, parents]), weights
+
+    def search(self, board: int, depth: int = None, deadline: float = None) -> np.ndarray:
+        # Value of each move from the board, -inf for invalid moves. Searches
+        # self.depth plies unless depth is given, and raises SearchTimeout
+        # between plies and before the leaves are evaluated once the deadline
+        # (a time.time() value) has passed.
+        if depth is None:
+            depth = self.depth
+        frontier = np.array([board], dtype=np.uint64)
+        plies = []
+        is_max = True
+        self.nodes_expanded = 1
+        for _ in range(depth):
+            if deadline is not None and time.time() > deadline:
+                raise SearchTimeout()
+            if is_max:
+                children, valid = self._expand_max(frontier)
+                ply = {'is_max': True, 'frontier': frontier, 'valid': valid}
+            else:
+                children, parents, weights = self._expand_chance(frontier)
+                ply = {'is_max': False, 'frontier': frontier, 'parents': parents, 'weights': weights}
+            frontier, ply['inverse'] = np.unique(children, return_inverse=True)
+            plies.append(ply)
+            self.nodes_expanded += len(frontier)
+            is_max = not is_max
+            if len(frontier) == 0:
+                break
+
+        if deadline is not None and time.time() > deadline:
+            raise SearchTimeout()
+        values = self.heuristic_array(frontier).astype(np.float64)
+        for ply in reversed(plies):
+            child_values = values[ply['inverse']]
+            n = len(ply['frontier'])
+            if ply['is_max']:
+                move_values = np.full((n, len(bp.MOVES)), float('-inf'))
+                move_values[ply['valid']] = child_values
+                values = move_values.max(axis=1)
+                # Boards without a valid move are game over and are leaves
+                over = ~ply['valid'].any(axis=1)
+                if over.any():
+                    values[over] = self.heuristic_array(ply['frontier'][over])
+            else:
+                values = np.bincount(ply['parents'], weights=child_values * ply['weights'], minlength=n)
+        if not plies:
+            return np.full(len(bp.MOVES), float('-inf'))
+        # The root is the first max ply
+        return move_values[0]
+
+    def effort(self) -> int:
+        return self.nodes_expanded
+
+    def get_best_move(self) -> str:
+        move_values = self.search(int(self.board.board[0]), deadline=self.deadline)
+        if np.all(move_values == float('-inf')):
+            return None
+        return bp.MOVES[int(np.argmax(move_values))]
+
+    def anytime(self, deadline: float = None):
+        # Anytime version of get_best_move (see anytime.py), deepening from 1
+        # to self.depth plies with an update after each depth
+        start_time = time.time()
+        board = int(self.board.board[0])
+        valid_moves = self.board.get_valid_moves()
+        if not valid_moves:
+            yield MoveUpdate(None, 1.0, 0, time.time() - start_time)
+            return
+        yield MoveUpdate(valid_moves[0], 0.0, 0, time.time() - start_time)
+        nodes = 0
+        for depth in range(1, self.depth + 1):
+            try:
+                move_values = self.search(board, depth, deadline)
+            except SearchTimeout:
+                return
+            nodes += self.nodes_expanded
+            yield MoveUpdate(bp.MOVES[int(np.argmax(move_values))], depth / self.depth, nodes,
+                             time.time() - start_time)
+
+
+if __name__ == '__main__':
+    from visual import VisualAgent
+    board = bp.Board()
+    expectimax_board = BatchedExpectimaxBoard(board, depth=5, heuristic=heuristics.score_heuristic)
+    visual = VisualAgent(expectimax_board, delay=10)
@@ -0,0 +1,121 @@
+import binary_puzzle as bp
+import numpy as np
+import heuristics
+import memory_budget
+import trajectory
+import time
+
+# Greedy AI playing many games at once. All the games still running advance
+# together one move per step: the 4 successors of every board are built with
+# merge table gathers into an M x 4 array, scored with one vectorized
+# heuristic call, invalid moves are masked out and each game takes the move
+# with the highest value. Spawns are vectorized the same way.
+# It plays like GreedyBoard, ties going to the first move in bp.MOVES.
+
+def spawn_random_tiles(boards: np.ndarray, rng: np.random.Generator):
+    # Spawn a 2 (90%) or a 4 (10%) in a random empty cell of every board.
+    # Returns the new boards, and the cell index and exponent of each spawn.
+    empty = heuristics.tile_exponents(boards) == 0
+    counts = empty.sum(axis=1)
+    # Pick the k-th empty cell of each board
+    k = (rng.random(len(boards)) * counts).astype(np.int64)
+    cells = np.argmax(np.cumsum(empty, axis=1) > k[:, None], axis=1)
+    exponents = np.where(rng.random(len(boards)) < 0.9, 1, 2)
+    # Full boards are left as they are
+    exponents[counts == 0] = 0
+    boards = boards | (exponents.astype(np.uint64) << heuristics.CELL_SHIFTS[cells])
+    return boards, cells, exponents
+
+def greedy_moves(boards: np.ndarray, heuristic_array: callable):
+    # Index in bp.MOVES of the greedy move of every board, and the boards
+    # after it. Boards without a valid move get -1.
+    successors = np.stack([bp.swipe_array(boards, move) for move in bp.MOVES], axis=1)
+    valid = successors != boards[:, None]
+    values = heuristic_array(successors.ravel()).astype(np.float64).reshape(successors.shape)
+    values[~valid] = float('-inf')
+    moves = np.argmax(values, axis=1)
+    moves[~valid.any(axis=1)] = -1
+    return moves, successors[np.arange(len(boards)), moves]
+
+class BatchedGreedyRunner:
+    def __init__(self, games: int, heuristic: callable = None, seed: int = None, record: bool = False):
+        if heuristic is None:
+            heuristic = heuristics.score_heuristic
+        self.heuristic_array = heuristics.as_array_heuristic(heuristic)
+        self.rng = np.random.default_rng(seed)
+        if bp.Board.merge_array is None:
+            bp.Board._initialize_merge_array()
+
+        boards = np.zeros(games, dtype=np.uint64)
+        boards, _, _ = spawn_random_tiles(boards, self.rng)
+        self.boards, _, _ = spawn_random_tiles(boards, self.rng)
+        self.moves = np.zeros(games, dtype=np.int64)
+        self.active = np.ones(games, dtype=bool)
+        # Records of each game in the trajectory.py format
+        self.records = [[] for _ in range(games)] if record else None
+
+    def best_moves(self, boards: np.ndarray):
+        return greedy_moves(boards, self.heuristic_array)
+
+    def step(self) -> int:
+        # Advance every running game by one move, returns the number of games
+        # still running
+        games = np.flatnonzero(self.active)
+        boards = self.boards[games]
+        moves, after = self.best_moves(boards)
+        over = moves < 0
+        self.active[games[over]] = False
+        games, boards, moves, after = games[~over], boards[~over], moves[~over], after[~over]
+
+        after, cells, exponents = spawn_random_tiles(after, self.rng)
+        self.boards[games] = after
+        self.moves[games] += 1
+        if self.records is not None:
+            spawns = np.where(exponents > 0, cells | (exponents << 4), trajectory.NO_SPAWN)
+            for game, board, move, spawn in zip(games.tolist(), boards.tolist(), moves.tolist(), spawns.tolist()):
+                self.records[game].append((board, move, spawn))
+        return len(games)
+
+    def run(self) -> list:
+        # Play all the games to the end. The results have the format of
+        # analysis.run_game, the time of a game being its share of the total
+        # time by number of moves. The effort of a game is the successors it
+        # scored, and it has no search memory and no successor cache lookups
+        # (swipe_array doesn't use the cache).
+        start_time = time.time()
+        while self.step():
+            pass
+        elapsed = time.time() - start_time
+        time_per_move = elapsed / max(1, int(self.moves.sum()))
+
+        scores = heuristics.score_heuristic_array(self.boards)
+        grids = np.where(heuristics.tile_exponents(self.boards) > 0,
+                         1 << heuristics.tile_exponents(self.boards), 0)[:, ::-1].reshape(-1, 4, 4)
+        results = []
+        for game in range(len(self.boards)):
+            result = {
+                'score': int(scores[game]),
+                'moves': int(self.moves[game]),
+                'board': grids[game].tolist(),
+                'time': float(self.moves[game] * time_per_move),
+                'effort': 4 * int(self.moves[game]),
+                'search_memory': 0,
+                'peak_rss': memory_budget.peak_rss(),
+                'successor_cache_hit_rate': 0.0
+            }
+            if self.records is not None:
+                records = np.array(self.records[game] + [(int(self.boards[game]), trajectory.NO_MOVE,
+                                                          trajectory.NO_SPAWN)], dtype=trajectory.RECORD_DTYPE)
+                result['trajectory'] = records
+            results.append(result)
+        return results
+
+
+if __name__ == '__main__':
+    for heuristic in [heuristics.score_heuristic, heuristics.open_cells_heuristic]:
+        start_time = time.time()
+        results = BatchedGreedyRunner(10000, heuristic, seed=0).run()
+        elapsed = time.time() - start_time
+        scores = [result['score'] for result in results]
+        print(f"{heuristic.__name__}: {len(results)} games in {elapsed:.1f}s, "
+              f"average score {np.mean(scores):.0f}, max score {max(scores)}")
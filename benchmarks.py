@@ -0,0 +1,136 @@
+import binary_puzzle as bp
+from greedy_ai import GreedyBoard
+from expectimax_ai import ExpectimaxBoard
+from batched_expectimax import BatchedExpectimaxBoard
+from batched_greedy import BatchedGreedyRunner
+from mcts_ai import MCTSBoard, RandomPlayout, EpsilonGreedyPlayout, CornerPlayout
+import heuristics
+import numpy as np
+import random
+import time
+
+def sample_positions(count=10, seed=0, max_moves=200):
+    # Positions from greedy games stopped after a random number of moves, so
+    # both early and late game boards are represented
+    rng = np.random.default_rng(seed)
+    np.random.seed(seed)
+    positions = []
+    while len(positions) < count:
+        board = bp.Board()
+        greedy_board = GreedyBoard(board, heuristics.open_cells_heuristic)
+        for _ in range(int(rng.integers(1, max_moves))):
+            if board.is_game_over():
+                break
+            greedy_board.take_best_move()
+        if not board.is_game_over():
+            positions.append(int(board.board[0]))
+    return positions
+
+def benchmark_expectimax_pruning(depths=(4, 5), positions=10, seed=0):
+    # Compare the plain expectimax search with move ordering and Star1 pruning
+    # on the same positions. The best move must be the same for both.
+    boards = sample_positions(positions, seed)
+    configs = [
+        ('open_cells_heuristic', heuristics.open_cells_heuristic, heuristics.open_cells_bounds),
+        ('max_tile_heuristic', heuristics.max_tile_heuristic, heuristics.max_tile_bounds),
+    ]
+    for depth in depths:
+        for name, heuristic, bounds in configs:
+            nodes = [0, 0]
+            times = [0.0, 0.0]
+            for board in boards:
+                moves = []
+                for i, options in enumerate([{}, {'move_ordering': True, 'heuristic_bounds': bounds}]):
+                    expectimax_board = ExpectimaxBoard(bp.Board(board), depth=depth, heuristic=heuristic, **options)
+                    start_time = time.time()
+                    moves.append(expectimax_board.get_best_move())
+                    times[i] += time.time() - start_time
+                    nodes[i] += expectimax_board.nodes_expanded
+                if moves[0] != moves[1]:
+                    raise AssertionError(f"Pruned search chose {moves[1]} instead of {moves[0]} on {hex(board)}")
+            print(f"depth={depth}, heuristic={name}: "
+                  f"nodes/decision {nodes[0] / len(boards):.0f} -> {nodes[1] / len(boards):.0f} "
+                  f"({100 * (1 - nodes[1] / nodes[0]):.1f}% fewer), "
+                  f"time/decision {times[0] / len(boards):.3f}s -> {times[1] / len(boards):.3f}s")
+
+def benchmark_batched_expectimax(depths=(2, 3, 4), positions=10, seed=0):
+    # Compare the recursive expectimax search with the breadth-first one
+    boards = sample_positions(positions, seed)
+    for depth in depths:
+        times = [0.0, 0.0]
+        agree = 0
+        for board in boards:
+            moves = []
+            for i, board_class in enumerate([ExpectimaxBoard, BatchedExpectimaxBoard]):
+                ai_board = board_class(bp.Board(board), depth=depth, heuristic=heuristics.score_heuristic)
+                start_time = time.time()
+                moves.append(ai_board.get_best_move())
+                times[i] += time.time() - start_time
+            agree += moves[0] == moves[1]
+        print(f"depth={depth}: time/decision {times[0] / len(boards):.3f}s -> {times[1] / len(boards):.4f}s "
+              f"({times[0] / times[1]:.0f}x), same move {agree}/{len(boards)}")
+
+def benchmark_batched_greedy(games=(10, 100, 1000), baseline_games=20, seed=0):
+    # Games per second of GreedyBoard against the batched runner
+    np.random.seed(seed)
+    start_time = time.time()
+    for _ in range(baseline_games):
+        greedy_board = GreedyBoard(bp.Board(), heuristics.score_heuristic)
+        while greedy_board.take_best_move():
+            pass
+    baseline = baseline_games / (time.time() - start_time)
+    print(f"GreedyBoard: {baseline:.1f} games/s")
+    for count in games:
+        start_time = time.time()
+        BatchedGreedyRunner(count, heuristics.score_heuristic, seed=seed).run()
+        rate = count / (time.time() - start_time)
+        print(f"BatchedGreedyRunner({count}): {rate:.1f} games/s ({rate / baseline:.0f}x)")
+
+def benchmark_mcts_playouts(simulation_time=0.1, positions=10, reference_depth=3, games=3,
+                            game_simulation_time=0.01, seed=0):
+    # Speed of each MCTS playout policy in playouts and playout moves per
+    # second. The quality of its signal is measured by how often the move it
+    # picks agrees with a deeper expectimax search, and by the scores of games
+    # played with a short time per move.
+    boards = sample_positions(positions, seed)
+    composite = heuristics.CompositeHeuristic()
+    reference = [ExpectimaxBoard(bp.Board(board), depth=reference_depth, heuristic=composite).get_best_move()
+                 for board in boards]
+    configs = [
+        ('board_random', {}),
+        ('random', {'playout_policy': RandomPlayout()}),
+        ('epsilon_greedy', {'playout_policy': EpsilonGreedyPlayout(epsilon=0.1)}),
+        ('epsilon_greedy_composite', {'playout_policy': EpsilonGreedyPlayout(composite.evaluate, epsilon=0.1)}),
+        ('corner', {'playout_policy': CornerPlayout()}),
+        ('random_depth_10', {'playout_policy': RandomPlayout(), 'rollout_depth': 10}),
+        ('epsilon_greedy_depth_10', {'playout_policy': EpsilonGreedyPlayout(epsilon=0.1), 'rollout_depth': 10}),
+        ('corner_depth_10', {'playout_policy': CornerPlayout(), 'rollout_depth': 10}),
+    ]
+    for name, options in configs:
+        random.seed(seed)
+        np.random.seed(seed)
+        policy = options.get('playout_policy')
+        playouts = 0
+        agree = 0
+        for board, move in zip(boards, reference):
+            mcts_board = MCTSBoard(bp.Board(board), simulation_time, heuristics.score_heuristic, **options)
+            agree += mcts_board.get_best_move() == move
+            playouts += mcts_board.playouts
+        elapsed = simulation_time * len(boards)
+        moves = f", {policy.moves_played / elapsed:.0f} playout moves/s" if policy is not None else ""
+
+        scores = []
+        for _ in range(games):
+            mcts_board = MCTSBoard(bp.Board(), game_simulation_time, heuristics.score_heuristic, **options)
+            while mcts_board.take_best_move():
+                pass
+            scores.append(mcts_board.board.score())
+        print(f"{name}: {playouts / elapsed:.0f} playouts/s{moves}, "
+              f"agrees with depth {reference_depth} expectimax {agree}/{len(boards)}, "
+              f"average score {np.mean(scores) if scores else float('nan'):.0f}")
+
+if __name__ == '__main__':
+    benchmark_expectimax_pruning()
+    benchmark_batched_expectimax()
+    benchmark_batched_greedy()
+    benchmark_mcts_playouts()
@@ -1,7 +1,46 @@
 import numpy as np
+import functools
+import table_cache
+from memory_budget import max_entries, successor_budget, SUCCESSOR_ENTRY_BYTES
+
+# Moves in the order used by get_valid_moves
+MOVES = ["left", "right", "up", "down"]
+MOVE_INDEX = {move: i for i, move in enumerate(MOVES)}
+
+# Valid moves by bit mask of the valid moves (bit i for MOVES[i]), see successors
+VALID_MOVES = [[move for i, move in enumerate(MOVES) if mask >> i & 1] for mask in range(16)]
+
+# Boards kept in the successor cache, its share of the memory budget (see
+# memory_budget.py)
+SUCCESSOR_CACHE_SIZE = max_entries(SUCCESSOR_ENTRY_BYTES, successor_budget())
+
+# Bit offset of each cell of the 4x4 grid in the 64-bit board, the top left
+# cell being in the highest nibble
+GRID_SHIFTS = np.arange(60, -1, -4, dtype=np.uint64).reshape(4, 4)
+
+# Value of a tile by exponent, 0 being an empty cell
+TILE_VALUES = np.array([0] + [2 ** e for e in range(1, 16)], dtype=np.uint64)
+
+# Contribution of a tile to Board.score, by exponent: a tile 2^e adds
+# 2^e + 2^(e-1) + ... + 4, and a 2 adds 2 + 1
+TILE_SCORES = np.array([0, 3] + [2 ** (e + 1) - 4 for e in range(2, 16)], dtype=np.int64)
 
 class Board:
+    size = 4  # Width and height of the grid
     merge_array = None  # Class variable to store the merge array
+    merge_right_array = None  # Class variable to store the merge array for right swipes
+    # Memoryviews of the merge arrays for swipe_int. Indexing them gives
+    # Python ints, without copying the memory mapped tables into each process.
+    merge_view = None
+    merge_right_view = None
+    # Column tables of the vertical swipes (see _build_column_arrays), and
+    # their memoryviews for swipe_int
+    column_array = None
+    column_up_array = None
+    column_down_array = None
+    column_view = None
+    column_up_view = None
+    column_down_view = None
 
     def __init__(self, board: int = None, num_moves: int = 0):
         if board is None:
@@ -13,16 +52,59 @@ class Board:
             Board._initialize_merge_array()
 
         self.total_moves = num_moves
+        # List of (board, move index, spawn) for each move when the game is
+        # being recorded (see trajectory.py). Copies are never recorded.
+        self.trajectory = None
+        # Decoded 4x4 views of the board and the board value they were decoded
+        # from (see get_exponent_board)
+        self._view_board = None
+        self._exponents = None
+        self._values = None
 
     def __str__(self):
         return str(self.get_2048_board())
 
     @classmethod
     def _initialize_merge_array(cls):
+        # The merge arrays are built once and cached on disk, later processes
+        # memory map them (see table_cache.py)
+        tables = table_cache.load_tables('board_merge', cls._build_merge_arrays)
+        cls.merge_array = tables['left']
+        cls.merge_right_array = tables['right']
+        cls.merge_view = memoryview(cls.merge_array)
+        cls.merge_right_view = memoryview(cls.merge_right_array)
+        columns = table_cache.load_tables('board_columns', cls._build_column_arrays)
+        cls.column_array = columns['transpose']
+        cls.column_up_array = columns['up']
+        cls.column_down_array = columns['down']
+        cls.column_view = memoryview(cls.column_array)
+        cls.column_up_view = memoryview(cls.column_up_array)
+        cls.column_down_view = memoryview(cls.column_down_array)
+
+    @classmethod
+    def _build_merge_arrays(cls):
         # Precompute the merge array for all 16-bit values
         arr = np.arange(0, 0xffff + 1, 1, dtype=np.uint16)
         cls._compute_merge(arr)
-        cls.merge_array = arr
+        # Swiping right is swiping the reversed row left and reversing it back
+        rows = np.arange(0, 0xffff + 1, 1, dtype=np.uint16)
+        return {'left': arr, 'right': reverse_rows(arr[reverse_rows(rows)])}
+
+    @classmethod
+    def _build_column_arrays(cls):
+        # A 16-bit row spread down a column: nibble k of the row moves to bit
+        # 16 * k of a 64-bit word. Shifted left by 4 * (3 - r), the word is the
+        # contribution of row r to the transposed board, so a transpose is 4
+        # lookups and ORs. The up and down tables spread the merged row
+        # instead, so a column goes through its merge and back to its place in
+        # the board in a single lookup.
+        rows = np.arange(0, 0xffff + 1, 1, dtype=np.uint64)
+        spread = np.zeros_like(rows)
+        for k in range(4):
+            spread |= ((rows >> np.uint64(4 * k)) & np.uint64(0xF)) << np.uint64(16 * k)
+        return {'transpose': spread,
+                'up': spread[cls.merge_array],
+                'down': spread[cls.merge_right_array]}
 
     @staticmethod
     def _compute_merge(arr):
@@ -118,87 +200,51 @@ class Board:
                     ((board & 0x00F0) << 4))
                 
     def swipe_up(self):
-        # Convert the board to a 16-bit array with each row as a 16-bit value
-        # View creates an array where the first value (16 bit number) is the last
-        # row of the board.
-        # LAST ROW IS FIRST VALUE
-        board = self.board.view(np.uint16)
-        # Modify the board so each 16-bit value is a column instead of a row
-        # using bitwise operations
-        new_board = np.zeros_like(board)
-        # Extract each column from each 16-bit value
-        # First column is the first nibble of each 16-bit value
-        n0 = (board >> 0) & 0xF
-        # Second column is the second nibble of each 16-bit value
-        n1 = (board >> 4) & 0xF
-        n2 = (board >> 8) & 0xF
-        n3 = (board >> 12) & 0xF
-
-        # n0 n1 n2 n3 are the columns of the board
-        new_board[0] = (n0[3] << 12) | (n0[2] << 8) | (n0[1] << 4) | n0[0]
-        new_board[1] = (n1[3] << 12) | (n1[2] << 8) | (n1[1] << 4) | n1[0]
-        new_board[2] = (n2[3] << 12) | (n2[2] << 8) | (n2[1] << 4) | n2[0]
-        new_board[3] = (n3[3] << 12) | (n3[2] << 8) | (n3[1] << 4) | n3[0]
-
-        # Merge the columns by using the merge array
-        merged = self.merge(new_board)
-
-        # Convert the merged columns back to rows
-        # Extract each column from each 16-bit value
-        n0 = (merged >> 0) & 0xF
-        n1 = (merged >> 4) & 0xF
-        n2 = (merged >> 8) & 0xF
-        n3 = (merged >> 12) & 0xF
-
-        # n0 n1 n2 n3 are the columns of the board
-        board[0] = (n0[3] << 12) | (n0[2] << 8) | (n0[1] << 4) | n0[0]
-        board[1] = (n1[3] << 12) | (n1[2] << 8) | (n1[1] << 4) | n1[0]
-        board[2] = (n2[3] << 12) | (n2[2] << 8) | (n2[1] << 4) | n2[0]
-        board[3] = (n3[3] << 12) | (n3[2] << 8) | (n3[1] << 4) | n3[0]
+        # Vertical swipes go through the column tables (see swipe_int)
+        self.board[0] = swipe_int(int(self.board[0]), "up")
 
     def swipe_down(self):
-        # Convert the board to a 16-bit array with each row as a 16-bit value
-        # View creates an array where the first value (16 bit number) is the last
-        # row of the board.
-        # LAST ROW IS FIRST VALUE
-        board = self.board.view(np.uint16)
-        # Flip the board upside down
-        board[:] = board[::-1]
-        # Swipe the board to the left up
-        self.swipe_up()
-        # Flip the board upside down again
-        board[:] = board[::-1]
+        self.board[0] = swipe_int(int(self.board[0]), "down")
 
     def swipe(self, direction):
-        # Move the board in a direction
-        if direction == "left":
-            self.swipe_left()
-        elif direction == "right":
-            self.swipe_right()
-        elif direction == "up":
-            self.swipe_up()
-        elif direction == "down":
-            self.swipe_down()
+        # Move the board in a direction, with the successor from the cache
+        if direction in MOVE_INDEX:
+            self.board[0] = successors(int(self.board[0]))[0][MOVE_INDEX[direction]]
 
     def move(self, direction):
         # Move the board in a direction
+        if self.trajectory is not None:
+            before = int(self.board[0])
         self.swipe(direction)
-        self.spawn_random_tile()
+        spawn = self.spawn_random_tile()
         self.total_moves += 1
+        if self.trajectory is not None:
+            self.trajectory.append((before, MOVE_INDEX[direction], spawn))
+
+    def _update_views(self):
+        # The views are decoded again only when the board value has changed
+        # since they were last decoded, so any change to self.board, in place
+        # or not, invalidates them
+        board_value = int(self.board[0])
+        if board_value != self._view_board:
+            exponents = ((self.board[0] >> GRID_SHIFTS) & np.uint64(0xF)).astype(np.uint8)
+            self._exponents = exponents
+            self._values = TILE_VALUES[exponents]
+            # Read-only, as they are shared by every caller until the board changes
+            self._exponents.setflags(write=False)
+            self._values.setflags(write=False)
+            self._view_board = board_value
+
+    def get_exponent_board(self):
+        # 4x4 array of tile exponents, 0 for empty cells. Read-only.
+        self._update_views()
+        return self._exponents
 
     def get_2048_board(self):
-        # Get the 2048 board from the 64-bit board
-        new_board = np.zeros((4, 4), dtype=np.uint64)
-        board_value = int(self.board[0])  # Convert to Python integer for bit operations
-        # Row
-        for i in range(4):
-            # Column
-            for j in range(4):
-                val = ((board_value >> (i * 16 + j * 4)) & 0xF)
-                if val > 0:
-                    new_board[3 - i, 3 - j] = 2 ** val
-        return new_board
-    
+        # 4x4 array of tile values, 0 for empty cells. Read-only.
+        self._update_views()
+        return self._values
+
     def _spawn_initial_tiles(self):
         # Spawn two initial tiles
         # Because the board is initialized to 0, we can just pick two random tiles
@@ -228,6 +274,8 @@ class Board:
         # Each tile is 4 bits, so we need to find the empty tiles
         # and insert a 2 or 4 into the tile randomly.
         # The tile is 2 with a 90% probability and 4 with a 10% probability.
+        # Returns (cell index, exponent) of the new tile, or None if the board
+        # is full.
 
         # Convert board to 4x4 array of 4-bit values
         board_value = int(self.board[0])
@@ -246,76 +294,50 @@ class Board:
             
             # Update the board with the new tile
             self.board[0] |= np.uint64(new_value << np.uint64(spawn_index * 4))
+            return int(spawn_index), int(new_value)
+        return None
+
+    # Valid moves come from the successor cache, which swipes each board in
+    # the 4 directions once however many times it is checked
 
     def can_swipe_left(self):
-        test_board = self.board.copy()
-        self.swipe_left()
-        changed = not np.array_equal(test_board, self.board)
-        self.board = test_board
-        return changed
+        return bool(successors(int(self.board[0]))[1] & 1)
 
     def can_swipe_right(self):
-        test_board = self.board.copy()
-        self.swipe_right()
-        changed = not np.array_equal(test_board, self.board)
-        self.board = test_board
-        return changed
+        return bool(successors(int(self.board[0]))[1] & 2)
 
     def can_swipe_up(self):
-        test_board = self.board.copy()
-        self.swipe_up()
-        changed = not np.array_equal(test_board, self.board)
-        self.board = test_board
-        return changed
+        return bool(successors(int(self.board[0]))[1] & 4)
 
     def can_swipe_down(self):
-        test_board = self.board.copy()
-        self.swipe_down()
-        changed = not np.array_equal(test_board, self.board)
-        self.board = test_board
-        return changed
+        return bool(successors(int(self.board[0]))[1] & 8)
     
     def get_valid_moves(self):
-        # Get the valid moves
-        moves = []
-        if self.can_swipe_left():
-            moves.append("left")
-        if self.can_swipe_right():
-            moves.append("right")
-        if self.can_swipe_up():
-            moves.append("up")
-        if self.can_swipe_down():
-            moves.append("down")
-        return moves
+        # Get the valid moves, in the order of MOVES. A new list, so callers
+        # can modify it.
+        return list(VALID_MOVES[successors(int(self.board[0]))[1]])
 
     def is_game_over(self):
         # Check if any swipe is possible
-        if self.can_swipe_left() or self.can_swipe_right() or self.can_swipe_up() or self.can_swipe_down():
-            return False
-        return True
+        return successors(int(self.board[0]))[1] == 0
     
     def copy(self):
-        return Board(int(self.board[0]), self.total_moves)
+        board = Board(int(self.board[0]), self.total_moves)
+        # The views are read-only, so the copy can share them
+        board._view_board, board._exponents, board._values = self._view_board, self._exponents, self._values
+        return board
     
     def score(self):
         # Get the score of the board
-        # This is done by repeatedly adding the value of the tiles
-        # and dividing by 2 until the value is 0
-        # This is because score is increased by the new value of the tile
-        # when two tiles are merged
-        score = 0
-        game_board = self.get_2048_board()
-        while np.any(game_board):
-            score += np.sum(game_board)
-            game_board = game_board // 2
-            # Get rid of any 2s in the board as they are not part of the score
-            game_board[game_board == 2] = 0
-        return score
+        # This is the sum of the values of the tiles, halved repeatedly until
+        # they are 2s, as the score is increased by the new value of the tile
+        # when two tiles are merged. That sum only depends on the exponent of
+        # each tile, so it is looked up per tile in TILE_SCORES.
+        return int(TILE_SCORES[self.get_exponent_board()].sum())
     
     def get_open_cells(self):
         # Get the indices of the open cells
-        game_board = self.get_2048_board()
-        return np.argwhere(game_board == 0)
+        return np.argwhere(self.get_exponent_board() == 0)
     
     def place_tile(self, cell, value):
         # Place a tile in the board
@@ -330,6 +352,99 @@ class Board:
         self.board[0] |= np.uint64(value << np.uint64((3 - cell[0]) * 16 + (3 - cell[1]) * 4))
 
 
+def reverse_rows(rows):
+    # Reverse the order of the 4 nibbles of 16-bit rows
+    return ((rows >> 12) |
+            ((rows >> 4) & 0x00F0) |
+            ((rows << 4) & 0x0F00) |
+            ((rows << 12) & 0xF000))
+
+def transpose(board: int) -> int:
+    # Transpose the 4x4 grid of nibbles of a 64-bit board so that the columns
+    # become the 16-bit rows. Swaps the off-diagonal nibbles within each 2x2
+    # block first, then swaps the off-diagonal 2x2 blocks.
+    a1 = board & 0xF0F00F0FF0F00F0F
+    a2 = board & 0x0000F0F00000F0F0
+    a3 = board & 0x0F0F00000F0F0000
+    a = a1 | (a2 << 12) | (a3 >> 12)
+    b1 = a & 0xFF00FF0000FF00FF
+    b2 = a & 0x00FF00FF00000000
+    b3 = a & 0x00000000FF00FF00
+    return b1 | (b2 >> 24) | (b3 << 24)
+
+def swipe_int(board: int, direction: str) -> int:
+    # Swipe a 64-bit board given as a Python int. Searches that only need the
+    # resulting board are much faster with this than with a Board copy.
+    if Board.merge_view is None:
+        Board._initialize_merge_array()
+    if direction in ("up", "down"):
+        # Transpose with the column table, then merge each column and put it
+        # back in place with the up or down table
+        column = Board.column_view
+        columns = (column[board & 0xFFFF] |
+                   (column[(board >> 16) & 0xFFFF] << 4) |
+                   (column[(board >> 32) & 0xFFFF] << 8) |
+                   (column[board >> 48] << 12))
+        column = Board.column_up_view if direction == "up" else Board.column_down_view
+        return (column[columns & 0xFFFF] |
+                (column[(columns >> 16) & 0xFFFF] << 4) |
+                (column[(columns >> 32) & 0xFFFF] << 8) |
+                (column[columns >> 48] << 12))
+    if direction == "left":
+        merge = Board.merge_view
+    else:
+        merge = Board.merge_right_view
+    return (merge[board & 0xFFFF] |
+            (merge[(board >> 16) & 0xFFFF] << 16) |
+            (merge[(board >> 32) & 0xFFFF] << 32) |
+            (merge[(board >> 48) & 0xFFFF] << 48))
+
+@functools.lru_cache(maxsize=SUCCESSOR_CACHE_SIZE)
+def successors(board: int) -> tuple:
+    # Boards after each move of MOVES from a 64-bit board, and the bit mask of
+    # the moves changing the board. The cache is shared by every Board and
+    # engine of the process, least recently used boards are evicted first.
+    after = tuple(swipe_int(board, move) for move in MOVES)
+    mask = (after[0] != board) | (after[1] != board) << 1 | (after[2] != board) << 2 | (after[3] != board) << 3
+    return after, mask
+
+def successor_cache_stats() -> dict:
+    # Lookups, hit rate and approximate bytes of the successor cache since
+    # the process started
+    info = successors.cache_info()
+    lookups = info.hits + info.misses
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+            'memory': info.currsize * SUCCESSOR_ENTRY_BYTES,
+            'hit_rate': info.hits / lookups if lookups else 0.0}
+
+def swipe_array(boards: np.ndarray, direction: str) -> np.ndarray:
+    # Swipe every board of an array of 64-bit boards in one direction.
+    # Vertical swipes use the column tables like swipe_int.
+    if Board.merge_array is None:
+        Board._initialize_merge_array()
+    boards = np.asarray(boards, dtype=np.uint64)
+    if direction in ("up", "down"):
+        columns = np.zeros_like(boards)
+        for shift in (0, 16, 32, 48):
+            rows = (boards >> np.uint64(shift)) & np.uint64(0xFFFF)
+            columns |= Board.column_array[rows] << np.uint64(shift // 4)
+        column_array = Board.column_up_array if direction == "up" else Board.column_down_array
+        result = np.zeros_like(boards)
+        for shift in (0, 16, 32, 48):
+            rows = (columns >> np.uint64(shift)) & np.uint64(0xFFFF)
+            result |= column_array[rows] << np.uint64(shift // 4)
+        return result
+    if direction == "left":
+        merge_array = Board.merge_array
+    else:
+        merge_array = Board.merge_right_array
+    result = np.zeros_like(boards)
+    for shift in (0, 16, 32, 48):
+        rows = (boards >> np.uint64(shift)) & np.uint64(0xFFFF)
+        result |= merge_array[rows].astype(np.uint64) << np.uint64(shift)
+    return result
+
+
 if __name__ == "__main__":
     board = Board()
     # board.board = np.array([0x1000_0100_0010_0001], dtype=np.uint64)
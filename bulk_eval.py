@@ -0,0 +1,145 @@
+import binary_puzzle as bp
+import heuristics
+from batched_expectimax import BatchedExpectimaxBoard
+import numpy as np
+import os
+import time
+import multiprocessing
+
+# Bulk evaluation of datasets of positions. Takes an array of 64-bit boards, or
+# a file of them that is memory mapped, and computes for every board:
+#  - values: the heuristic value of the board
+#  - valid: a mask of the valid moves, one column per move of bp.MOVES
+#  - best_moves: index in bp.MOVES of the expectimax best move at the chosen
+#    depth, -1 when the game is over
+# The boards are processed in chunks by a pool of processes. Workers memory map
+# input files themselves, and with an output directory the results are written
+# into memory mapped .npy files as chunks finish, so memory stays bounded by
+# the chunk size whatever the size of the dataset.
+
+# Worker state
+_source = None
+_heuristic = None
+_depth = None
+
+def load_boards(source) -> np.ndarray:
+    # Boards from an array, a .npy file or a raw file of little endian
+    # 64-bit boards. Files are memory mapped, not read.
+    if isinstance(source, str):
+        if source.endswith('.npy'):
+            boards = np.load(source, mmap_mode='r')
+        else:
+            boards = np.memmap(source, dtype='<u8', mode='r')
+    else:
+        boards = np.asarray(source)
+    return boards.reshape(-1)
+
+def evaluate_chunk(boards: np.ndarray, heuristic: callable = None, depth: int = 1):
+    # Values, valid move masks and best moves of an array of boards.
+    # depth counts plies like ExpectimaxBoard, so depth 1 is the greedy move.
+    if heuristic is None:
+        heuristic = heuristics.score_heuristic
+    boards = np.ascontiguousarray(boards, dtype=np.uint64)
+    heuristic_array = heuristics.as_array_heuristic(heuristic)
+    values = heuristic_array(boards).astype(np.float64)
+
+    successors = np.stack([bp.swipe_array(boards, move) for move in bp.MOVES], axis=1)
+    valid = successors != boards[:, None]
+    if depth <= 1:
+        # All the moves of the chunk are scored in one call
+        move_values = heuristic_array(successors.ravel()).astype(np.float64).reshape(successors.shape)
+        move_values[~valid] = float('-inf')
+        best_moves = np.argmax(move_values, axis=1)
+    else:
+        search = BatchedExpectimaxBoard(None, depth, heuristic)
+        best_moves = np.array([np.argmax(search.search(board)) for board in boards.tolist()], dtype=np.int64)
+    best_moves[~valid.any(axis=1)] = -1
+    return values, valid, best_moves.astype(np.int8)
+
+def _init_worker(source, heuristic, depth):
+    global _source, _heuristic, _depth
+    if bp.Board.merge_array is None:
+        bp.Board._initialize_merge_array()
+    # Input files are memory mapped once per worker
+    _source = load_boards(source) if isinstance(source, str) else None
+    _heuristic = heuristic
+    _depth = depth
+
+def _evaluate_task(task):
+    start, end, chunk = task
+    if chunk is None:
+        chunk = _source[start:end]
+    return start, end, evaluate_chunk(chunk, _heuristic, _depth)
+
+def _output_arrays(count: int, output: str):
+    # Result arrays, memory mapped files in the output directory if given
+    shapes = {'values': ((count,), np.float64), 'valid': ((count, len(bp.MOVES)), bool),
+              'best_moves': ((count,), np.int8)}
+    if output is None:
+        return {name: np.empty(shape, dtype=dtype) for name, (shape, dtype) in shapes.items()}
+    if not os.path.exists(output):
+        os.makedirs(output)
+    return {name: np.lib.format.open_memmap(os.path.join(output, f'{name}.npy'), mode='w+',
+                                            dtype=dtype, shape=shape)
+            for name, (shape, dtype) in shapes.items()}
+
+def evaluate_boards(source, heuristic: callable = None, depth: int = 1, chunk_size: int = 65536,
+                    processes: int = None, output: str = None, progress: bool = True) -> dict:
+    # Evaluate every board of the source (see load_boards). Returns a dict of
+    # the values, valid and best_moves arrays, backed by .npy files in output
+    # when it is given. With processes=1 the chunks are evaluated in this
+    # process.
+    if heuristic is None:
+        heuristic = heuristics.score_heuristic
+    boards = load_boards(source)
+    count = len(boards)
+    results = _output_arrays(count, output)
+
+    # Chunks of in-memory arrays are sent to the workers, chunks of files are
+    # read by the workers from their own memory map
+    from_file = isinstance(source, str)
+    tasks = ((start, min(start + chunk_size, count), None if from_file else boards[start:start + chunk_size])
+             for start in range(0, count, chunk_size))
+
+    done = 0
+    start_time = time.time()
+    if processes == 1:
+        _init_worker(source, heuristic, depth)
+        chunks = map(_evaluate_task, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes=processes, initializer=_init_worker,
+                                    initargs=(source if from_file else None, heuristic, depth))
+        chunks = pool.imap_unordered(_evaluate_task, tasks)
+    try:
+        for start, end, (values, valid, best_moves) in chunks:
+            results['values'][start:end] = values
+            results['valid'][start:end] = valid
+            results['best_moves'][start:end] = best_moves
+            done += end - start
+            if progress:
+                elapsed = time.time() - start_time
+                rate = done / elapsed
+                print(f"Boards {done}/{count}: {rate:.0f} boards/s, "
+                      f"{(count - done) / rate:.0f}s left")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if output is not None:
+        for array in results.values():
+            array.flush()
+    return results
+
+
+if __name__ == '__main__':
+    from batched_greedy import BatchedGreedyRunner
+    # Positions from greedy games, evaluated with a depth 3 search
+    runner = BatchedGreedyRunner(1000, heuristics.open_cells_heuristic, seed=0, record=True)
+    games = runner.run()
+    positions = np.unique(np.concatenate([game['trajectory']['board'] for game in games]))
+    if not os.path.exists('datasets'):
+        os.makedirs('datasets')
+    np.save('datasets/positions.npy', positions)
+    evaluate_boards('datasets/positions.npy', heuristics.score_heuristic, depth=3, chunk_size=4096,
+                    output='datasets/positions_depth_3')
@@ -0,0 +1,205 @@
+import binary_puzzle as bp
+import agents
+import heuristics
+import numpy as np
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+# Head-to-head comparison of agent configurations with early stopping.
+# Every configuration plays the same seeds, and a game's spawns come from a
+# generator seeded by its seed alone, so the games of two configurations on a
+# seed face the same tiles for as long as they play the same moves. Games are
+# played in rounds of a few seeds, and after each round every pair of
+# configurations still undecided is tested on its paired score differences.
+# A pair stops once its test decides, and a configuration stops playing once
+# all its pairs are decided, so clear differences are settled in a few games
+# and the games budget goes to the close ones.
+
+class SPRT:
+    # Sequential probability ratio test on the paired games won (sign test),
+    # which is robust to the heavy tails of the 2048 scores. Tests H1: the
+    # first configuration wins a paired game with probability 0.5 + delta,
+    # against H0: with probability 0.5 - delta, with error rates alpha and
+    # beta. Ties are ignored.
+    def __init__(self, delta: float = 0.1, alpha: float = 0.05, beta: float = 0.05):
+        self.delta = delta
+        self.alpha = alpha
+        self.beta = beta
+
+    def decide(self, differences: np.ndarray):
+        # 1 if the first configuration is better, -1 if the second one is,
+        # None while undecided
+        wins = int(np.sum(differences > 0))
+        losses = int(np.sum(differences < 0))
+        llr = (wins - losses) * math.log((0.5 + self.delta) / (0.5 - self.delta))
+        if llr >= math.log((1 - self.beta) / self.alpha):
+            return 1
+        if llr <= math.log(self.beta / (1 - self.alpha)):
+            return -1
+        return None
+
+class BootstrapCI:
+    # Bootstrap confidence interval of the mean paired score difference. The
+    # pair is decided once the interval excludes 0, or lies within +-margin
+    # (equivalent configurations, 0) when a margin is given. The interval is
+    # checked after every round, so the level is kept high to make up for the
+    # repeated looks.
+    def __init__(self, level: float = 0.99, min_games: int = 10, resamples: int = 2000, margin: float = None,
+                 seed: int = 0):
+        self.level = level
+        self.min_games = min_games
+        self.resamples = resamples
+        self.margin = margin
+        self.rng = np.random.default_rng(seed)
+
+    def interval(self, differences: np.ndarray) -> tuple:
+        samples = self.rng.integers(0, len(differences), size=(self.resamples, len(differences)))
+        means = differences[samples].mean(axis=1)
+        tail = 100 * (1 - self.level) / 2
+        return float(np.percentile(means, tail)), float(np.percentile(means, 100 - tail))
+
+    def decide(self, differences: np.ndarray):
+        if len(differences) < self.min_games:
+            return None
+        low, high = self.interval(differences)
+        if low > 0:
+            return 1
+        if high < 0:
+            return -1
+        if self.margin is not None and -self.margin < low and high < self.margin:
+            return 0
+        return None
+
+def _spawn_tile(board: bp.Board, rng: np.random.Generator):
+    # Spawn a 2 (90%) or a 4 (10%) in a random empty cell with the game's own
+    # generator, so the search's use of np.random doesn't change the spawns
+    value = int(board.board[0])
+    empty = [cell for cell in range(16) if not (value >> (4 * cell)) & 0xF]
+    if empty:
+        cell = empty[int(rng.integers(len(empty)))]
+        exponent = 1 if rng.random() < 0.9 else 2
+        board.board[0] = np.uint64(value | (exponent << (4 * cell)))
+
+def play_game(agent_name: str, options: dict, seed: int) -> int:
+    # Score of a game of the agent on the seed
+    np.random.seed(seed)
+    random.seed(seed)
+    rng = np.random.default_rng(seed)
+    board = bp.Board(0)
+    _spawn_tile(board, rng)
+    _spawn_tile(board, rng)
+    agent = agents.make_agent(agent_name, board, **options)
+    while True:
+        move = agent.get_best_move()
+        if move is None:
+            break
+        board.swipe(move)
+        _spawn_tile(board, rng)
+        board.total_moves += 1
+    return int(board.score())
+
+def _play_game_wrapper(args):
+    # Initialize Board's merge_array for this process
+    if bp.Board.merge_array is None:
+        bp.Board._initialize_merge_array()
+    name, agent_name, options, seed = args
+    return name, play_game(agent_name, options, seed)
+
+def compare(configs: dict, test=None, max_games: int = 100, round_games: int = 8, processes: int = 8,
+            seed: int = 0) -> dict:
+    # Compare configurations given as name -> (agent name, options of the
+    # agent), with the test (SPRT by default) deciding each pair. Every
+    # configuration plays at most max_games games.
+    if test is None:
+        test = SPRT()
+    seeds = np.random.default_rng(seed).integers(0, 2**31, size=max_games).tolist()
+    scores = {name: [] for name in configs}
+    # (first, second) -> (decision, games played when decided)
+    pairs = {pair: (None, None) for pair in itertools.combinations(configs, 2)}
+    played = 0
+    start_time = time.time()
+    with multiprocessing.Pool(processes=processes) as pool:
+        while played < max_games:
+            active = [name for name in configs
+                      if any(name in pair and decision is None for pair, (decision, _) in pairs.items())]
+            if not active:
+                break
+            round_seeds = seeds[played:played + round_games]
+            tasks = [(name, *configs[name], game_seed) for name in active for game_seed in round_seeds]
+            # map keeps the order of the tasks, so the scores stay in seed order
+            for name, score in pool.map(_play_game_wrapper, tasks):
+                scores[name].append(score)
+            played += len(round_seeds)
+
+            for (first, second), (decision, _) in pairs.items():
+                if decision is not None:
+                    continue
+                differences = np.array(scores[first][:played], dtype=np.float64) - scores[second][:played]
+                decision = test.decide(differences)
+                if decision is not None:
+                    pairs[(first, second)] = (decision, played)
+            decided = sum(decision is not None for decision, _ in pairs.values())
+            print(f"{played} games: {decided}/{len(pairs)} comparisons decided, "
+                  f"{time.time() - start_time:.0f}s elapsed")
+
+    total = sum(len(games) for games in scores.values())
+    summary = {
+        'test': type(test).__name__,
+        'max_games': max_games,
+        'games_played': total,
+        'games_saved': len(configs) * max_games - total,
+        'time': time.time() - start_time,
+        'configs': {name: {'mean_score': float(np.mean(games)), 'games': len(games), 'scores': games}
+                    for name, games in scores.items()},
+        'comparisons': []
+    }
+    for (first, second), (decision, games) in pairs.items():
+        if decision == 1:
+            verdict = f"{first} is better"
+        elif decision == -1:
+            verdict = f"{second} is better"
+        elif decision == 0:
+            verdict = "equivalent"
+        else:
+            verdict = "undecided"
+        summary['comparisons'].append({'first': first, 'second': second, 'verdict': verdict,
+                                       'games': games if games is not None else played})
+    return summary
+
+def print_summary(summary: dict):
+    print(f"\n{summary['test']}: {summary['games_played']} games played, {summary['games_saved']} saved "
+          f"out of {summary['games_played'] + summary['games_saved']} ({summary['time']:.0f}s)")
+    for name, config in summary['configs'].items():
+        print(f"{name}: mean score {config['mean_score']:.0f} over {config['games']} games")
+    for comparison in summary['comparisons']:
+        print(f"{comparison['first']} vs {comparison['second']}: {comparison['verdict']} "
+              f"after {comparison['games']} games")
+
+def save_summary(summary: dict):
+    # In a subdirectory, as graphing.load_results reads every JSON file of
+    # results as sweep results
+    if not os.path.exists('results/comparisons'):
+        os.makedirs('results/comparisons')
+    filename = f"results/comparisons/compare_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(filename, 'w') as f:
+        json.dump(summary, f)
+    print(f"\nSaved comparison to {filename}")
+
+
+if __name__ == '__main__':
+    max_games = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    configs = {
+        'expectimax_depth_2': ('expectimax', {'depth': 2, 'heuristic': heuristics.score_heuristic}),
+        'expectimax_depth_3': ('expectimax', {'depth': 3, 'heuristic': heuristics.score_heuristic}),
+        'greedy_open_cells': ('greedy', {'heuristic': heuristics.open_cells_heuristic}),
+    }
+    summary = compare(configs, SPRT(), max_games=max_games)
+    print_summary(summary)
+    save_summary(summary)
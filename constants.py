@@ -1,5 +1,6 @@
 SIZE = 400
-# GIRD_LEN cannot be changed, this is assumed to be 4
+# GRID_LEN is the default board size. 4x4 games use the 64-bit
+# binary_puzzle.Board, other sizes use grid_board.GridBoard
 GRID_LEN = 4
 GRID_PADDING = 10
 
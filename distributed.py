@@ -0,0 +1,247 @@
+import analysis
+import binary_puzzle as bp
+import collections
+import multiprocessing
+import numpy as np
+import os
+import random
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+# Distributed sweeps. A coordinator holds the tasks of analysis.prepare_tasks
+# and hands them out over TCP to worker processes, which can run on any number
+# of machines. Each worker runs one game at a time with run_game_wrapper and
+# sends the result back.
+#
+# Workers send a heartbeat every few seconds while they play. A task is put
+# back in the queue when its worker disconnects, or when no heartbeat has come
+# for heartbeat_timeout seconds (machine lost, network partition...), and is
+# handed to the next worker asking for one. If the lost worker comes back with
+# a result anyway, the first result received is kept.
+#
+# Connections use multiprocessing.connection, which pickles the messages and
+# authenticates both ends with a shared key, the DISTRIBUTED_AUTHKEY
+# environment variable. Anyone holding the key can run code on the
+# coordinator and the workers (unpickling runs code), so there is no default
+# key: coordinators and workers refuse to start without one. Use a long
+# random key, e.g. from python3 -c "import secrets; print(secrets.token_hex(32))".
+# The coordinator only listens on 127.0.0.1 unless given the host to listen
+# on, e.g. 0.0.0.0 to accept workers from other machines.
+#
+#   coordinator:  python3 distributed.py coordinator [iterations] [port] [host] [--extended]
+#   workers:      python3 distributed.py worker <coordinator host> [port] [processes]
+
+PORT = 2049
+
+def get_authkey(authkey: bytes = None) -> bytes:
+    # The given key, or the DISTRIBUTED_AUTHKEY environment variable
+    if authkey is None:
+        authkey = os.environ.get('DISTRIBUTED_AUTHKEY', '').encode()
+    if not authkey:
+        raise RuntimeError("Set DISTRIBUTED_AUTHKEY to a shared secret key to run distributed sweeps")
+    return authkey
+
+class Coordinator:
+    def __init__(self, tasks: list, host: str = '127.0.0.1', port: int = PORT, authkey: bytes = None,
+                 heartbeat_timeout: float = 30.0):
+        self.tasks = tasks
+        self.heartbeat_timeout = heartbeat_timeout
+        self.listener = Listener((host, port), authkey=get_authkey(authkey))
+        self.address = self.listener.address
+        self.lock = threading.Lock()
+        self.pending = collections.deque(range(len(tasks)))
+        # Task index -> (worker name, time of the last heartbeat)
+        self.running = {}
+        self.results = {}
+        self.done = threading.Event()
+        self.requeued = 0
+        self.start_time = None
+
+    def run(self) -> list:
+        # Serve the tasks until every one has a result, returns the results in
+        # the order of the tasks
+        self.start_time = time.time()
+        print(f"Coordinator listening on {self.address[0]}:{self.address[1]} with {len(self.tasks)} tasks")
+        threading.Thread(target=self._accept, daemon=True).start()
+        threading.Thread(target=self._monitor, daemon=True).start()
+        if not self.tasks:
+            self.done.set()
+        self.done.wait()
+        self.listener.close()
+        elapsed = time.time() - self.start_time
+        print(f"Finished {len(self.tasks)} tasks in {elapsed:.1f}s ({len(self.tasks) / elapsed:.2f} tasks/s), "
+              f"{self.requeued} requeued")
+        return [self.results[i] for i in range(len(self.tasks))]
+
+    def _accept(self):
+        while not self.done.is_set():
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError as error:
+                # A client with the wrong key (or a port scanner), keep
+                # accepting the other workers
+                print(f"Rejected connection: {error}")
+                continue
+            except (OSError, EOFError):
+                # Closed listener, or a client that disconnected during the
+                # handshake
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        worker = None
+        try:
+            while True:
+                message = conn.recv()
+                kind = message[0]
+                if kind == 'ready':
+                    worker = message[1]
+                    conn.send(self._next_task(worker))
+                elif kind == 'heartbeat':
+                    with self.lock:
+                        if message[1] in self.running and self.running[message[1]][0] == worker:
+                            self.running[message[1]] = (worker, time.time())
+                elif kind == 'result':
+                    self._add_result(message[1], message[2], worker)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            # Tasks of a disconnected worker go back to the queue
+            with self.lock:
+                for index, (owner, _) in list(self.running.items()):
+                    if owner == worker:
+                        self._requeue(index, f"worker {worker} disconnected")
+
+    def _next_task(self, worker: str):
+        with self.lock:
+            if self.pending:
+                index = self.pending.popleft()
+                self.running[index] = (worker, time.time())
+                return ('task', index, self.tasks[index])
+            if self.done.is_set():
+                return ('done',)
+            # Tasks still running may be requeued, so ask again later
+            return ('wait', 1.0)
+
+    def _add_result(self, index: int, result, worker: str):
+        with self.lock:
+            self.running.pop(index, None)
+            if index in self.results:
+                return
+            self.results[index] = result
+            if index in self.pending:
+                self.pending.remove(index)
+            count = len(self.results)
+            if count == len(self.tasks):
+                self.done.set()
+        elapsed = time.time() - self.start_time
+        print(f"Task {index} done by {worker}: {count}/{len(self.tasks)} tasks, {count / elapsed:.2f} tasks/s")
+
+    def _requeue(self, index: int, reason: str):
+        # Called with the lock held
+        del self.running[index]
+        if index not in self.results:
+            self.pending.appendleft(index)
+            self.requeued += 1
+            print(f"Requeued task {index}: {reason}")
+
+    def _monitor(self):
+        while not self.done.wait(1.0):
+            now = time.time()
+            with self.lock:
+                for index, (worker, last_heartbeat) in list(self.running.items()):
+                    if now - last_heartbeat > self.heartbeat_timeout:
+                        self._requeue(index, f"no heartbeat from {worker} for {now - last_heartbeat:.0f}s")
+
+
+def run_worker(host: str, port: int = PORT, authkey: bytes = None, heartbeat_every: float = 5.0,
+               name: str = None):
+    # Run tasks from the coordinator until it has no more
+    authkey = get_authkey(authkey)
+    if name is None:
+        name = f"{os.uname().nodename}:{os.getpid()}"
+    if bp.Board.merge_array is None:
+        bp.Board._initialize_merge_array()
+    # Forked workers inherit the random state of their parent, reseed so
+    # they don't all play the same games
+    np.random.seed()
+    random.seed()
+    conn = Client((host, port), authkey=authkey)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    try:
+        while True:
+            send(('ready', name))
+            message = conn.recv()
+            if message[0] == 'done':
+                break
+            if message[0] == 'wait':
+                time.sleep(message[1])
+                continue
+            _, index, task = message
+            # Heartbeats are sent from another thread while the game is played
+            finished = threading.Event()
+            def heartbeat():
+                while not finished.wait(heartbeat_every):
+                    send(('heartbeat', index))
+            thread = threading.Thread(target=heartbeat, daemon=True)
+            thread.start()
+            try:
+                result = analysis.run_game_wrapper(task)
+            finally:
+                finished.set()
+                thread.join()
+            send(('result', index, result))
+    except (EOFError, OSError):
+        # The coordinator is gone
+        pass
+    finally:
+        conn.close()
+
+def start_workers(host: str, port: int = PORT, processes: int = None, authkey: bytes = None) -> list:
+    # Worker processes on this machine
+    authkey = get_authkey(authkey)
+    workers = []
+    for _ in range(processes or os.cpu_count()):
+        worker = multiprocessing.Process(target=run_worker, args=(host, port, authkey))
+        worker.start()
+        workers.append(worker)
+    return workers
+
+def run_distributed_experiments(iterations: int = 10, record_trajectories: bool = False, host: str = '127.0.0.1',
+                                port: int = PORT, local_workers: int = 0, heartbeat_timeout: float = 30.0,
+                                authkey: bytes = None, extended: bool = False):
+    # analysis.run_experiments with the games played by distributed workers.
+    # local_workers starts that many workers on this machine as well. Remote
+    # workers can only connect when host is an address they can reach.
+    authkey = get_authkey(authkey)
+    tasks = analysis.prepare_tasks(iterations, record_trajectories, extended)
+    coordinator = Coordinator(tasks, host, port, authkey, heartbeat_timeout=heartbeat_timeout)
+    workers = start_workers('127.0.0.1', coordinator.address[1], local_workers, authkey) if local_workers else []
+    results = coordinator.run()
+    for worker in workers:
+        worker.join()
+    analysis.save_experiment_results(results, iterations, record_trajectories)
+
+
+if __name__ == '__main__':
+    extended = '--extended' in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != '--extended']
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else PORT
+        processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        for worker in start_workers(sys.argv[2], port, processes):
+            worker.join()
+    else:
+        iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else PORT
+        host = sys.argv[4] if len(sys.argv) > 4 else '127.0.0.1'
+        run_distributed_experiments(iterations, host=host, port=port, extended=extended)
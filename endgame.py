@@ -0,0 +1,151 @@
+import binary_puzzle as bp
+import numpy as np
+import os
+from memory_budget import evict_oldest, max_entries, ENDGAME_ENTRY_BYTES
+
+# Exact solver for near-terminal boards. With few empty cells the game tree is
+# small enough to search exhaustively, so instead of trusting a heuristic the
+# solver computes the probability of surviving the next `horizon` moves with
+# optimal play. Values are memoized per board and number of moves left, under
+# the canonical form of the board: the 8 rotations and reflections of a board
+# have the same value, so only one of them is stored.
+#
+# Values of boards with at most max_empty empty cells can be saved to a .npy
+# table and loaded by later games, where a lookup is a dict access. The memo
+# keeps within a memory budget by evicting its oldest half once it is full.
+
+TABLE_DTYPE = np.dtype([('board', '<u8'), ('moves', 'u1'), ('survival', '<f4')])
+
+def _flip_rows(board: int) -> int:
+    # Reverse the order of the rows
+    return (((board & 0xFFFF) << 48) | (((board >> 16) & 0xFFFF) << 32) |
+            (((board >> 32) & 0xFFFF) << 16) | (board >> 48))
+
+def _mirror_rows(board: int) -> int:
+    # Reverse the tiles of each row
+    return (bp.reverse_rows(board & 0xFFFF) | (bp.reverse_rows((board >> 16) & 0xFFFF) << 16) |
+            (bp.reverse_rows((board >> 32) & 0xFFFF) << 32) | (bp.reverse_rows(board >> 48) << 48))
+
+def canonical(board: int) -> int:
+    # Smallest of the 8 symmetric images of the board
+    best = board
+    for image in (board, bp.transpose(board)):
+        flipped = _flip_rows(image)
+        for candidate in (image, flipped, _mirror_rows(image), _mirror_rows(flipped)):
+            if candidate < best:
+                best = candidate
+    return best
+
+def count_empty(board: int) -> int:
+    return sum(1 for shift in range(0, 64, 4) if (board >> shift) & 0xF == 0)
+
+class EndgameSolver:
+    def __init__(self, max_empty: int = 3, horizon: int = 4, path: str = None, memory_budget: int = None):
+        self.max_empty = max_empty
+        self.horizon = horizon
+        self.path = path
+        # (canonical board, moves left) -> survival probability
+        self.table = {}
+        # Entries of the table that fit in memory_budget bytes (the search
+        # budget of memory_budget.py by default), and number evicted so far
+        self.max_table_entries = max_entries(ENDGAME_ENTRY_BYTES, memory_budget)
+        self.evictions = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def survival(self, board: int, moves: int = None) -> float:
+        # Probability of making `moves` more moves from a board where the player
+        # is to move, playing the moves that maximize it
+        if moves is None:
+            moves = self.horizon
+        if moves == 0:
+            return 1.0
+        key = (canonical(board), moves)
+        value = self.table.get(key)
+        if value is None:
+            value = 0.0
+            for move in bp.MOVES:
+                after = bp.swipe_int(board, move)
+                if after != board:
+                    value = max(value, self.survival_after(after, moves))
+                    if value == 1.0:
+                        break
+            if len(self.table) >= self.max_table_entries:
+                self._evict()
+            self.table[key] = value
+        return value
+
+    def _evict(self):
+        self.evictions += evict_oldest(self.table)
+
+    @property
+    def memory_used(self) -> int:
+        # Approximate bytes used by the table
+        return len(self.table) * ENDGAME_ENTRY_BYTES
+
+    def survival_after(self, board: int, moves: int = None) -> float:
+        # Survival probability from a board waiting for its tile to spawn,
+        # with the move that led to it counted in `moves`
+        if moves is None:
+            moves = self.horizon
+        empty = [shift for shift in range(0, 64, 4) if (board >> shift) & 0xF == 0]
+        if not empty:
+            return 0.0
+        total = 0.0
+        for shift in empty:
+            total += 0.9 * self.survival(board | (1 << shift), moves - 1)
+            total += 0.1 * self.survival(board | (2 << shift), moves - 1)
+        return total / len(empty)
+
+    def save(self, path: str = None):
+        # Only boards with at most max_empty empty cells are worth keeping
+        path = path or self.path
+        entries = [(board, moves, value) for (board, moves), value in self.table.items()
+                   if count_empty(board) <= self.max_empty]
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(path, np.array(entries, dtype=TABLE_DTYPE))
+
+    def load(self, path: str):
+        # Entries past the budget are not loaded
+        entries = np.load(path)[:max(0, self.max_table_entries - len(self.table))]
+        self.table.update(zip(zip(entries['board'].tolist(), entries['moves'].tolist()),
+                              entries['survival'].tolist()))
+
+
+class EndgameOracle:
+    # Leaf oracle for ExpectimaxBoard. On boards with at most max_empty empty
+    # cells, the heuristic value is weighted by the exact survival probability,
+    # with death_value for the games that end within the horizon. Other boards
+    # are left to the heuristic.
+    def __init__(self, solver: EndgameSolver, heuristic: callable, death_value: float = 0):
+        self.solver = solver
+        self.heuristic = heuristic
+        self.death_value = death_value
+
+    @property
+    def memory_used(self) -> int:
+        return self.solver.memory_used
+
+    def __call__(self, board: bp.Board, is_max: bool):
+        value = int(board.board[0])
+        if count_empty(value) > self.solver.max_empty:
+            return None
+        if is_max:
+            survival = self.solver.survival(value)
+        else:
+            survival = self.solver.survival_after(value, self.solver.horizon + 1)
+        return survival * self.heuristic(board) + (1 - survival) * self.death_value
+
+
+if __name__ == '__main__':
+    from expectimax_ai import ExpectimaxBoard
+    from visual import VisualAgent
+    import heuristics
+    solver = EndgameSolver(max_empty=3, horizon=4, path='cache/endgame_3_4.npy')
+    board = bp.Board()
+    oracle = EndgameOracle(solver, heuristics.score_heuristic)
+    expectimax_board = ExpectimaxBoard(board, depth=3, heuristic=heuristics.score_heuristic, leaf_oracle=oracle)
+    visual = VisualAgent(expectimax_board, delay=10)
+    solver.save()
@@ -1,20 +1,173 @@
 import binary_puzzle as bp
 import numpy as np
-from visual import GameVisual
+from visual import VisualAgent
 import time
 import heuristics
+from memory_budget import evict_oldest, max_entries, TABLE_ENTRY_BYTES
+from anytime import MoveUpdate, SearchTimeout
+from agents import Agent, register_agent
 
-class ExpectimaxBoard:
-    def __init__(self, board: bp.Board, depth: int = 3, heuristic: callable = None):
+# Canonical order of the moves, ties between moves are broken in this order
+MOVE_ORDER = {"left": 0, "right": 1, "up": 2, "down": 3}
+
+# Relative slack on pruning decisions so rounding errors never prune a
+# subtree whose value ties with the best one found so far
+PRUNE_EPSILON = 1e-9
+
+class DepthSchedule:
+    # Picks the search depth of each move from the state of the board. The
+    # base depth comes from the number of empty cells: open boards are safe and
+    # have a large branching factor, so they get a shallow search. Two more
+    # plies (one more move) are added when at least distinct_tiles distinct
+    # tiles are on the board and when at most close_to_end moves are valid, as
+    # mistakes are likely to be fatal there; None and 0 turn them off.
+    # Searches ending on the player's moves (odd depths) play much better than
+    # ones ending on the spawns, so the defaults only use odd depths. They were
+    # tuned to the time per move of a fixed depth 3 search.
+    def __init__(self, schedule=((10, 1), (2, 3), (0, 5)), distinct_tiles=None, close_to_end=0, max_depth=7):
+        # schedule is a list of (minimum empty cells, depth), checked in order
+        self.schedule = schedule
+        self.distinct_tiles = distinct_tiles
+        self.close_to_end = close_to_end
+        self.max_depth = max_depth
+
+    def __call__(self, board: bp.Board) -> int:
+        game_board = board.get_2048_board()
+        empty = np.sum(game_board == 0)
+        depth = self.schedule[-1][1]
+        for min_empty, schedule_depth in self.schedule:
+            if empty >= min_empty:
+                depth = schedule_depth
+                break
+        if self.distinct_tiles is not None and len(np.unique(game_board[game_board > 0])) >= self.distinct_tiles:
+            depth += 2
+        if len(board.get_valid_moves()) <= self.close_to_end:
+            depth += 2
+        return min(depth, self.max_depth)
+
+class NodeBudget:
+    # Picks the deepest search expected to stay within a number of nodes per
+    # move. Max nodes branch into the valid moves and chance nodes into a 2 and
+    # a 4 in each empty cell, so a search of depth d visits about
+    # (moves * 2 * empty) ^ (d / 2) nodes. The estimate ignores merges and
+    # game overs, so ExpectimaxBoard also counts the nodes: it deepens from
+    # min_depth up to the estimated depth, stops at the budget and plays the
+    # move of the deepest completed search. It deepens depth_step plies at a
+    # time: with 2, every search ends on the player's moves (odd depths from
+    # min_depth 1), which plays much better than ending on the spawns. The
+    # default budget was tuned to the time per move of a fixed depth 3 search.
+    def __init__(self, budget=800, min_depth=1, max_depth=7, depth_step=2):
+        self.budget = budget
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.depth_step = depth_step
+
+    @property
+    def node_limit(self) -> int:
+        # Nodes per move, read by ExpectimaxBoard from any depth policy
+        return self.budget
+
+    def __call__(self, board: bp.Board) -> int:
+        moves = max(1, len(board.get_valid_moves()))
+        empty = max(1, len(board.get_open_cells()))
+        depth = self.min_depth
+        nodes = moves
+        while depth + self.depth_step <= self.max_depth:
+            for ply in range(depth, depth + self.depth_step):
+                # Depth d + 1 adds a chance ply if d is odd and a max ply if d is even
+                nodes *= 2 * empty if ply % 2 == 1 else moves
+            if nodes > self.budget:
+                break
+            depth += self.depth_step
+        return depth
+
+@register_agent('expectimax')
+class ExpectimaxBoard(Agent):
+    def __init__(self, board: bp.Board, depth: int = 3, heuristic: callable = None,
+                 move_ordering: bool = False, heuristic_bounds: tuple = None, leaf_oracle: callable = None,
+                 depth_policy: callable = None, transposition_table: dict = None, memory_budget: int = None):
         self.board = board
         self.depth = depth
+        # Called with the board before each move to pick the depth of its
+        # search instead of the fixed depth (see DepthSchedule and NodeBudget).
+        # A policy with a node_limit attribute other than None gets iterative
+        # deepening from its min_depth (1 if it has none), depth_step plies at
+        # a time (1 if it has none), within that many nodes per move.
+        self.depth_policy = depth_policy
+        # Depth of the last search
+        self.last_depth = depth
         if heuristic is None:
             self.heuristic = heuristics.score_heuristic
         else:
             self.heuristic = heuristic
+        # Visit the moves of max nodes in order of their heuristic value
+        self.move_ordering = move_ordering
+        # (lower, upper) bounds of the heuristic, or a function of the board
+        # and the remaining depth returning bounds valid for the whole subtree
+        # (see heuristics.open_cells_bounds). When they are known, chance nodes
+        # are pruned once their outcome can no longer affect the move chosen
+        # above them (Star1 pruning)
+        self.heuristic_bounds = heuristic_bounds
+        # Called as leaf_oracle(board, is_max) on leaves before the heuristic.
+        # It returns a value to use instead of the heuristic, or None to fall
+        # back to it (see endgame.EndgameOracle). With heuristic_bounds, its
+        # values must be within the bounds too.
+        self.leaf_oracle = leaf_oracle
+        # Dict of (board, depth, is_max) -> (value, move) of searched nodes,
+        # which can be shared by searches to reuse the subtrees they have in
+        # common (e.g. between consecutive moves of a game). Only exact values
+        # are stored. The values depend on the heuristic, so a table must only
+        # be shared by searches using the same heuristic and leaf oracle.
+        self.transposition_table = transposition_table
+        # Bytes the transposition table may use (the search budget of
+        # memory_budget.py by default). When it is full, the oldest half of
+        # its entries, which come from the earliest searches, are evicted.
+        self.max_table_entries = max_entries(TABLE_ENTRY_BYTES, memory_budget)
+        # Approximate bytes used by the transposition table and the leaf
+        # oracle, and number of entries evicted from the table so far
+        self.memory_used = 0
+        self.evictions = 0
+        # Number of nodes visited and of transposition table hits of the last search
+        self.nodes_expanded = 0
+        self.table_hits = 0
+        # time.time() by which an anytime search must stop, and number of
+        # nodes after which a search must stop (see _policy_node_limit)
+        self.deadline = None
+        self.node_limit = None
+
+    def expectimax(self, board: bp.Board, depth: int, is_max: bool,
+                   alpha: float = float('-inf'), beta: float = float('inf')) -> tuple[float, str]:
+        # The value returned is exact when it lies between alpha and beta.
+        # Otherwise it is only a bound: a value below alpha is an upper bound
+        # and a value above beta is a lower bound of the exact value.
+        if self.transposition_table is None:
+            return self._search(board, depth, is_max, alpha, beta)
+        key = (int(board.board[0]), depth, is_max)
+        entry = self.transposition_table.get(key)
+        if entry is not None:
+            self.table_hits += 1
+            return entry
+        entry = self._search(board, depth, is_max, alpha, beta)
+        if alpha < entry[0] < beta:
+            if len(self.transposition_table) >= self.max_table_entries:
+                self._evict()
+            self.transposition_table[key] = entry
+        return entry
 
-    def expectimax(self, board: bp.Board, depth: int, is_max: bool) -> tuple[float, str]:
+    def _evict(self):
+        self.evictions += evict_oldest(self.transposition_table)
+
+    def _search(self, board: bp.Board, depth: int, is_max: bool, alpha: float, beta: float) -> tuple[float, str]:
+        self.nodes_expanded += 1
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SearchTimeout()
+        if self.node_limit is not None and self.nodes_expanded >= self.node_limit:
+            raise SearchTimeout()
         if depth == 0 or board.is_game_over():
+            if self.leaf_oracle is not None:
+                value = self.leaf_oracle(board, is_max)
+                if value is not None:
+                    return value, None
             return self.heuristic(board), None
 
         if is_max:
@@ -23,29 +176,44 @@ class ExpectimaxBoard:
             if not valid_moves:
                 # This should never happen, but just in case
                 raise ValueError("No valid moves")
-                    
-            max_value = float('-inf')
-            best_move = valid_moves[0]
-            
+
+            children = []
             for move in valid_moves:
                 new_board = board.copy()
                 new_board.swipe(move)
-                value, _ = self.expectimax(new_board, depth - 1, False)
-                if value > max_value:
+                children.append((move, new_board))
+            if self.move_ordering and depth > 1:
+                # Searching the most promising move first gives the tightest
+                # alpha for the remaining moves
+                children.sort(key=lambda child: self.heuristic(child[1]), reverse=True)
+
+            max_value = float('-inf')
+            best_move = children[0][0]
+
+            for move, new_board in children:
+                value, _ = self.expectimax(new_board, depth - 1, False, max(alpha, max_value), beta)
+                # Ties go to the earlier move in MOVE_ORDER, so the move chosen
+                # doesn't depend on the order the moves were searched in
+                if value > max_value or (value == max_value and MOVE_ORDER[move] < MOVE_ORDER[best_move]):
                     max_value = value
                     best_move = move
-            
+                if value > beta:
+                    break
+
             return max_value, best_move
-        
+
         else:
-            # Chance node - get the expected value for all possible tile 
+            # Chance node - get the expected value for all possible tile
             # placements and return the average
             open_cells = board.get_open_cells()
             total_value = 0
             if len(open_cells) == 0:
                 # This should never happen, but just in case
                 raise ValueError("No open cells")
-            
+
+            if self.heuristic_bounds is not None:
+                return self._pruned_chance(board, open_cells, depth, alpha, beta)
+
             # 2 and 4 are the possible values for a new tile
             for cell in open_cells:
                 # 90% chance of getting a 2, 10% chance of getting a 4
@@ -57,62 +225,165 @@ class ExpectimaxBoard:
 
             return total_value / len(open_cells), None
 
+    def _pruned_chance(self, board: bp.Board, open_cells, depth: int, alpha: float, beta: float) -> tuple[float, str]:
+        # Star1 pruning. After each outcome, the unseen outcomes are assumed to
+        # take the lowest or highest heuristic value to bound the value of the
+        # node. If the bounds show the node is below alpha or above beta, the
+        # remaining outcomes can't change the move chosen and are skipped.
+        # All the 2s are searched before the 4s, so that after them only 10% of
+        # the probability is unknown and the bounds are tight.
+        if callable(self.heuristic_bounds):
+            lower, upper = self.heuristic_bounds(board, depth)
+        else:
+            lower, upper = self.heuristic_bounds
+        count = len(open_cells)
+        values = {}
+        expected = 0.0
+        seen = 0.0
+        for tile in [(2, 0.9), (4, 0.1)]:
+            probability = tile[1] / count
+            for i, cell in enumerate(open_cells):
+                remaining = max(0.0, 1.0 - seen - probability)
+                # Window the child must fall in for this node to stay in its own
+                child_alpha = (alpha - expected - upper * remaining) / probability
+                child_beta = (beta - expected - lower * remaining) / probability
+
+                new_board = board.copy()
+                new_board.place_tile(cell, tile[0])
+                value, _ = self.expectimax(new_board, depth - 1, True, child_alpha, child_beta)
+                values[i, tile[0]] = value
+                expected += value * probability
+                seen += probability
+
+                if expected + upper * remaining < alpha - PRUNE_EPSILON * (1 + abs(alpha)):
+                    return expected + upper * remaining, None
+                if expected + lower * remaining > beta + PRUNE_EPSILON * (1 + abs(beta)):
+                    return expected + lower * remaining, None
+
+        # Sum in the same order as the unpruned search so exact values, and so
+        # ties between moves, are identical
+        total_value = 0
+        for i in range(count):
+            for tile in [(2, 0.9), (4, 0.1)]:
+                total_value += values[i, tile[0]] * tile[1]
+        return total_value / count, None
+
+    def effort(self) -> int:
+        return self.nodes_expanded
+
     def get_best_move(self) -> str:
-        _, best_move = self.expectimax(self.board, self.depth, True)
+        self.nodes_expanded = 0
+        self.table_hits = 0
+        depth = self.depth if self.depth_policy is None else self.depth_policy(self.board)
+        budget = self._policy_node_limit()
+        if budget is not None:
+            return self._budgeted_search(depth, budget)
+        self.last_depth = depth
+        _, best_move = self.expectimax(self.board, depth, True)
+        self._update_memory_used()
+        return best_move
+
+    def _policy_node_limit(self):
+        # Nodes per move wanted by the depth policy, None for no limit
+        return getattr(self.depth_policy, 'node_limit', None)
+
+    def _budgeted_search(self, target: int, budget: int) -> str:
+        # Iterative deepening up to target within the node budget, the first
+        # depth is searched in full so there is always a move. A depth is not
+        # started when the growth in nodes of the last step adding the same
+        # plies (max or chance) says it can't end within the budget.
+        nodes = 0
+        depth_nodes = []
+        best_move = None
+        try:
+            min_depth = getattr(self.depth_policy, 'min_depth', 1)
+            step = getattr(self.depth_policy, 'depth_step', 1)
+            # Steps of an even number of plies all add the same plies, odd
+            # ones alternate
+            back = 1 if step % 2 == 0 else 2
+            for depth in range(min(min_depth, target), target + 1, step):
+                if len(depth_nodes) > back:
+                    growth = depth_nodes[-back] / max(1, depth_nodes[-back - 1])
+                    if nodes + depth_nodes[-1] * growth > budget:
+                        break
+                self.nodes_expanded = 0
+                self.node_limit = budget - nodes if best_move is not None else None
+                try:
+                    _, move = self.expectimax(self.board, depth, True)
+                except SearchTimeout:
+                    break
+                finally:
+                    nodes += self.nodes_expanded
+                depth_nodes.append(self.nodes_expanded)
+                best_move = move
+                self.last_depth = depth
+        finally:
+            self.node_limit = None
+            self.nodes_expanded = nodes
+            self._update_memory_used()
         return best_move
-    
-    def take_best_move(self) -> bool:
-        move = self.get_best_move()
-        if move is None:
-            return False
-        # print(f"Taking move {move}")
-        self.board.move(move)
-        return True
-
-    def __str__(self):
-        return str(self.board)
-    
-
-class VisualEB(GameVisual):
-    def __init__(self, expectimax_board: ExpectimaxBoard, delay=1000):
-        super().__init__()
-        self.board = expectimax_board.board
-        self.expectimax_board = expectimax_board
-        self.delay = delay
-        self.update_grid_cells()
-        self.after(self.delay, self.ai_move)
-        self.mainloop()
-
-    def ai_move(self):
-        if self.expectimax_board.take_best_move():
-            self.update_grid_cells()
-            if self.board.is_game_over():
-                self.show_game_over()
-            else:
-                self.after(self.delay, self.ai_move)
+
+    def _update_memory_used(self):
+        self.memory_used = getattr(self.leaf_oracle, 'memory_used', 0)
+        if self.transposition_table is not None:
+            self.memory_used += len(self.transposition_table) * TABLE_ENTRY_BYTES
+
+    def anytime(self, deadline: float = None):
+        # Anytime version of get_best_move (see anytime.py). Iterative
+        # deepening up to the depth get_best_move would search, with an update
+        # after each depth. The search in progress at the deadline is dropped.
+        start_time = time.time()
+        target = self.depth if self.depth_policy is None else self.depth_policy(self.board)
+        valid_moves = self.board.get_valid_moves()
+        if not valid_moves:
+            yield MoveUpdate(None, 1.0, 0, time.time() - start_time)
+            return
+        yield MoveUpdate(valid_moves[0], 0.0, 0, time.time() - start_time)
+        nodes = 0
+        self.deadline = deadline
+        budget = self._policy_node_limit()
+        try:
+            for depth in range(1, target + 1):
+                self.nodes_expanded = 0
+                self.table_hits = 0
+                if budget is not None and depth > 1:
+                    self.node_limit = budget - nodes
+                try:
+                    _, best_move = self.expectimax(self.board, depth, True)
+                except SearchTimeout:
+                    return
+                finally:
+                    nodes += self.nodes_expanded
+                    self._update_memory_used()
+                self.last_depth = depth
+                yield MoveUpdate(best_move, depth / target, nodes, time.time() - start_time)
+        finally:
+            self.deadline = None
+            self.node_limit = None
+
 
 if __name__ == '__main__':
     # Test with score heuristic
     board = bp.Board()
     expectimax_board = ExpectimaxBoard(board, depth=5, heuristic=heuristics.score_heuristic)
-    visual = VisualEB(expectimax_board, delay=10)
+    visual = VisualAgent(expectimax_board, delay=10)
 
     # Test with open cells heuristic
     board = bp.Board()
     expectimax_board = ExpectimaxBoard(board, depth=3, heuristic=heuristics.open_cells_heuristic)
-    visual = VisualEB(expectimax_board, delay=10)
+    visual = VisualAgent(expectimax_board, delay=10)
 
     # Test with max tile heuristic
     board = bp.Board()
     expectimax_board = ExpectimaxBoard(board, depth=3, heuristic=heuristics.max_tile_heuristic)
-    visual = VisualEB(expectimax_board, delay=10)
+    visual = VisualAgent(expectimax_board, delay=10)
 
     # Test with tile sum heuristic
     board = bp.Board()
     expectimax_board = ExpectimaxBoard(board, depth=3, heuristic=heuristics.tile_sum_heuristic)
-    visual = VisualEB(expectimax_board, delay=10)
+    visual = VisualAgent(expectimax_board, delay=10)
 
     # Test with tile sum game over heuristic
     board = bp.Board()
     expectimax_board = ExpectimaxBoard(board, depth=3, heuristic=heuristics.tile_sum_and_gamover_heuristic)
-    visual = VisualEB(expectimax_board, delay=10)
+    visual = VisualAgent(expectimax_board, delay=10)
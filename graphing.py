@@ -4,58 +4,91 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 
-def load_results():
-    # Load all JSON result files from the 'results' directory
-    results = {}
-    for filename in os.listdir('results'):
+KEY_TILES = [512, 1024, 2048, 4096]
+
+def load_results(directory='results'):
+    # Load all JSON result files into one table with a row per game
+    frames = []
+    for filename in sorted(os.listdir(directory)):
         if filename.endswith('.json'):
             algorithm = filename.split('_')[0]
-            filepath = os.path.join('results', filename)
-            with open(filepath, 'r') as f:
+            run = os.path.splitext(filename)[0][len(algorithm) + 1:]
+            with open(os.path.join(directory, filename), 'r') as f:
                 data = json.load(f)
-                results[algorithm] = data
+            for variant, games in data.items():
+                if not games:
+                    continue
+                frame = pd.DataFrame.from_records(games, columns=['score', 'moves', 'time'])
+                # Max tile of every game at once from the stacked final boards
+                frame['max_tile'] = np.array([game['board'] for game in games]).reshape(len(games), -1).max(axis=1)
+                if 'trajectory' in games[0]:
+                    frame['trajectory'] = [game['trajectory'] for game in games]
+                frame['algorithm'] = algorithm
+                frame['variant'] = variant
+                frame['run'] = run
+                frame['game'] = np.arange(len(games))
+                frames.append(frame)
+    results = pd.concat(frames, ignore_index=True)
+    # Categories keep the variants in the order they were run
+    for column in ['algorithm', 'variant']:
+        results[column] = pd.Categorical(results[column], categories=results[column].unique())
     return results
 
+def bootstrap_ci(results, column='score', confidence=0.95, resamples=2000, seed=0):
+    # Bootstrap confidence interval of the mean of a column for each variant.
+    # All the resamples of a variant are drawn as one matrix of indices.
+    rng = np.random.default_rng(seed)
+    rows = []
+    for (algorithm, variant), values in results.groupby(['algorithm', 'variant'], observed=True, sort=False)[column]:
+        values = values.to_numpy(dtype=np.float64)
+        means = values[rng.integers(0, len(values), size=(resamples, len(values)))].mean(axis=1)
+        low, high = np.quantile(means, [(1 - confidence) / 2, (1 + confidence) / 2])
+        rows.append((algorithm, variant, low, high))
+    return pd.DataFrame(rows, columns=['algorithm', 'variant', f'{column}_ci_low', f'{column}_ci_high'])
+
 def compute_statistics(results):
-    stats = {}
-    for algorithm, variants in results.items():
-        stats[algorithm] = {}
-        for variant, games in variants.items():
-            scores = [game['score'] for game in games]
-            moves = [game['moves'] for game in games]
-            times = [game['time'] for game in games]
-            max_tiles = [np.max(game['board']) for game in games]
-            stats[algorithm][variant] = {
-                'scores': scores,
-                'moves': moves,
-                'times': times,
-                'max_tiles': max_tiles,
-                'avg_score': np.mean(scores),
-                'median_score': np.median(scores),
-                'max_score': np.max(scores),
-                'avg_moves': np.mean(moves),
-                'avg_time_per_move': np.mean(times) / np.mean(moves),
-                'avg_time_per_game': np.mean(times),
-                'tile_counts': {}
-            }
-            for tile in [512, 1024, 2048, 4096]:
-                count = sum(1 for mt in max_tiles if mt >= tile)
-                stats[algorithm][variant]['tile_counts'][tile] = count / len(games)
+    # One row of statistics per algorithm variant
+    grouped = results.groupby(['algorithm', 'variant'], observed=True, sort=False)
+    stats = grouped.agg(
+        games=('score', 'size'),
+        avg_score=('score', 'mean'),
+        median_score=('score', 'median'),
+        max_score=('score', 'max'),
+        avg_moves=('moves', 'mean'),
+        avg_time_per_game=('time', 'mean'),
+    )
+    stats['avg_time_per_move'] = stats['avg_time_per_game'] / stats['avg_moves']
+    # Rate of games reaching each key tile
+    for tile in KEY_TILES:
+        stats[f'tile_{tile}'] = (results['max_tile'] >= tile).groupby(
+            [results['algorithm'], results['variant']], observed=True, sort=False).mean()
+    stats = stats.join(bootstrap_ci(results).set_index(['algorithm', 'variant']))
     return stats
 
+def survival_curves(results):
+    # Fraction of each variant's games still running after each move number
+    longest = int(results['moves'].max())
+    curves = {}
+    for key, moves in results.groupby(['algorithm', 'variant'], observed=True, sort=False)['moves']:
+        ended = np.bincount(moves.to_numpy(), minlength=longest + 1)
+        curves[key] = 1 - np.cumsum(ended) / len(moves)
+    return curves
+
+def _labels(stats):
+    return [f"{algorithm}_{variant}" for algorithm, variant in stats.index]
+
 def plot_scores(stats):
     # Plot average and median scores for each algorithm variant
-    for algorithm, variants in stats.items():
-        variants_list = list(variants.keys())
-        avg_scores = [variants[variant]['avg_score'] for variant in variants_list]
-        median_scores = [variants[variant]['median_score'] for variant in variants_list]
-
+    for algorithm, variants in stats.groupby(level='algorithm', observed=True, sort=False):
+        variants_list = variants.index.get_level_values('variant')
         x = np.arange(len(variants_list))
         width = 0.35
+        # Error bars show the bootstrap confidence interval of the average
+        errors = [variants['avg_score'] - variants['score_ci_low'], variants['score_ci_high'] - variants['avg_score']]
 
         plt.figure(figsize=(10, 6))
-        plt.bar(x - width/2, avg_scores, width, label='Average Score')
-        plt.bar(x + width/2, median_scores, width, label='Median Score')
+        plt.bar(x - width/2, variants['avg_score'], width, yerr=errors, capsize=3, label='Average Score')
+        plt.bar(x + width/2, variants['median_score'], width, label='Median Score')
 
         plt.ylabel('Scores')
         plt.title(f'Scores by Variant for {algorithm.capitalize()}')
@@ -67,16 +100,14 @@ def plot_scores(stats):
 
 def plot_max_tiles(stats):
     # Plot achievement rates of key tiles for each algorithm variant
-    key_tiles = [512, 1024, 2048, 4096]
-    for algorithm, variants in stats.items():
-        variants_list = list(variants.keys())
+    for algorithm, variants in stats.groupby(level='algorithm', observed=True, sort=False):
+        variants_list = variants.index.get_level_values('variant')
         x = np.arange(len(variants_list))
         width = 0.2
 
         plt.figure(figsize=(10, 6))
-        for i, tile in enumerate(key_tiles):
-            achievement_rates = [variants[variant]['tile_counts'][tile]*100 for variant in variants_list]
-            plt.bar(x + (i - 1.5)*width, achievement_rates, width, label=f'Tile {tile}')
+        for i, tile in enumerate(KEY_TILES):
+            plt.bar(x + (i - 1.5)*width, variants[f'tile_{tile}'] * 100, width, label=f'Tile {tile}')
 
         plt.ylabel('Achievement Rate (%)')
         plt.title(f'Key Tile Achievement Rates for {algorithm.capitalize()}')
@@ -88,14 +119,12 @@ def plot_max_tiles(stats):
 
 def plot_time_per_move(stats):
     # Plot average time per move for each algorithm variant
-    for algorithm, variants in stats.items():
-        variants_list = list(variants.keys())
-        times_per_move = [variants[variant]['avg_time_per_move'] for variant in variants_list]
-
+    for algorithm, variants in stats.groupby(level='algorithm', observed=True, sort=False):
+        variants_list = variants.index.get_level_values('variant')
         x = np.arange(len(variants_list))
 
         plt.figure(figsize=(10, 6))
-        plt.bar(x, times_per_move)
+        plt.bar(x, variants['avg_time_per_move'])
         plt.ylabel('Time per Move (s)')
         plt.title(f'Average Time per Move for {algorithm.capitalize()}')
         plt.xticks(x, variants_list, rotation=45, ha='right')
@@ -105,14 +134,12 @@ def plot_time_per_move(stats):
 
 def plot_time_per_game(stats):
     # Plot average time per game for each algorithm variant
-    for algorithm, variants in stats.items():
-        variants_list = list(variants.keys())
-        times_per_game = [variants[variant]['avg_time_per_game'] for variant in variants_list]
-
+    for algorithm, variants in stats.groupby(level='algorithm', observed=True, sort=False):
+        variants_list = variants.index.get_level_values('variant')
         x = np.arange(len(variants_list))
 
         plt.figure(figsize=(10, 6))
-        plt.bar(x, times_per_game)
+        plt.bar(x, variants['avg_time_per_game'])
         plt.ylabel('Time per Game (s)')
         plt.title(f'Average Time per Game for {algorithm.capitalize()}')
         plt.xticks(x, variants_list, rotation=45, ha='right')
@@ -120,39 +147,54 @@ def plot_time_per_game(stats):
         plt.savefig(f'figures/{algorithm}_time_per_game.png')
         plt.close()
 
+def plot_score_distributions(results):
+    # Box plots of the scores of each algorithm variant
+    for algorithm, games in results.groupby('algorithm', observed=True, sort=False):
+        groups = games.groupby('variant', observed=True, sort=False)['score']
+        plt.figure(figsize=(10, 6))
+        plt.boxplot([scores.to_numpy() for _, scores in groups], showmeans=True)
+        plt.ylabel('Score')
+        plt.title(f'Score Distribution by Variant for {algorithm.capitalize()}')
+        plt.xticks(np.arange(1, groups.ngroups + 1), list(groups.groups), rotation=45, ha='right')
+        plt.tight_layout()
+        plt.savefig(f'figures/{algorithm}_score_distribution.png')
+        plt.close()
+
+def plot_survival(results):
+    # Fraction of games still running against the number of moves played
+    curves = survival_curves(results)
+    for algorithm in results['algorithm'].cat.categories:
+        plt.figure(figsize=(10, 6))
+        for (curve_algorithm, variant), curve in curves.items():
+            if curve_algorithm == algorithm:
+                plt.step(np.arange(len(curve)), curve, where='post', label=variant)
+        plt.xlabel('Move')
+        plt.ylabel('Games Still Running')
+        plt.title(f'Survival by Move for {algorithm.capitalize()}')
+        plt.legend()
+        plt.tight_layout()
+        plt.savefig(f'figures/{algorithm}_survival.png')
+        plt.close()
+
 def create_tile_achievement_table(stats):
     # Create tables showing the rate of achieving key tile values
-    key_tiles = [512, 1024, 2048, 4096]
-    for algorithm, variants in stats.items():
-        data = []
-        index = []
-        for variant, info in variants.items():
-            row = [info['tile_counts'][tile]*100 for tile in key_tiles]
-            data.append(row)
-            index.append(variant)
-        df = pd.DataFrame(data, columns=[f'Tile {tile}' for tile in key_tiles], index=index)
+    for algorithm, variants in stats.groupby(level='algorithm', observed=True, sort=False):
+        df = variants[[f'tile_{tile}' for tile in KEY_TILES]] * 100
+        df.columns = [f'Tile {tile}' for tile in KEY_TILES]
+        df.index = variants.index.get_level_values('variant').astype(str)
         df.index.name = 'Variant'
         df.to_csv(f'figures/{algorithm}_tile_achievement_rates.csv')
 
 def plot_combined_scores(stats):
     # Plot average scores for all algorithm variants in one graph
-    variants_list = []
-    avg_scores = []
-    median_scores = []
-    for algorithm, variants in stats.items():
-        for variant, data in variants.items():
-            variants_list.append(f"{algorithm}_{variant}")
-            avg_scores.append(data['avg_score'])
-            median_scores.append(data['median_score'])
-    
     width = 0.35
-    x = np.arange(len(variants_list))
+    x = np.arange(len(stats))
     plt.figure(figsize=(12, 6))
-    plt.bar(x - width/2, avg_scores, width, label='Average Score', color='skyblue')
-    plt.bar(x + width/2, median_scores, width, label='Median Score', color='lightgreen')
+    plt.bar(x - width/2, stats['avg_score'], width, label='Average Score', color='skyblue')
+    plt.bar(x + width/2, stats['median_score'], width, label='Median Score', color='lightgreen')
     plt.ylabel('Scores')
     plt.title('Average and Median Scores Across All Algorithm Variants')
-    plt.xticks(x, variants_list, rotation=90)
+    plt.xticks(x, _labels(stats), rotation=90)
     plt.legend()
     plt.tight_layout()
     plt.savefig('figures/combined_avg_median_scores.png')
@@ -160,23 +202,14 @@ def plot_combined_scores(stats):
 
 def plot_combined_max_tiles(stats):
     # Plot key tile achievement rates for all algorithm variants in one graph
-    key_tiles = [512, 1024, 2048, 4096]
-    variants_list = []
-    tile_rates = {tile: [] for tile in key_tiles}
-    for algorithm, variants in stats.items():
-        for variant, data in variants.items():
-            variants_list.append(f"{algorithm}_{variant}")
-            for tile in key_tiles:
-                tile_rates[tile].append(data['tile_counts'][tile] * 100)
-    
-    x = np.arange(len(variants_list))
+    x = np.arange(len(stats))
     width = 0.2
     plt.figure(figsize=(12, 6))
-    for i, tile in enumerate(key_tiles):
-        plt.bar(x + (i - 1.5)*width, tile_rates[tile], width, label=f'Tile {tile}')
+    for i, tile in enumerate(KEY_TILES):
+        plt.bar(x + (i - 1.5)*width, stats[f'tile_{tile}'] * 100, width, label=f'Tile {tile}')
     plt.ylabel('Achievement Rate (%)')
     plt.title('Key Tile Achievement Rates Across All Algorithm Variants')
-    plt.xticks(x, variants_list, rotation=90)
+    plt.xticks(x, _labels(stats), rotation=90)
     plt.legend()
     plt.tight_layout()
     plt.savefig('figures/combined_tile_achievements.png')
@@ -184,38 +217,24 @@ def plot_combined_max_tiles(stats):
 
 def plot_combined_time_per_move(stats):
     # Plot average time per move for all algorithm variants in one graph
-    variants_list = []
-    times_per_move = []
-    for algorithm, variants in stats.items():
-        for variant, data in variants.items():
-            variants_list.append(f"{algorithm}_{variant}")
-            times_per_move.append(data['avg_time_per_move'])
-    
-    x = np.arange(len(variants_list))
+    x = np.arange(len(stats))
     plt.figure(figsize=(12, 6))
-    plt.bar(x, times_per_move, color='orange')
+    plt.bar(x, stats['avg_time_per_move'], color='orange')
     plt.ylabel('Time per Move (s)')
     plt.title('Average Time per Move Across All Algorithm Variants')
-    plt.xticks(x, variants_list, rotation=90)
+    plt.xticks(x, _labels(stats), rotation=90)
     plt.tight_layout()
     plt.savefig('figures/combined_time_per_move.png')
     plt.close()
 
 def plot_combined_time_per_game(stats):
     # Plot average time per game for all algorithm variants in one graph
-    variants_list = []
-    times_per_game = []
-    for algorithm, variants in stats.items():
-        for variant, data in variants.items():
-            variants_list.append(f"{algorithm}_{variant}")
-            times_per_game.append(data['avg_time_per_game'])
-    
-    x = np.arange(len(variants_list))
+    x = np.arange(len(stats))
     plt.figure(figsize=(12, 6))
-    plt.bar(x, times_per_game, color='green')
+    plt.bar(x, stats['avg_time_per_game'], color='green')
     plt.ylabel('Time per Game (s)')
     plt.title('Average Time per Game Across All Algorithm Variants')
-    plt.xticks(x, variants_list, rotation=90)
+    plt.xticks(x, _labels(stats), rotation=90)
     plt.tight_layout()
     plt.savefig('figures/combined_time_per_game.png')
     plt.close()
@@ -229,6 +248,8 @@ def main():
     plot_max_tiles(stats)
     plot_time_per_move(stats)
     plot_time_per_game(stats)
+    plot_score_distributions(results)
+    plot_survival(results)
     create_tile_achievement_table(stats)
     plot_combined_scores(stats)
     plot_combined_max_tiles(stats)
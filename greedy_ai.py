@@ -1,11 +1,15 @@
 import binary_puzzle as bp
 import numpy as np
-from visual import GameVisual
+from visual import VisualAgent
 import time
 import heuristics
+from anytime import MoveUpdate
+from agents import Agent, register_agent
+from batched_greedy import greedy_moves
 
-class GreedyBoard():
-    def __init__(self, board: bp.Board, heuristic: callable):
+@register_agent('greedy')
+class GreedyBoard(Agent):
+    def __init__(self, board: bp.Board, heuristic: callable = None):
         self.board = board
         if heuristic is None:
             self.heuristic = heuristics.score_heuristic
@@ -25,43 +29,43 @@ class GreedyBoard():
                 best_move = move
 
         return best_move
-    
-    def take_best_move(self) -> bool:
-        move = self.get_best_move()
-        if move is None:
-            return False
-        # print(f"Taking move {move}")
-        self.board.move(move)
-        return True
 
-    def __str__(self):
-        return str(self.board)
-    
+    def choose_moves(self, boards: np.ndarray) -> np.ndarray:
+        # The successors of all the boards are scored in one vectorized
+        # heuristic call
+        boards = np.asarray(boards, dtype=np.uint64).reshape(-1)
+        moves, _ = greedy_moves(boards, heuristics.as_array_heuristic(self.heuristic))
+        return moves
 
-class VisualGB(GameVisual):
-    def __init__(self, greedy_board: GreedyBoard, delay=1000):
-        super().__init__()
-        self.board = greedy_board.board
-        self.greedy_board = greedy_board
-        self.delay = delay
-        self.update_grid_cells()
-        self.after(self.delay, self.ai_move)
-        self.mainloop()
+    def anytime(self, deadline: float = None):
+        # Anytime version of get_best_move (see anytime.py), with an update
+        # after each move is scored
+        start_time = time.time()
+        valid_moves = self.board.get_valid_moves()
+        if not valid_moves:
+            yield MoveUpdate(None, 1.0, 0, time.time() - start_time)
+            return
+        yield MoveUpdate(valid_moves[0], 0.0, 0, time.time() - start_time)
+        best_move = None
+        best_h = None
+        for i, move in enumerate(valid_moves):
+            new_board = self.board.copy()
+            new_board.swipe(move)
+            h = self.heuristic(new_board)
+            if best_h is None or h > best_h:
+                best_h = h
+                best_move = move
+            yield MoveUpdate(best_move, (i + 1) / len(valid_moves), i + 1, time.time() - start_time)
+            if deadline is not None and time.time() >= deadline:
+                return
 
-    def ai_move(self):
-        if self.greedy_board.take_best_move():
-            self.update_grid_cells()
-            if self.board.is_game_over():
-                self.show_game_over()
-            else:
-                self.after(self.delay, self.ai_move)
 
 if __name__ == '__main__':
     board = bp.Board()
     greedy_board = GreedyBoard(board, heuristics.score_heuristic)
-    visual = VisualGB(greedy_board, delay=100)
+    visual = VisualAgent(greedy_board, delay=100)
 
     board = bp.Board()
     greedy_board = GreedyBoard(board, heuristics.open_cells_heuristic)
-    visual = VisualGB(greedy_board, delay=100)
+    visual = VisualAgent(greedy_board, delay=100)
 
@@ -0,0 +1,231 @@
+import numpy as np
+import constants as c
+import binary_puzzle as bp
+import table_cache
+
+# Board engine for any N x N grid. The 4x4 game keeps using the 64-bit
+# binary_puzzle.Board, other sizes use GridBoard which has the same interface,
+# so the AIs and heuristics work on both.
+#
+# A GridBoard stores one integer per row, with a 5-bit tile exponent per cell
+# and the leftmost cell in the highest bits, so tiles go up to 2^31 instead of
+# the 2^15 of Board (larger grids reach 2^16 and beyond). Swipes look the rows
+# up in a merge table covering the 16^N rows whose tiles are all at most 2^15,
+# 32^N entries would be too many. Rows holding a larger tile are rare and are
+# merged directly. Tables are built the first time a size is used and cached
+# on disk (see table_cache.py), so later processes memory map them instead of
+# building them.
+
+# Bits of a cell and largest tile exponent they hold
+CELL_BITS = 5
+CELL_MASK = (1 << CELL_BITS) - 1
+
+# Rows merged per step when building a table, to bound the memory used
+CHUNK_SIZE = 1 << 20
+
+def _row_dtype(size):
+    return np.uint32 if CELL_BITS * size <= 32 else np.uint64
+
+def _merge_tiles(tiles):
+    # Swipes rows of tile exponents (one row per line of the array) to the
+    # left, see Board._compute_merge for how the tiles are shifted and merged
+
+    # Shift non-zero tiles to the left
+    indices = np.argsort(tiles == 0, axis=1, kind='stable')
+    tiles = np.take_along_axis(tiles, indices, axis=1)
+
+    # Merge tiles by incrementing duplicates
+    for i in range(tiles.shape[1] - 1):
+        merge_mask = (tiles[:, i] == tiles[:, i + 1]) & (tiles[:, i] != 0)
+        tiles[merge_mask, i] += 1
+        tiles[merge_mask, i + 1] = 0
+    if np.any(tiles > CELL_MASK):
+        raise OverflowError(f"Tile above 2^{CELL_MASK} doesn't fit in a {CELL_BITS}-bit cell")
+
+    # Shift non-zero tiles to the left again
+    indices = np.argsort(tiles == 0, axis=1, kind='stable')
+    return np.take_along_axis(tiles, indices, axis=1)
+
+def _compute_grid_merge(rows, size):
+    # Merged rows in CELL_BITS cells, for rows given by their index in the
+    # merge table, with 4-bit cells
+    tiles = np.stack([(rows >> (4 * (size - 1 - i))) & 0xF for i in range(size)], axis=1)
+    tiles = _merge_tiles(tiles.astype(np.int64))
+    merged = np.zeros(len(rows), dtype=_row_dtype(size))
+    for i in range(size):
+        merged |= tiles[:, i].astype(merged.dtype) << merged.dtype.type(CELL_BITS * (size - 1 - i))
+    return merged
+
+def _build_merge_table(size):
+    table = np.empty(16 ** size, dtype=_row_dtype(size))
+    for start in range(0, len(table), CHUNK_SIZE):
+        rows = np.arange(start, min(start + CHUNK_SIZE, len(table)), dtype=np.uint64)
+        table[start:start + len(rows)] = _compute_grid_merge(rows, size)
+    return table
+
+def _row_layout(size):
+    # Integer type of the rows, bit offset of each cell in a row from the
+    # leftmost to the rightmost, bit offset of the same cell in the row's index
+    # in the merge table
+    dtype = _row_dtype(size)
+    shifts = np.arange(CELL_BITS * (size - 1), -1, -CELL_BITS, dtype=dtype)
+    table_shifts = np.arange(4 * (size - 1), -1, -4, dtype=dtype)
+    return dtype, shifts, table_shifts
+
+def load_merge_table(size):
+    # Merge table for rows of the given size, built once and cached on disk
+    return table_cache.load_table(f'grid_merge_{size}', lambda: _build_merge_table(size))
+
+
+class GridBoard:
+    merge_tables = {}  # Class variable to store the merge table of each size
+    layouts = {}  # Row layout of each size, see _row_layout
+
+    def __init__(self, size: int = c.GRID_LEN, rows=None, num_moves: int = 0):
+        self.size = size
+        if size not in GridBoard.merge_tables:
+            GridBoard.merge_tables[size] = load_merge_table(size)
+            GridBoard.layouts[size] = _row_layout(size)
+        self.dtype, self.shifts, self.table_shifts = GridBoard.layouts[size]
+        if rows is None:
+            self.rows = np.zeros(size, dtype=self.dtype)
+            self._spawn_initial_tiles()
+        else:
+            self.rows = np.array(rows, dtype=self.dtype)
+        self.total_moves = num_moves
+
+    def __str__(self):
+        return str(self.get_2048_board())
+
+    def get_exponent_board(self):
+        # N x N array of tile exponents
+        return (self.rows[:, None] >> self.shifts) & self.dtype(CELL_MASK)
+
+    def _set_exponent_board(self, tiles):
+        self.rows = np.bitwise_or.reduce(tiles.astype(self.dtype) << self.shifts, axis=1)
+
+    def _merge(self, tiles):
+        # Rows swiped left, from an array of rows of tile exponents
+        if tiles.max() <= 0xF:
+            # Every tile is at most 2^15, the rows are in the table
+            return GridBoard.merge_tables[self.size][np.bitwise_or.reduce(tiles << self.table_shifts, axis=1)]
+        # Rows with a larger tile are merged directly
+        merged = _merge_tiles(tiles.astype(np.int64)).astype(self.dtype)
+        return np.bitwise_or.reduce(merged << self.shifts, axis=1)
+
+    def _reverse(self, rows):
+        # Reverse the order of the cells of each row
+        tiles = (rows[:, None] >> self.shifts) & self.dtype(CELL_MASK)
+        return np.bitwise_or.reduce(tiles[:, ::-1] << self.shifts, axis=1)
+
+    def swipe_left(self):
+        self.rows = self._merge(self.get_exponent_board())
+
+    def swipe_right(self):
+        self.rows = self._reverse(self._merge(self.get_exponent_board()[:, ::-1]))
+
+    def swipe_up(self):
+        # Columns become rows with the top cell on the left
+        self.rows = self._merge(self.get_exponent_board().T)
+        self._set_exponent_board(self.get_exponent_board().T)
+
+    def swipe_down(self):
+        self.rows = self._reverse(self._merge(self.get_exponent_board().T[:, ::-1]))
+        self._set_exponent_board(self.get_exponent_board().T)
+
+    def swipe(self, direction):
+        # Move the board in a direction
+        if direction == "left":
+            self.swipe_left()
+        elif direction == "right":
+            self.swipe_right()
+        elif direction == "up":
+            self.swipe_up()
+        elif direction == "down":
+            self.swipe_down()
+
+    def move(self, direction):
+        # Move the board in a direction
+        self.swipe(direction)
+        self.spawn_random_tile()
+        self.total_moves += 1
+
+    def get_2048_board(self):
+        tiles = self.get_exponent_board().astype(np.uint64)
+        return np.where(tiles > 0, np.uint64(1) << tiles, np.uint64(0))
+
+    def _spawn_initial_tiles(self):
+        self.spawn_random_tile()
+        self.spawn_random_tile()
+
+    def spawn_random_tile(self):
+        # Insert a 2 with a 90% probability or a 4 with a 10% probability
+        # into a random empty cell
+        tiles = self.get_exponent_board()
+        empty = np.argwhere(tiles == 0)
+        if len(empty) > 0:
+            row, col = empty[np.random.randint(len(empty))]
+            tiles[row, col] = 1 if np.random.random() < 0.9 else 2
+            self._set_exponent_board(tiles)
+
+    def _can_swipe(self, direction):
+        test_board = self.copy()
+        test_board.swipe(direction)
+        return not np.array_equal(test_board.rows, self.rows)
+
+    def can_swipe_left(self):
+        return self._can_swipe("left")
+
+    def can_swipe_right(self):
+        return self._can_swipe("right")
+
+    def can_swipe_up(self):
+        return self._can_swipe("up")
+
+    def can_swipe_down(self):
+        return self._can_swipe("down")
+
+    def get_valid_moves(self):
+        return [move for move in bp.MOVES if self._can_swipe(move)]
+
+    def is_game_over(self):
+        return not any(self._can_swipe(move) for move in bp.MOVES)
+
+    def copy(self):
+        return GridBoard(self.size, self.rows.copy(), self.total_moves)
+
+    def score(self):
+        # Same scoring as Board.score
+        score = 0
+        game_board = self.get_2048_board()
+        while np.any(game_board):
+            score += np.sum(game_board)
+            game_board = game_board // 2
+            game_board[game_board == 2] = 0
+        return score
+
+    def get_open_cells(self):
+        return np.argwhere(self.get_exponent_board() == 0)
+
+    def place_tile(self, cell, value):
+        # Cell is a tuple of the row and column, value is the tile value
+        tiles = self.get_exponent_board()
+        tiles[cell[0], cell[1]] = int(np.log2(value))
+        self._set_exponent_board(tiles)
+
+
+def make_board(size: int = c.GRID_LEN):
+    # New game of the given size, using the 64-bit engine for 4x4
+    if size == 4:
+        return bp.Board()
+    return GridBoard(size)
+
+
+if __name__ == '__main__':
+    from expectimax_ai import ExpectimaxBoard
+    from visual import VisualAgent
+    import heuristics
+    for size in (3, 5, 6):
+        board = make_board(size)
+        expectimax_board = ExpectimaxBoard(board, depth=2, heuristic=heuristics.open_cells_heuristic)
+        visual = VisualAgent(expectimax_board, delay=10)
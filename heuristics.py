@@ -1,5 +1,6 @@
 import numpy as np
 import binary_puzzle as bp
+import table_cache
 
 def score_heuristic(board: bp.Board) -> int:
     # Sum all of the values in the board
@@ -20,6 +21,25 @@ def tile_sum_heuristic(board: bp.Board) -> int:
     # This heuristic will return the weighted sum of all the tile values
     return np.sum(board.get_2048_board() ** 1.01)
 
+"""
+Bounds of the heuristics over every board reachable within a number of plies
+(spawns and moves alternating, starting with a spawn). ExpectimaxBoard uses
+them to prune chance nodes.
+"""
+def open_cells_bounds(board: bp.Board, plies: int) -> tuple:
+    # Moves never fill cells and merge at most 8 tiles, each spawn fills one cell
+    spawns = (plies + 1) // 2
+    moves = plies // 2
+    empty = open_cells_heuristic(board)
+    return max(0, empty - spawns), min(16, empty + 8 * moves)
+
+def max_tile_bounds(board: bp.Board, plies: int) -> tuple:
+    # The max tile never shrinks and doubles at most once per move, and a
+    # spawned tile is at most a 4
+    moves = plies // 2
+    max_tile = max_tile_heuristic(board)
+    return max_tile, max(max_tile, 2) + moves
+
 """
 The following heuristics will return the heuristic value if the game is not 
 over and 0 if the game is over
@@ -53,3 +73,195 @@ def tile_sum_and_gamover_heuristic(board: bp.Board) -> int:
     return tile_sum_heuristic(board)
 
 
+
+"""
+Composite heuristic: a weighted sum of board features. Each feature is built
+from tables precomputed over all 65536 possible 16-bit rows, so a board is
+evaluated with a few table lookups on its rows and columns.
+"""
+FEATURES = ('empty', 'monotonicity', 'smoothness', 'merges', 'corner', 'max_tile')
+
+DEFAULT_WEIGHTS = {
+    'empty': 2.7,
+    'monotonicity': 1.0,
+    'smoothness': 0.1,
+    'merges': 0.7,
+    'corner': 1.0,
+    'max_tile': 1.0,
+}
+
+def _compute_row_tables():
+    # Tile exponents of every row, from the leftmost to the rightmost tile
+    rows = np.arange(0, 0xffff + 1, 1, dtype=np.int64)
+    tiles = np.stack([(rows >> 12) & 0xF, (rows >> 8) & 0xF, (rows >> 4) & 0xF, rows & 0xF], axis=1)
+
+    empty = np.sum(tiles == 0, axis=1)
+
+    # Monotonicity is the smaller of the increases seen when walking the row
+    # left to right and right to left, negated so a monotonic row scores 0
+    steps = tiles[:, 1:] - tiles[:, :-1]
+    increasing = np.sum(np.maximum(steps, 0), axis=1)
+    decreasing = np.sum(np.maximum(-steps, 0), axis=1)
+    monotonicity = -np.minimum(increasing, decreasing)
+
+    # Smoothness and merges only look at neighbours once empty cells are
+    # skipped, which is what the tiles will be after a swipe
+    order = np.argsort(tiles == 0, axis=1, kind='stable')
+    packed = np.take_along_axis(tiles, order, axis=1)
+    both = (packed[:, 1:] != 0) & (packed[:, :-1] != 0)
+    diffs = np.abs(packed[:, 1:] - packed[:, :-1])
+    smoothness = -np.sum(np.where(both, diffs, 0), axis=1)
+    merges = np.sum(both & (diffs == 0), axis=1)
+
+    corner = np.maximum(tiles[:, 0], tiles[:, 3])
+    max_tile = np.max(tiles, axis=1)
+
+    return {
+        'empty': empty,
+        'monotonicity': monotonicity,
+        'smoothness': smoothness,
+        'merges': merges,
+        'corner': corner,
+        'max_tile': max_tile,
+    }
+
+class CompositeHeuristic:
+    row_tables = None  # Class variable to store the row feature tables
+    # Python list copies of the row tables, faster than NumPy for single
+    # boards. Built once per process and shared by every instance.
+    row_lists = None
+
+    def __init__(self, weights=None):
+        if CompositeHeuristic.row_tables is None:
+            CompositeHeuristic._initialize_row_tables()
+        if weights is None:
+            weights = DEFAULT_WEIGHTS
+        if isinstance(weights, dict):
+            weights = [weights[name] for name in FEATURES]
+        self.weights = np.asarray(weights, dtype=np.float64)
+        if self.weights.shape != (len(FEATURES),):
+            raise ValueError(f"Expected {len(FEATURES)} weights, got {self.weights.shape}")
+        # Python floats are faster than NumPy for single boards
+        self._weights = self.weights.tolist()
+
+    @classmethod
+    def _initialize_row_tables(cls):
+        cls.row_tables = table_cache.load_tables('composite_rows', _compute_row_tables)
+        cls.row_lists = {name: table.tolist() for name, table in cls.row_tables.items()}
+
+    def __call__(self, board: bp.Board) -> float:
+        return self.evaluate(int(board.board[0]))
+
+    def features(self, board: int) -> list:
+        # Feature values of a 64-bit board, in the order of FEATURES
+        t = CompositeHeuristic.row_lists
+        columns = bp.transpose(board)
+        rows = [(board >> shift) & 0xFFFF for shift in (0, 16, 32, 48)]
+        cols = [(columns >> shift) & 0xFFFF for shift in (0, 16, 32, 48)]
+        lines = rows + cols
+
+        max_tile = max(t['max_tile'][r] for r in rows)
+        # Only the top and bottom rows hold the corners
+        corner = max(t['corner'][rows[0]], t['corner'][rows[3]])
+        return [
+            sum(t['empty'][r] for r in rows),
+            sum(t['monotonicity'][line] for line in lines),
+            sum(t['smoothness'][line] for line in lines),
+            sum(t['merges'][line] for line in lines),
+            corner if corner == max_tile else 0,
+            max_tile,
+        ]
+
+    def evaluate(self, board: int) -> float:
+        return sum(w * f for w, f in zip(self._weights, self.features(board)))
+
+    def features_array(self, boards: np.ndarray) -> np.ndarray:
+        # Feature values of an array of 64-bit boards, one row per board
+        t = CompositeHeuristic.row_tables
+        boards = np.asarray(boards, dtype=np.uint64)
+        columns = bp.transpose(boards)
+        rows = [((boards >> np.uint64(shift)) & np.uint64(0xFFFF)).astype(np.int64) for shift in (0, 16, 32, 48)]
+        cols = [((columns >> np.uint64(shift)) & np.uint64(0xFFFF)).astype(np.int64) for shift in (0, 16, 32, 48)]
+        lines = rows + cols
+
+        max_tile = np.max([t['max_tile'][r] for r in rows], axis=0)
+        corner = np.maximum(t['corner'][rows[0]], t['corner'][rows[3]])
+        return np.stack([
+            np.sum([t['empty'][r] for r in rows], axis=0),
+            np.sum([t['monotonicity'][line] for line in lines], axis=0),
+            np.sum([t['smoothness'][line] for line in lines], axis=0),
+            np.sum([t['merges'][line] for line in lines], axis=0),
+            np.where(corner == max_tile, corner, 0),
+            max_tile,
+        ], axis=1).astype(np.float64)
+
+    def evaluate_array(self, boards: np.ndarray) -> np.ndarray:
+        return self.features_array(boards) @ self.weights
+
+"""
+Vectorized versions of the heuristics. They take an array of 64-bit boards and
+return one value per board, for searches that evaluate many boards at once.
+"""
+# Bit offsets of the 16 cells of a 64-bit board
+CELL_SHIFTS = np.arange(0, 64, 4, dtype=np.uint64)
+
+def tile_exponents(boards: np.ndarray) -> np.ndarray:
+    # Exponent of every cell, one row of 16 cells per board
+    boards = np.asarray(boards, dtype=np.uint64)
+    return ((boards[:, None] >> CELL_SHIFTS) & np.uint64(0xF)).astype(np.int64)
+
+def score_heuristic_array(boards: np.ndarray) -> np.ndarray:
+    return bp.TILE_SCORES[tile_exponents(boards)].sum(axis=1)
+
+def open_cells_heuristic_array(boards: np.ndarray) -> np.ndarray:
+    return np.sum(tile_exponents(boards) == 0, axis=1)
+
+def max_tile_heuristic_array(boards: np.ndarray) -> np.ndarray:
+    max_tile = tile_exponents(boards).max(axis=1).astype(np.float64)
+    max_tile[max_tile == 0] = float('-inf')
+    return max_tile
+
+def tile_sum_heuristic_array(boards: np.ndarray) -> np.ndarray:
+    exponents = tile_exponents(boards)
+    return np.where(exponents > 0, (2.0 ** exponents) ** 1.01, 0).sum(axis=1)
+
+def is_game_over_array(boards: np.ndarray) -> np.ndarray:
+    boards = np.asarray(boards, dtype=np.uint64)
+    over = np.ones(boards.shape, dtype=bool)
+    for move in bp.MOVES:
+        over &= bp.swipe_array(boards, move) == boards
+    return over
+
+def _with_game_over(heuristic_array):
+    def heuristic_and_gameover(boards):
+        values = heuristic_array(boards).astype(np.float64)
+        values[is_game_over_array(boards)] = -100000
+        return values
+    return heuristic_and_gameover
+
+score_and_gamover_heuristic_array = _with_game_over(score_heuristic_array)
+open_cells_and_gamover_heuristic_array = _with_game_over(open_cells_heuristic_array)
+max_tile_and_gamover_heuristic_array = _with_game_over(max_tile_heuristic_array)
+tile_sum_and_gamover_heuristic_array = _with_game_over(tile_sum_heuristic_array)
+
+ARRAY_HEURISTICS = {
+    score_heuristic: score_heuristic_array,
+    open_cells_heuristic: open_cells_heuristic_array,
+    max_tile_heuristic: max_tile_heuristic_array,
+    tile_sum_heuristic: tile_sum_heuristic_array,
+    score_and_gamover_heuristic: score_and_gamover_heuristic_array,
+    open_cells_and_gamover_heuristic: open_cells_and_gamover_heuristic_array,
+    max_tile_and_gamover_heuristic: max_tile_and_gamover_heuristic_array,
+    tile_sum_and_gamover_heuristic: tile_sum_and_gamover_heuristic_array,
+}
+
+def as_array_heuristic(heuristic: callable) -> callable:
+    # Vectorized version of a heuristic. Evaluators like CompositeHeuristic and
+    # NTupleNetwork provide their own, any other heuristic is called per board.
+    if heuristic in ARRAY_HEURISTICS:
+        return ARRAY_HEURISTICS[heuristic]
+    if hasattr(heuristic, 'evaluate_array'):
+        return heuristic.evaluate_array
+    def heuristic_array(boards):
+        return np.array([heuristic(bp.Board(int(board))) for board in boards], dtype=np.float64)
+    return heuristic_array
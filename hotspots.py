@@ -0,0 +1,278 @@
+import binary_puzzle as bp
+import agents
+import analysis
+import heuristics
+from batched_greedy import BatchedGreedyRunner
+import cProfile
+import pstats
+import json
+import multiprocessing
+import os
+import sys
+import numpy as np
+import matplotlib.pyplot as plt
+import pandas as pd
+from datetime import datetime
+
+# Hotspot report of a sweep. The games of analysis.prepare_tasks are played
+# under cProfile, with one profiler per game stage (empty cells and max tile
+# of the board before the move). Greedy games are played the way the sweep
+# plays them, all together with BatchedGreedyRunner, and each step of the
+# batch is profiled under the stage of its median game. The time of every
+# profiled function is assigned to a phase of the search:
+#  - move generation: swipes and valid move checks
+#  - spawn: placing new tiles
+#  - evaluation: heuristics, endgame tables and MCTS playouts
+#  - selection: the search itself (expectimax recursion, MCTS tree policy)
+#  - cache: transposition table lookups (successor cache lookups are counted
+#    as move generation)
+#  - other: board copies and decoding, and time outside the other phases
+# Functions outside the table (NumPy calls, builtins) are assigned to the
+# phases of their callers, in proportion to the time spent in them from each
+# caller. cProfile adds a fixed cost per call, so phases made of many small
+# calls are overstated, the report is for finding hotspots, not for timing.
+#
+#   profile a sweep:   python3 hotspots.py profile [games per variant] [variant substring] [--extended]
+#   render a report:   python3 hotspots.py report [profile file]
+
+PHASES = ['move generation', 'spawn', 'evaluation', 'selection', 'cache', 'other']
+
+# (file, function) -> phase, with function None for a whole file
+PHASE_FUNCTIONS = {
+    ('binary_puzzle.py', 'swipe'): 'move generation',
+    ('binary_puzzle.py', 'swipe_left'): 'move generation',
+    ('binary_puzzle.py', 'swipe_right'): 'move generation',
+    ('binary_puzzle.py', 'swipe_up'): 'move generation',
+    ('binary_puzzle.py', 'swipe_down'): 'move generation',
+    ('binary_puzzle.py', 'merge'): 'move generation',
+    ('binary_puzzle.py', 'can_swipe_left'): 'move generation',
+    ('binary_puzzle.py', 'can_swipe_right'): 'move generation',
+    ('binary_puzzle.py', 'can_swipe_up'): 'move generation',
+    ('binary_puzzle.py', 'can_swipe_down'): 'move generation',
+    ('binary_puzzle.py', 'get_valid_moves'): 'move generation',
+    ('binary_puzzle.py', 'is_game_over'): 'move generation',
+    ('binary_puzzle.py', 'swipe_int'): 'move generation',
+    ('binary_puzzle.py', 'swipe_array'): 'move generation',
+    ('binary_puzzle.py', 'successors'): 'move generation',
+    ('binary_puzzle.py', 'transpose'): 'move generation',
+    ('binary_puzzle.py', 'reverse_rows'): 'move generation',
+    ('binary_puzzle.py', 'copy'): 'other',
+    ('binary_puzzle.py', '__init__'): 'other',
+    ('binary_puzzle.py', '_update_views'): 'other',
+    ('binary_puzzle.py', 'spawn_random_tile'): 'spawn',
+    ('binary_puzzle.py', '_spawn_initial_tiles'): 'spawn',
+    ('binary_puzzle.py', 'place_tile'): 'spawn',
+    ('mcts_ai.py', '_spawn_int'): 'spawn',
+    ('mcts_ai.py', 'outcome'): 'spawn',
+    ('batched_greedy.py', 'spawn_random_tiles'): 'spawn',
+    ('batched_greedy.py', None): 'selection',
+    ('batched_expectimax.py', '_expand_chance'): 'spawn',
+    ('batched_expectimax.py', '_expand_max'): 'move generation',
+    ('heuristics.py', None): 'evaluation',
+    ('ntuple.py', None): 'evaluation',
+    ('endgame.py', None): 'evaluation',
+    ('mcts_ai.py', 'playout'): 'evaluation',
+    ('mcts_ai.py', 'choose'): 'evaluation',
+    ('mcts_ai.py', '__call__'): 'evaluation',
+    ('mcts_ai.py', '_simulate'): 'evaluation',
+    ('expectimax_ai.py', 'expectimax'): 'cache',
+    ('expectimax_ai.py', '_evict'): 'cache',
+    ('expectimax_ai.py', None): 'selection',
+    ('mcts_ai.py', None): 'selection',
+    ('greedy_ai.py', None): 'selection',
+    ('batched_expectimax.py', None): 'selection',
+    ('agents.py', None): 'selection',
+}
+
+def game_stage(board: bp.Board) -> tuple:
+    # (empty cells, max tile) of a board
+    exponents = board.get_exponent_board()
+    return int(np.sum(exponents == 0)), int(1 << int(exponents.max())) if exponents.max() > 0 else 0
+
+def _function_phase(function: tuple):
+    # Phase of a pstats function key (file, line, name), None if not in the table
+    filename = os.path.basename(function[0])
+    name = function[2]
+    return PHASE_FUNCTIONS.get((filename, name), PHASE_FUNCTIONS.get((filename, None)))
+
+def phase_times(stats: pstats.Stats) -> dict:
+    # Seconds spent in each phase, from the self time of every function
+    shares = {}
+
+    def function_shares(function, visiting):
+        # Fraction of the function's time belonging to each phase
+        if function in shares:
+            return shares[function]
+        phase = _function_phase(function)
+        if phase is not None:
+            result = {phase: 1.0}
+        else:
+            callers = stats.stats[function][4]
+            total = sum(caller[2] for caller in callers.values())
+            if function in visiting or total <= 0:
+                return {'other': 1.0}
+            result = {}
+            for caller, caller_stats in callers.items():
+                if caller not in stats.stats:
+                    continue
+                for caller_phase, fraction in function_shares(caller, visiting | {function}).items():
+                    result[caller_phase] = result.get(caller_phase, 0.0) + fraction * caller_stats[2] / total
+        shares[function] = result
+        return result
+
+    times = dict.fromkeys(PHASES, 0.0)
+    for function, (_, _, self_time, _, _) in stats.stats.items():
+        for phase, fraction in function_shares(function, frozenset()).items():
+            times[phase] += fraction * self_time
+    return times
+
+def profile_game(task) -> tuple:
+    # Play the game of an analysis task under cProfile. Returns the algorithm,
+    # the variant and one row per game stage with its number of moves and
+    # the time of each phase.
+    if bp.Board.merge_array is None:
+        bp.Board._initialize_merge_array()
+    algorithm, params = task
+    agent = agents.make_agent(algorithm, **params['options'])
+    profilers = {}
+    moves = {}
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    while not agent.board.is_game_over():
+        stage = game_stage(agent.board)
+        profiler = profilers.setdefault(stage, cProfile.Profile())
+        profiler.enable()
+        agent.take_best_move()
+        profiler.disable()
+        moves[stage] = moves.get(stage, 0) + 1
+    rows = []
+    for (empty, max_tile), profiler in profilers.items():
+        times = phase_times(pstats.Stats(profiler))
+        rows.append({'empty_cells': empty, 'max_tile': max_tile, 'moves': moves[(empty, max_tile)], **times})
+    return algorithm, params['variant'], rows
+
+def profile_greedy(task) -> tuple:
+    # Like profile_game for the greedy games of the sweep, given as
+    # (heuristic name, number of games)
+    if bp.Board.merge_array is None:
+        bp.Board._initialize_merge_array()
+    heuristic_name, games = task
+    runner = BatchedGreedyRunner(games, getattr(heuristics, heuristic_name))
+    profilers = {}
+    moves = {}
+    while runner.active.any():
+        exponents = heuristics.tile_exponents(runner.boards[runner.active])
+        stage = (int(np.median(np.sum(exponents == 0, axis=1))), 1 << int(np.median(exponents.max(axis=1))))
+        profiler = profilers.setdefault(stage, cProfile.Profile())
+        profiler.enable()
+        runner.step()
+        profiler.disable()
+        # Every running game made a move, or found it had none
+        moves[stage] = moves.get(stage, 0) + len(exponents)
+    rows = []
+    for (empty, max_tile), profiler in profilers.items():
+        times = phase_times(pstats.Stats(profiler))
+        rows.append({'empty_cells': empty, 'max_tile': max_tile, 'moves': moves[(empty, max_tile)], **times})
+    return 'greedy', heuristic_name, rows
+
+def profile_sweep(games: int = 1, variant_filter: str = None, processes: int = 8, extended: bool = False) -> str:
+    # Profile games of every variant of the sweep (or of the variants whose
+    # name contains variant_filter, extended as in analysis.prepare_tasks)
+    # and save the rows to results/profiles
+    tasks = [task for task in analysis.prepare_tasks(games, extended=extended)
+             if variant_filter is None or variant_filter in task[1]['variant']]
+    # Greedy games are played by analysis.save_experiment_results, one batch
+    # of games per heuristic
+    greedy_tasks = [(heuristic_name, games) for heuristic_name in ['score_heuristic', 'open_cells_heuristic']
+                    if variant_filter is None or variant_filter in heuristic_name]
+    with multiprocessing.Pool(processes=processes) as pool:
+        games_rows = pool.map(profile_greedy, greedy_tasks) + pool.map(profile_game, tasks)
+    rows = [{'algorithm': algorithm, 'variant': variant, **row}
+            for algorithm, variant, game_rows in games_rows for row in game_rows]
+    # In a subdirectory, as graphing.load_results reads every JSON file of
+    # results as sweep results
+    if not os.path.exists('results/profiles'):
+        os.makedirs('results/profiles')
+    filename = f"results/profiles/profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(filename, 'w') as f:
+        json.dump(rows, f)
+    print(f"Saved profile of {len(tasks) + games * len(greedy_tasks)} games to {filename}")
+    return filename
+
+def load_profile(filename: str = None) -> pd.DataFrame:
+    # Rows of a profile file, the latest one by default
+    if filename is None:
+        filename = os.path.join('results/profiles', sorted(os.listdir('results/profiles'))[-1])
+    with open(filename, 'r') as f:
+        profile = pd.DataFrame.from_records(json.load(f))
+    for column in ['algorithm', 'variant']:
+        profile[column] = pd.Categorical(profile[column], categories=profile[column].unique())
+    return profile
+
+def _empty_cells_bucket(empty):
+    return pd.cut(empty, bins=[-1, 1, 3, 7, 16], labels=['0-1', '2-3', '4-7', '8+'])
+
+def time_per_move(profile: pd.DataFrame, by: list) -> pd.DataFrame:
+    # Milliseconds per move of each phase, grouped by the given columns
+    grouped = profile.groupby(by, observed=True, sort=True)[PHASES + ['moves']].sum()
+    table = grouped[PHASES].div(grouped['moves'], axis=0) * 1000
+    table['total'] = table.sum(axis=1)
+    return table
+
+def _plot_stacked(table: pd.DataFrame, ax, title: str, xlabel: str):
+    bottom = np.zeros(len(table))
+    x = np.arange(len(table))
+    for phase in PHASES:
+        ax.bar(x, table[phase], bottom=bottom, label=phase)
+        bottom += table[phase].to_numpy()
+    ax.set_xticks(x, [str(label) for label in table.index], rotation=45, ha='right')
+    ax.set_ylabel('Time per Move (ms)')
+    ax.set_xlabel(xlabel)
+    ax.set_title(title)
+
+def report(filename: str = None):
+    # Tables of time per move by phase, per variant and per game stage of
+    # each algorithm, saved as CSV next to the other figures, and plots of them
+    profile = load_profile(filename)
+    profile['empty_cells_bucket'] = _empty_cells_bucket(profile['empty_cells'])
+    if not os.path.exists('figures'):
+        os.makedirs('figures')
+
+    by_variant = time_per_move(profile, ['algorithm', 'variant'])
+    by_variant.to_csv('figures/hotspots_by_variant.csv')
+    print("Time per move by phase (ms):")
+    print(by_variant.round(3).to_string())
+    fig, ax = plt.subplots(figsize=(12, 6))
+    _plot_stacked(by_variant, ax, 'Time per Move by Phase Across All Algorithm Variants', 'Variant')
+    ax.set_xticks(np.arange(len(by_variant)), [f"{algorithm}_{variant}" for algorithm, variant in by_variant.index],
+                  rotation=90)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig('figures/hotspots_by_variant.png')
+    plt.close(fig)
+
+    for algorithm, rows in profile.groupby('algorithm', observed=True, sort=False):
+        by_empty = time_per_move(rows, ['empty_cells_bucket'])
+        by_tile = time_per_move(rows, ['max_tile'])
+        pd.concat({'empty_cells': by_empty, 'max_tile': by_tile}).to_csv(f'figures/{algorithm}_hotspots_by_stage.csv')
+        print(f"\n{algorithm.capitalize()} time per move by empty cells (ms):")
+        print(by_empty.round(3).to_string())
+        print(f"\n{algorithm.capitalize()} time per move by max tile (ms):")
+        print(by_tile.round(3).to_string())
+        fig, axes = plt.subplots(1, 2, figsize=(14, 6))
+        _plot_stacked(by_empty, axes[0], f'Time per Move by Empty Cells for {algorithm.capitalize()}', 'Empty Cells')
+        _plot_stacked(by_tile, axes[1], f'Time per Move by Max Tile for {algorithm.capitalize()}', 'Max Tile')
+        axes[0].legend()
+        fig.tight_layout()
+        fig.savefig(f'figures/{algorithm}_hotspots_by_stage.png')
+        plt.close(fig)
+
+
+if __name__ == '__main__':
+    extended = '--extended' in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != '--extended']
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        report(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        games = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        variant_filter = sys.argv[3] if len(sys.argv) > 3 else None
+        report(profile_sweep(games, variant_filter, extended=extended))
@@ -1,10 +1,102 @@
 import binary_puzzle as bp
 import numpy as np
-from visual import GameVisual
+from visual import VisualAgent
 import time
 import math
 import random
 import heuristics
+from anytime import MoveUpdate
+from memory_budget import max_entries, MCTS_NODE_BYTES
+from agents import Agent, register_agent
+
+# Light playout policies. Instead of a Board per simulated move, they play on
+# 64-bit boards as Python ints with bp.swipe_int, and the policies that look
+# at the successors score them with table lookups, so a playout costs a few
+# microseconds per move. Playout boards are rarely seen twice, so they bypass
+# the successor cache (bp.successors) rather than evicting the tree's boards.
+
+def _spawn_int(board: int) -> int:
+    # Spawn a 2 (90%) or a 4 (10%) in a random empty cell
+    empty = [shift for shift in range(0, 64, 4) if (board >> shift) & 0xF == 0]
+    if not empty:
+        return board
+    return board | ((1 if random.random() < 0.9 else 2) << random.choice(empty))
+
+class RandomPlayout:
+    # Uniformly random moves
+    # Total number of moves played in playouts, for benchmarks
+    moves_played = 0
+
+    def choose(self, board: int, successors: list) -> int:
+        return random.choice(successors)[1]
+
+    def playout(self, board: int, max_moves: int = None) -> int:
+        # Play from the board until the game is over or max_moves moves have
+        # been made, returns the final board
+        moves = 0
+        while max_moves is None or moves < max_moves:
+            successors = []
+            for move in bp.MOVES:
+                after = bp.swipe_int(board, move)
+                if after != board:
+                    successors.append((move, after))
+            if not successors:
+                break
+            board = _spawn_int(self.choose(board, successors))
+            moves += 1
+        self.moves_played += moves
+        return board
+
+class LineEvaluator:
+    # Cheap playout evaluation of a 64-bit board: the CompositeHeuristic
+    # features that are sums over lines (empty cells, monotonicity, smoothness
+    # and merges) folded into one table, so a board costs 8 lookups.
+    # Empty cells are counted on the rows and the columns, so their weight is
+    # halved.
+    def __init__(self, weights: dict = None):
+        if weights is None:
+            weights = heuristics.DEFAULT_WEIGHTS
+        if heuristics.CompositeHeuristic.row_tables is None:
+            heuristics.CompositeHeuristic._initialize_row_tables()
+        tables = heuristics.CompositeHeuristic.row_tables
+        values = (0.5 * weights['empty'] * tables['empty'] + weights['monotonicity'] * tables['monotonicity'] +
+                  weights['smoothness'] * tables['smoothness'] + weights['merges'] * tables['merges'])
+        self.values = values.tolist()
+
+    def __call__(self, board: int) -> float:
+        values = self.values
+        columns = bp.transpose(board)
+        return (values[board & 0xFFFF] + values[(board >> 16) & 0xFFFF] +
+                values[(board >> 32) & 0xFFFF] + values[board >> 48] +
+                values[columns & 0xFFFF] + values[(columns >> 16) & 0xFFFF] +
+                values[(columns >> 32) & 0xFFFF] + values[columns >> 48])
+
+class EpsilonGreedyPlayout(RandomPlayout):
+    # The successor with the highest value, or a random move with probability
+    # epsilon. evaluate takes a 64-bit board as an int, the default is a
+    # LineEvaluator (heuristics.CompositeHeuristic().evaluate is stronger but
+    # several times slower).
+    def __init__(self, evaluate: callable = None, epsilon: float = 0.1):
+        if evaluate is None:
+            evaluate = LineEvaluator()
+        self.evaluate = evaluate
+        self.epsilon = epsilon
+
+    def choose(self, board: int, successors: list) -> int:
+        if random.random() < self.epsilon:
+            return random.choice(successors)[1]
+        return max(successors, key=lambda successor: self.evaluate(successor[1]))[1]
+
+class CornerPlayout(RandomPlayout):
+    # Random moves drawn with prior weights that keep the big tiles in one
+    # corner, the bottom left one with the default weights
+    def __init__(self, priors: dict = None):
+        if priors is None:
+            priors = {"left": 0.4, "down": 0.4, "right": 0.15, "up": 0.05}
+        self.priors = priors
+
+    def choose(self, board: int, successors: list) -> int:
+        return random.choices(successors, weights=[self.priors[move] for move, _ in successors])[0][1]
 
 class Node:
     def __init__(self, board: bp.Board, parent=None, move=None):
@@ -15,6 +107,10 @@ class Node:
         self.wins = 0
         self.visits = 0
         self.untried_moves = board.get_valid_moves()
+        # Sum of the squared scores, for UCB1Tuned
+        self.squared_wins = 0
+        # Prior probability of each valid move, for PUCT
+        self.move_priors = None
 
     def ucb1(self, exploration=0.1, normalizing_factor=1):
         if self.visits == 0:
@@ -29,8 +125,118 @@ class Node:
         self.children.append(child)
         return child
 
-class MCTSBoard:
-    def __init__(self, board: bp.Board, simulation_time=1.0, heuristic=None, exploration=0.1, greedy_heuristic=None):
+    def add_chance_child(self, move):
+        # Child for the board after the move, before its tile spawns
+        new_board = self.board.copy()
+        new_board.swipe(move)
+        child = ChanceNode(new_board, parent=self, move=move)
+        self.untried_moves.remove(move)
+        self.children.append(child)
+        return child
+
+class ChanceNode:
+    # Board after a move and before the new tile spawns, used with progressive
+    # widening. Its children are the spawns sampled so far, one Node each.
+    def __init__(self, board: bp.Board, parent=None, move=None):
+        self.board = board
+        self.parent = parent
+        self.move = move
+        self.children = {}  # Board after the spawn -> Node
+        self.wins = 0
+        self.squared_wins = 0
+        self.visits = 0
+
+    def outcome(self, widening: tuple) -> Node:
+        # Progressive widening: a new spawn is sampled only while the number of
+        # outcomes is below k * visits ^ alpha, otherwise one of the outcomes
+        # already in the tree is revisited with a probability proportional to
+        # its visits (i.e. to how often it was sampled)
+        k, alpha = widening
+        if len(self.children) < max(1, k * self.visits ** alpha):
+            new_board = self.board.copy()
+            new_board.spawn_random_tile()
+            key = int(new_board.board[0])
+            if key not in self.children:
+                self.children[key] = Node(new_board, parent=self, move=self.move)
+            return self.children[key]
+        children = list(self.children.values())
+        return random.choices(children, weights=[child.visits + 1 for child in children])[0]
+
+"""
+Selection policies for MCTSBoard. Mean scores are normalized to [0, 1] with the
+lowest and highest playout scores seen in the tree, so exploration constants
+don't depend on the scale of the heuristic or on the stage of the game.
+select returns the child to descend to, or an untried move to expand.
+"""
+class UCB1:
+    def __init__(self, exploration: float = 0.5):
+        self.exploration = exploration
+
+    def select(self, node: Node, tree):
+        if node.untried_moves:
+            return random.choice(node.untried_moves)
+        log_visits = math.log(node.visits)
+        return max(node.children, key=lambda child: self.value(child, tree, log_visits))
+
+    def value(self, child, tree, log_visits: float) -> float:
+        return tree.normalize(child.wins / child.visits) + self.exploration * math.sqrt(log_visits / child.visits)
+
+class UCB1Tuned(UCB1):
+    # UCB1 with the exploration of each child scaled by an upper bound of the
+    # variance of its normalized scores (Auer et al.)
+    def __init__(self, exploration: float = 1.0):
+        self.exploration = exploration
+
+    def value(self, child, tree, log_visits: float) -> float:
+        mean = child.wins / child.visits
+        variance = max(0.0, child.squared_wins / child.visits - mean * mean) / tree.score_range() ** 2
+        bound = min(0.25, variance + math.sqrt(2 * log_visits / child.visits))
+        return tree.normalize(mean) + self.exploration * math.sqrt(log_visits / child.visits * bound)
+
+class PUCT:
+    # Exploration weighted by prior probabilities of the moves (as in
+    # AlphaZero). The priors are a softmax of an evaluation of the board after
+    # each move, by default mcts_ai.LineEvaluator. Untried moves compete with
+    # the children using the mean of their parent, so unlikely moves may never
+    # be expanded.
+    def __init__(self, exploration: float = 1.0, evaluate: callable = None, temperature: float = 2.0):
+        self.exploration = exploration
+        self.evaluate = evaluate
+        self.temperature = temperature
+
+    def priors(self, node: Node) -> dict:
+        if self.evaluate is None:
+            # Built on first use so the policy is cheap to send to other processes
+            self.evaluate = LineEvaluator()
+        after, _ = bp.successors(int(node.board.board[0]))
+        moves = node.untried_moves + [child.move for child in node.children]
+        values = [self.evaluate(after[bp.MOVE_INDEX[move]]) / self.temperature for move in moves]
+        top = max(values)
+        weights = [math.exp(value - top) for value in values]
+        return {move: weight / sum(weights) for move, weight in zip(moves, weights)}
+
+    def select(self, node: Node, tree):
+        if node.move_priors is None:
+            node.move_priors = self.priors(node)
+        priors = node.move_priors
+        scale = self.exploration * math.sqrt(max(1, node.visits))
+        parent_value = tree.normalize(node.wins / node.visits) if node.visits else 0.5
+        best, best_value = None, float('-inf')
+        for move in node.untried_moves:
+            value = parent_value + scale * priors[move]
+            if value > best_value:
+                best, best_value = move, value
+        for child in node.children:
+            value = tree.normalize(child.wins / child.visits) + scale * priors[child.move] / (1 + child.visits)
+            if value > best_value:
+                best, best_value = child, value
+        return best
+
+@register_agent('mcts')
+class MCTSBoard(Agent):
+    def __init__(self, board: bp.Board, simulation_time=1.0, heuristic=None, exploration=0.1, greedy_heuristic=None,
+                 playout_policy=None, rollout_depth: int = None, selection=None, widening: tuple = None,
+                 memory_budget: int = None):
         self.board = board
         self.simulation_time = simulation_time
         if heuristic is None:
@@ -39,55 +245,52 @@ class MCTSBoard:
             self.heuristic = heuristic
         self.exploration = exploration
         self.greedy_heuristic = greedy_heuristic
+        # Light playout policy (RandomPlayout, EpsilonGreedyPlayout or
+        # CornerPlayout) used instead of the Board based simulations. With
+        # rollout_depth, playouts stop after that many moves and the heuristic
+        # evaluates the board they reach instead of the final board.
+        self.playout_policy = playout_policy
+        self.rollout_depth = rollout_depth
+        # Selection policy (UCB1, UCB1Tuned or PUCT) replacing Node.ucb1 and the
+        # normalizing factor
+        self.selection = selection
+        # (k, alpha) for progressive widening of the spawns after each move
+        # (see ChanceNode). Without it, each move is followed by the single
+        # spawn sampled when the move was expanded.
+        self.widening = widening
         self.normalizing_factor = 1
+        # Lowest and highest playout scores of the current tree
+        self.min_score = float('inf')
+        self.max_score = float('-inf')
+        # Number of playouts of the last search
+        self.playouts = 0
+        # Bytes the tree may use (the search budget of memory_budget.py by
+        # default). When it has more nodes than fit, the least visited
+        # subtrees are pruned.
+        self.max_nodes = max_entries(MCTS_NODE_BYTES, memory_budget)
+        # Nodes in the current tree, approximate bytes they use, and number of
+        # nodes pruned during the last search
+        self.tree_nodes = 0
+        self.memory_used = 0
+        self.pruned = 0
+
+    def normalize(self, value: float) -> float:
+        # Mean score mapped to [0, 1] by the scores seen in the tree
+        if self.max_score <= self.min_score:
+            return 0.5
+        return (value - self.min_score) / (self.max_score - self.min_score)
+
+    def score_range(self) -> float:
+        return max(1e-9, self.max_score - self.min_score)
+
+    def effort(self) -> int:
+        return self.playouts
 
     def get_best_move(self) -> str:
-        root = Node(self.board)
+        root = self._new_root()
         end_time = time.time() + self.simulation_time
-
         while time.time() < end_time:
-            # Selection
-            node = root
-            while node.untried_moves == [] and node.children:
-                node = max(node.children, key=lambda n: n.ucb1(self.exploration, normalizing_factor=self.normalizing_factor))
-
-            # Expansion
-            if node.untried_moves:
-                move = random.choice(node.untried_moves)
-                node = node.add_child(move)
-
-            # Simulation
-            sim_board = node.board.copy()
-            moves = sim_board.get_valid_moves()
-            
-            if self.greedy_heuristic:
-                # Use greedy heuristic for simulation
-                while moves:
-                    best_move = None
-                    best_h = float('-inf')
-                    for move in moves:
-                        test_board = sim_board.copy()
-                        test_board.move(move)
-                        h = self.greedy_heuristic(test_board)
-                        if h > best_h:
-                            best_h = h
-                            best_move = move
-                    sim_board.move(best_move)
-                    moves = sim_board.get_valid_moves()
-            else:
-                # Use random moves for simulation
-                while moves:
-                    sim_board.move(random.choice(moves))
-                    moves = sim_board.get_valid_moves()
-
-            # Backpropagation
-            score = self.heuristic(sim_board)
-            if score > self.normalizing_factor:
-                self.normalizing_factor = score
-            while node:
-                node.visits += 1
-                node.wins += score
-                node = node.parent
+            self._iterate(root)
 
         # Print the number of visits for each child
         # print("Number of visits for each child:")
@@ -96,40 +299,193 @@ class MCTSBoard:
         # Choose best move based on most visits
         return max(root.children, key=lambda c: c.visits).move if root.children else None
 
-    def take_best_move(self) -> bool:
-        move = self.get_best_move()
-        if move is None:
-            return False
-        # print(f"Taking move {move}")
-        self.board.move(move)
-        return True
-
-    def __str__(self):
-        return str(self.board)
-
-class VisualMCTS(GameVisual):
-    def __init__(self, mcts_board: MCTSBoard, delay=1000):
-        super().__init__()
-        self.board = mcts_board.board
-        self.mcts_board = mcts_board
-        self.delay = delay
-        self.update_grid_cells()
-        self.after(self.delay, self.ai_move)
-        self.mainloop()
-
-    def ai_move(self):
-        if self.mcts_board.take_best_move():
-            self.update_grid_cells()
-            if self.board.is_game_over():
-                self.show_game_over()
+    def anytime(self, deadline: float = None, interval: float = 0.05):
+        # Anytime version of get_best_move (see anytime.py), searching until
+        # the deadline (simulation_time from now by default) with an update
+        # every interval seconds. Confidence is the visit share of the move.
+        start_time = time.time()
+        if deadline is None:
+            deadline = start_time + self.simulation_time
+        valid_moves = self.board.get_valid_moves()
+        if not valid_moves:
+            yield MoveUpdate(None, 1.0, 0, time.time() - start_time)
+            return
+        yield MoveUpdate(valid_moves[0], 0.0, 0, time.time() - start_time)
+        root = self._new_root()
+        while time.time() < deadline:
+            next_update = min(deadline, time.time() + interval)
+            while time.time() < next_update:
+                self._iterate(root)
+            # The deadline can pass before the first iteration (e.g. while the
+            # caller handles the first update), the root has no children yet
+            if not root.children:
+                continue
+            best = max(root.children, key=lambda c: c.visits)
+            yield MoveUpdate(best.move, best.visits / max(1, root.visits), self.playouts,
+                             time.time() - start_time)
+
+    def _new_root(self) -> Node:
+        # Root of a new search tree
+        self.playouts = 0
+        self.min_score = float('inf')
+        self.max_score = float('-inf')
+        self._selection = self.selection if self.selection is not None else UCB1()
+        self.tree_nodes = 1
+        self.pruned = 0
+        return Node(self.board)
+
+    def _iterate(self, root: Node):
+        # One selection, expansion, simulation and backpropagation from the root
+        if self.selection is not None or self.widening is not None:
+            self._iterate_with_policy(root)
+            return
+        # Selection
+        node = root
+        while node.untried_moves == [] and node.children:
+            node = max(node.children, key=lambda n: n.ucb1(self.exploration, normalizing_factor=self.normalizing_factor))
+
+        # Expansion
+        if node.untried_moves:
+            move = random.choice(node.untried_moves)
+            node = node.add_child(move)
+            self.tree_nodes += 1
+
+        # Simulation
+        score = self._simulate(node.board)
+        self.playouts += 1
+
+        # Backpropagation
+        if score > self.normalizing_factor:
+            self.normalizing_factor = score
+        while node:
+            node.visits += 1
+            node.wins += score
+            node = node.parent
+        self._enforce_budget(root)
+
+    def _iterate_with_policy(self, root: Node):
+        # Selection and expansion, down to a new node or a game over
+        node = root
+        path = [root]
+        while node.untried_moves or node.children:
+            choice = self._selection.select(node, self)
+            expanded = isinstance(choice, str)
+            if expanded:
+                if self.widening is None:
+                    choice = node.add_child(choice)
+                else:
+                    choice = node.add_chance_child(choice)
+                self.tree_nodes += 1
+            if self.widening is not None:
+                path.append(choice)
+                choice = choice.outcome(self.widening)
+                # A spawn sampled for the first time is a new node
+                if choice.visits == 0:
+                    expanded = True
+                    self.tree_nodes += 1
+            node = choice
+            path.append(node)
+            if expanded:
+                break
+
+        # Simulation
+        score = self._simulate(node.board)
+        self.playouts += 1
+
+        # Backpropagation
+        self.min_score = min(self.min_score, score)
+        self.max_score = max(self.max_score, score)
+        for node in path:
+            node.visits += 1
+            node.wins += score
+            node.squared_wins += score * score
+        self._enforce_budget(root)
+
+    def _enforce_budget(self, root: Node):
+        # Prune the tree back to 3/4 of the budget once it is over it, so
+        # pruning only runs every max_nodes / 4 expansions
+        if self.tree_nodes > self.max_nodes:
+            self._prune(root, self.max_nodes * 3 // 4)
+        self.memory_used = self.tree_nodes * MCTS_NODE_BYTES
+
+    def _prune(self, root: Node, target: int):
+        # Collapse the least visited subtrees into leaves until the tree has at
+        # most target nodes. A collapsed node keeps its statistics and gets its
+        # moves back as untried moves, so it grows again if it is selected.
+        sizes = {}
+        inner = []
+        # Subtree sizes in post order, without recursion as trees can be deep
+        stack = [(root, False)]
+        while stack:
+            node, done = stack.pop()
+            children = node.children.values() if isinstance(node, ChanceNode) else node.children
+            if done:
+                sizes[node] = 1 + sum(sizes[child] for child in children)
+                if node is not root and children:
+                    inner.append(node)
+                continue
+            stack.append((node, True))
+            stack.extend((child, False) for child in children)
+        # A node has at least as many visits as each of its children, and the
+        # sort is stable, so nodes come after the nodes of their subtree
+        inner.sort(key=lambda n: n.visits)
+        for node in inner:
+            if self.tree_nodes <= target:
+                break
+            removed = sizes[node] - 1
+            if isinstance(node, ChanceNode):
+                node.children = {}
             else:
-                self.after(self.delay, self.ai_move)
+                node.children = []
+                node.untried_moves = node.board.get_valid_moves()
+            # The subtrees above lose the collapsed nodes
+            ancestor = node.parent
+            while ancestor is not None:
+                sizes[ancestor] -= removed
+                ancestor = ancestor.parent
+            self.tree_nodes -= removed
+            self.pruned += removed
+
+    def _simulate(self, board: bp.Board) -> float:
+        # Play the game out from the board and score the board reached
+        sim_board = board.copy()
+        if self.playout_policy is not None:
+            sim_board = bp.Board(self.playout_policy.playout(int(sim_board.board[0]), self.rollout_depth))
+        elif self.greedy_heuristic:
+            # Use greedy heuristic for simulation
+            moves = sim_board.get_valid_moves()
+            while moves:
+                best_move = None
+                best_h = float('-inf')
+                for move in moves:
+                    test_board = sim_board.copy()
+                    test_board.move(move)
+                    h = self.greedy_heuristic(test_board)
+                    if h > best_h:
+                        best_h = h
+                        best_move = move
+                sim_board.move(best_move)
+                moves = sim_board.get_valid_moves()
+        else:
+            # Use random moves for simulation
+            moves = sim_board.get_valid_moves()
+            while moves:
+                sim_board.move(random.choice(moves))
+                moves = sim_board.get_valid_moves()
+        return self.heuristic(sim_board)
+
 
 if __name__ == '__main__':
     # Test with tile sum game over heuristic
     board = bp.Board()
     mcts_board = MCTSBoard(board, simulation_time=0.1, heuristic=heuristics.tile_sum_heuristic, exploration=0.1)
-    visual = VisualMCTS(mcts_board, delay=1)
+    visual = VisualAgent(mcts_board, delay=1)
+
+    # Test with light corner preferring playouts
+    board = bp.Board()
+    mcts_board = MCTSBoard(board, simulation_time=0.1, heuristic=heuristics.score_heuristic, exploration=0.1,
+                           playout_policy=CornerPlayout())
+    visual = VisualAgent(mcts_board, delay=1)
 
     
 
@@ -0,0 +1,66 @@
+import itertools
+import os
+import sys
+
+# Per-process memory budget of the searches. Every store of a search keeps its
+# size within it: MCTSBoard prunes the least visited subtrees of its tree, and
+# ExpectimaxBoard and EndgameSolver evict the oldest entries of their dicts,
+# and the successor cache of binary_puzzle its least recently used boards.
+# analysis.py runs one game per worker process, so the searches of a sweep
+# use at most about processes * MEMORY_BUDGET.
+# The budget is SEARCH_MEMORY_MB megabytes (256 by default). The successor
+# cache, which all the searches of a process share, takes SUCCESSOR_CACHE_SHARE
+# of it and the store of a search the rest, or the memory_budget given to the
+# AI. A search with two stores (an expectimax transposition table and the
+# endgame memo of its leaf oracle) should split the rest between them with
+# their memory_budget parameters.
+
+MEMORY_BUDGET = int(float(os.environ.get('SEARCH_MEMORY_MB', 256)) * 2 ** 20)
+
+# Part of the budget taken by the successor cache
+SUCCESSOR_CACHE_SHARE = 1 / 8
+
+# Approximate memory of one entry of each store, measured with tracemalloc
+# (an MCTS node holds a copy of its Board, a table entry is a key tuple, a
+# value tuple and a dict slot, an endgame entry a key tuple and a float, a
+# successor entry a board, a tuple of the 4 boards after it and the link of
+# the lru_cache)
+MCTS_NODE_BYTES = 600
+TABLE_ENTRY_BYTES = 190
+ENDGAME_ENTRY_BYTES = 150
+SUCCESSOR_ENTRY_BYTES = 380
+
+def search_budget() -> int:
+    # Default budget of the store of a search
+    return MEMORY_BUDGET - successor_budget()
+
+def successor_budget() -> int:
+    return int(MEMORY_BUDGET * SUCCESSOR_CACHE_SHARE)
+
+def max_entries(entry_bytes: int, budget: int = None) -> int:
+    # Number of entries of entry_bytes each that fit in the budget (the
+    # search budget by default)
+    if budget is None:
+        budget = search_budget()
+    return max(1, budget // entry_bytes)
+
+def evict_oldest(table: dict, count: int = None) -> int:
+    # Evict the count oldest entries of a dict store (half of them by default)
+    # and return the number of entries evicted. Dicts keep their insertion
+    # order, so the first keys are the oldest.
+    if count is None:
+        count = max(1, len(table) // 2)
+    for key in list(itertools.islice(table, count)):
+        del table[key]
+    return count
+
+def peak_rss() -> int:
+    # Peak resident memory of this process in bytes, 0 where the resource
+    # module is unavailable (Windows)
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,210 @@
+import json
+import os
+import time
+import numpy as np
+import binary_puzzle as bp
+import table_cache
+
+# An n-tuple network scores a board by looking at a handful of fixed groups of
+# cells (the tuples). The exponents of the cells in a tuple are concatenated
+# into an index into a weight table, and the value of the board is the sum of
+# the looked up weights. Every tuple is applied to all 8 symmetries of the
+# board (rotations and reflections) and shares one weight table between them.
+
+# Cells are given as (row, column) of the 2048 board, (0, 0) being the top left.
+
+# The standard 4 x 6-tuple network (Szubert & Jaskowski, Yeh et al.)
+# Each table has 16^6 entries, so the weight file is about 268 MB
+TUPLES_6 = [
+    [(0, 0), (0, 1), (0, 2), (0, 3), (1, 0), (1, 1)],
+    [(1, 0), (1, 1), (1, 2), (1, 3), (2, 0), (2, 1)],
+    [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)],
+    [(1, 0), (1, 1), (1, 2), (2, 0), (2, 1), (2, 2)],
+]
+
+# A small 4-tuple network (rows and 2x2 squares) that trains quickly
+# Each table has 16^4 entries, so the weight file is about 1.3 MB
+TUPLES_4 = [
+    [(0, 0), (0, 1), (0, 2), (0, 3)],
+    [(1, 0), (1, 1), (1, 2), (1, 3)],
+    [(0, 0), (0, 1), (1, 0), (1, 1)],
+    [(0, 1), (0, 2), (1, 1), (1, 2)],
+    [(1, 1), (1, 2), (2, 1), (2, 2)],
+]
+
+def _symmetries(cell):
+    # All 8 images of a cell under the rotations and reflections of the board
+    r, c = cell
+    return [
+        (r, c), (c, 3 - r), (3 - r, 3 - c), (3 - c, r),
+        (r, 3 - c), (3 - c, 3 - r), (3 - r, c), (c, r),
+    ]
+
+def _cell_shift(cell):
+    # Bit offset of a cell in the 64-bit board (see Board.get_2048_board)
+    r, c = cell
+    return (3 - r) * 16 + (3 - c) * 4
+
+def _true_score_rows():
+    # The real 2048 score of each 16-bit row, assuming every tile was spawned
+    # as a 2. A tile 2^e is worth (e - 1) * 2^e as every merge on the way to it
+    # scored the value of the merged tile. The difference between the values of
+    # a board before and after a swipe is the reward of that swipe.
+    rows = np.arange(0, 0xffff + 1, 1, dtype=np.int64)
+    total = np.zeros_like(rows)
+    for k in range(4):
+        e = (rows >> (4 * k)) & 0xF
+        total += np.where(e > 1, (e - 1) << e, 0)
+    return total
+
+class NTupleNetwork:
+    _score_rows = None  # Class variable to store the row score table
+
+    def __init__(self, tuples=None, weights: np.ndarray = None):
+        if tuples is None:
+            tuples = TUPLES_4
+        self.tuples = [[tuple(cell) for cell in t] for t in tuples]
+
+        # Offset of each tuple's table in the flat weight array
+        self.offsets = []
+        size = 0
+        for t in self.tuples:
+            self.offsets.append(size)
+            size += 16 ** len(t)
+
+        if weights is None:
+            weights = np.zeros(size, dtype=np.float32)
+        elif weights.shape != (size,):
+            raise ValueError(f"Expected {size} weights, got {weights.shape}")
+        self.weights = weights
+
+        # For each tuple, the nibble shifts of its cells under every symmetry
+        self.features = []
+        for offset, t in zip(self.offsets, self.tuples):
+            images = [_symmetries(cell) for cell in t]
+            shift_sets = [tuple(_cell_shift(image[s]) for image in images) for s in range(8)]
+            self.features.append((offset, shift_sets))
+        self.num_features = 8 * len(self.tuples)
+
+        if NTupleNetwork._score_rows is None:
+            # Python lists are faster than NumPy arrays for single lookups
+            NTupleNetwork._score_rows = table_cache.load_table('true_score_rows', _true_score_rows).tolist()
+
+    def __call__(self, board: bp.Board) -> float:
+        # Allows the network to be used as a heuristic by the AIs
+        return self.evaluate(int(board.board[0]))
+
+    def _indices(self, board: int):
+        # Weight indices of every feature of the board
+        for offset, shift_sets in self.features:
+            for shifts in shift_sets:
+                index = 0
+                for shift in shifts:
+                    index = (index << 4) | ((board >> shift) & 0xF)
+                yield offset + index
+
+    def evaluate(self, board: int) -> float:
+        # Value of a 64-bit board
+        weights = self.weights
+        return float(sum(weights[i] for i in self._indices(board)))
+
+    def evaluate_array(self, boards: np.ndarray) -> np.ndarray:
+        # Value of every board in an array of 64-bit boards
+        boards = np.asarray(boards, dtype=np.uint64)
+        total = np.zeros(boards.shape, dtype=np.float64)
+        for offset, shift_sets in self.features:
+            for shifts in shift_sets:
+                index = np.zeros(boards.shape, dtype=np.int64)
+                for shift in shifts:
+                    index = (index << 4) | ((boards >> np.uint64(shift)) & np.uint64(0xF)).astype(np.int64)
+                total += self.weights[offset + index]
+        return total
+
+    def update(self, board: int, delta: float):
+        # Move the value of the board by delta, split evenly between features
+        delta /= self.num_features
+        weights = self.weights
+        for i in self._indices(board):
+            weights[i] += delta
+
+    @classmethod
+    def board_score(cls, board: int) -> int:
+        # Real 2048 score of a 64-bit board
+        rows = cls._score_rows
+        return (rows[board & 0xFFFF] + rows[(board >> 16) & 0xFFFF] +
+                rows[(board >> 32) & 0xFFFF] + rows[(board >> 48) & 0xFFFF])
+
+    def save(self, path: str):
+        # Weights go into a .npy file so they can be memory mapped when loaded,
+        # the tuple shapes go into a .json file next to it
+        if not path.endswith('.npy'):
+            path += '.npy'
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(path, np.asarray(self.weights, dtype=np.float32))
+        with open(path[:-4] + '.json', 'w') as f:
+            json.dump({'tuples': self.tuples}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        # With mmap the weights are read-only and shared between processes
+        # that load the same file, without mmap they can be trained further
+        if not path.endswith('.npy'):
+            path += '.npy'
+        with open(path[:-4] + '.json', 'r') as f:
+            tuples = json.load(f)['tuples']
+        weights = np.load(path, mmap_mode='r' if mmap else None)
+        return cls(tuples, weights)
+
+
+def train_td(network: NTupleNetwork, games: int = 1000, learning_rate: float = 0.1, log_every: int = 100):
+    # Temporal difference learning of afterstate values (TD(0)).
+    # The player picks the move maximizing reward + V(afterstate). After each
+    # move, the value of the previous afterstate is moved towards the reward
+    # and value of the new afterstate. The last afterstate of a game is moved
+    # towards 0 as no more reward can be collected from it.
+    scores = []
+    start_time = time.time()
+    for game in range(games):
+        board = bp.Board()
+        score = 0
+        prev_after = None
+        while True:
+            state = int(board.board[0])
+            state_score = network.board_score(state)
+            best = None
+            for move in board.get_valid_moves():
+                new_board = board.copy()
+                new_board.swipe(move)
+                after = int(new_board.board[0])
+                reward = network.board_score(after) - state_score
+                value = reward + network.evaluate(after)
+                if best is None or value > best[0]:
+                    best = (value, move, after, reward)
+
+            if best is None:
+                if prev_after is not None:
+                    network.update(prev_after, -learning_rate * network.evaluate(prev_after))
+                break
+
+            value, move, after, reward = best
+            if prev_after is not None:
+                network.update(prev_after, learning_rate * (value - network.evaluate(prev_after)))
+            board.move(move)
+            score += reward
+            prev_after = after
+
+        scores.append(score)
+        if log_every and (game + 1) % log_every == 0:
+            recent = scores[-log_every:]
+            elapsed = time.time() - start_time
+            print(f"Game {game + 1}: average score {float(np.mean(recent)):.0f}, "
+                  f"max score {int(np.max(recent))}, {(game + 1) / elapsed:.1f} games/s")
+    return scores
+
+
+if __name__ == '__main__':
+    network = NTupleNetwork(TUPLES_4)
+    train_td(network, games=1000, learning_rate=0.1, log_every=100)
+    network.save('weights/ntuple_4.npy')
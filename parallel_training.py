@@ -0,0 +1,95 @@
+import binary_puzzle as bp
+import ntuple
+import numpy as np
+import os
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+# Hogwild-style parallel TD training of an n-tuple network. The weight tables
+# live in one shared memory block that every worker maps as a NumPy array, so
+# workers read and update the same weights without copying them. Updates are
+# not locked: two workers can race on the same weight, but the tables are so
+# large and the updates so small that lost updates don't hurt the training.
+
+# Network used by the worker process, backed by the shared memory block
+_network = None
+_shm = None
+
+def _attach(name):
+    # Attach to an existing shared memory block, the parent owns the block and
+    # is the only one to unlink it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument. Pool workers share the parent's
+        # resource tracker, so registering the block again is harmless.
+        return shared_memory.SharedMemory(name=name)
+
+def _init_worker(shm_name, tuples, size):
+    global _network, _shm
+    # Initialize Board's merge_array for this process
+    if bp.Board.merge_array is None:
+        bp.Board._initialize_merge_array()
+    _shm = _attach(shm_name)
+    weights = np.ndarray((size,), dtype=np.float32, buffer=_shm.buf)
+    _network = ntuple.NTupleNetwork(tuples, weights)
+
+def _train_games(args):
+    games, learning_rate, seed = args
+    np.random.seed(seed)
+    return ntuple.train_td(_network, games=games, learning_rate=learning_rate, log_every=0)
+
+def train_parallel(network: ntuple.NTupleNetwork, games: int = 10000, processes: int = 8,
+                   games_per_task: int = 50, learning_rate: float = 0.1,
+                   checkpoint_path: str = None, checkpoint_every: int = 1000, seed: int = 0):
+    size = network.weights.shape[0]
+    shm = shared_memory.SharedMemory(create=True, size=network.weights.nbytes)
+    try:
+        shared = np.ndarray((size,), dtype=np.float32, buffer=shm.buf)
+        shared[:] = network.weights
+        shared_network = ntuple.NTupleNetwork(network.tuples, shared)
+
+        # Split the games into small tasks so progress can be reported and
+        # checkpoints taken while the workers keep training
+        tasks = []
+        remaining = games
+        while remaining > 0:
+            n = min(games_per_task, remaining)
+            tasks.append((n, learning_rate, seed + len(tasks)))
+            remaining -= n
+
+        scores = []
+        start_time = time.time()
+        last_checkpoint = 0
+        with multiprocessing.Pool(processes=processes, initializer=_init_worker,
+                                  initargs=(shm.name, network.tuples, size)) as pool:
+            for task_scores in pool.imap_unordered(_train_games, tasks):
+                scores.extend(task_scores)
+                elapsed = time.time() - start_time
+                print(f"Games {len(scores)}/{games}: average score {float(np.mean(task_scores)):.0f}, "
+                      f"{len(scores) / elapsed:.1f} games/s")
+                if checkpoint_path and len(scores) - last_checkpoint >= checkpoint_every:
+                    # Snapshot the weights while the workers keep updating them
+                    shared_network.save(checkpoint_path)
+                    last_checkpoint = len(scores)
+                    print(f"Saved checkpoint to {checkpoint_path}")
+
+        network.weights = shared.copy()
+        if checkpoint_path:
+            network.save(checkpoint_path)
+        elapsed = time.time() - start_time
+        print(f"Trained {games} games in {elapsed:.1f}s ({games / elapsed:.1f} games/s)")
+        return scores
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+if __name__ == '__main__':
+    path = 'weights/ntuple_4.npy'
+    if os.path.exists(path):
+        network = ntuple.NTupleNetwork.load(path, mmap=False)
+    else:
+        network = ntuple.NTupleNetwork(ntuple.TUPLES_4)
+    train_parallel(network, games=10000, processes=8, checkpoint_path=path)
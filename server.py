@@ -0,0 +1,417 @@
+import asyncio
+import gc
+import json
+import math
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import binary_puzzle as bp
+import agents
+from anytime import best_move_by, SearchTimeout
+import heuristics
+from memory_budget import evict_oldest, max_entries, TABLE_ENTRY_BYTES
+
+# Local move recommendation server. Clients connect over TCP and send one JSON
+# request per line:
+#   {"id": 1, "board": "0x1200...", "algorithm": "expectimax", "budget_ms": 50}
+# The board is a 64-bit board (int or hex string) or a 4x4 grid of tile values.
+# Optional keys are "heuristic" (name of one of HEURISTICS),
+# "max_depth" and "session", see below. Each response is one JSON line:
+#   {"id": 1, "move": "left", "depth": 4, "nodes": 5321, "latency_ms": 41.2, ...}
+# with move None when the game is over, or {"id": 1, "error": "..."}.
+# Responses on a connection can come back out of order, they are matched to
+# their request by id. {"type": "stats"} returns latency percentiles.
+#
+# Searches run in a pool of worker processes started with the server, so the
+# merge and heuristic tables are loaded once. Each worker keeps an expectimax
+# transposition table across requests. Requests are routed to workers by
+# session (or by board when there is none), so the moves of a game reach the
+# worker that already searched the subtrees they share with earlier moves.
+#
+# Requests arriving within batch_window of each other are sent to a worker
+# together, which saves a round trip to the pool per request under load. A
+# worker solves its batch one request after another, sharing the time left
+# between the requests still to solve, and a request whose budget has run out
+# by the time its turn comes is answered with its first valid move
+# ("timed_out": true) without a search. The server answers the same way
+# itself when a worker is late, so a response never waits past the budget.
+
+HOST = '127.0.0.1'
+PORT = 2048
+
+# Names of the registered agents (see agents.py)
+ALGORITHMS = tuple(agents.agent_names())
+
+# Heuristics a request can ask for by name, the per-board heuristics of
+# heuristics.py
+HEURISTICS = {name: getattr(heuristics, name) for name in (
+    'score_heuristic', 'open_cells_heuristic', 'max_tile_heuristic', 'tile_sum_heuristic',
+    'score_and_gamover_heuristic', 'open_cells_and_gamover_heuristic',
+    'max_tile_and_gamover_heuristic', 'tile_sum_and_gamover_heuristic')}
+
+# Agents searched by iterative deepening, the others publish their best move
+# until the deadline with their anytime search
+DEEPENING_ALGORITHMS = ('expectimax', 'batched_expectimax')
+
+# Part of the budget kept for the batching window, the round trip to the
+# worker and the response: searches stop this many milliseconds before the
+# end of the budget (or at half of it for budgets under twice this). The
+# server stops waiting for the worker half way through the margin.
+RESPONSE_MARGIN_MS = 5
+
+# Latencies kept for the stats request
+LATENCY_WINDOW = 10000
+
+# Worker state: transposition table of each heuristic, and the entries added
+# by the searches of the current batch as (table, new entries)
+_tables = {}
+_new_entries = []
+
+# Entries a transposition table is trimmed to between batches. Growing a
+# table of hundreds of thousands of entries (a dict resize), evicting half of
+# it or a garbage collection going through it takes tens of milliseconds,
+# which must not happen during a search with a deadline.
+TABLE_TRIM_ENTRIES = int(0.9 * max_entries(TABLE_ENTRY_BYTES))
+
+class _SearchTable(dict):
+    # Transposition table of one search: the entries it adds, on top of the
+    # worker's table that it only reads. They are moved into the worker's
+    # table between batches by _tidy_worker.
+    def __init__(self, table: dict):
+        super().__init__()
+        self.table = table
+
+    def get(self, key, default=None):
+        entry = dict.get(self, key)
+        return self.table.get(key, default) if entry is None else entry
+
+def _init_worker():
+    # Load the tables before the first request instead of during it
+    bp.Board._initialize_merge_array()
+    heuristics.tile_exponents(np.zeros(1, dtype=np.uint64))
+    gc.freeze()
+
+def _start_worker():
+    # Workers run below the server's priority, so that the server sends the
+    # responses on time when they share a core
+    if hasattr(os, 'nice'):
+        os.nice(5)
+    _init_worker()
+
+def _tidy_worker():
+    # Between batches: add the entries of the batch's searches to the
+    # tables, evict their oldest entries over TABLE_TRIM_ENTRIES, and move
+    # the objects left by the batch out of the garbage collector's reach. The
+    # tables only hold tuples of numbers, which never form cycles. It
+    # starts by yielding the CPU, so that the server sends the responses
+    # of the batch first when they share a core.
+    time.sleep(0.001)
+    for table, entries in _new_entries:
+        table.update(entries)
+    _new_entries.clear()
+    for table in _tables.values():
+        if len(table) > TABLE_TRIM_ENTRIES:
+            evict_oldest(table, len(table) - TABLE_TRIM_ENTRIES)
+    gc.freeze()
+
+def parse_board(board) -> int:
+    # 64-bit board from an int, a hex string or a 4x4 grid of tile values
+    if isinstance(board, (int, str)) and not isinstance(board, bool):
+        value = board if isinstance(board, int) else int(board, 0)
+        if not 0 <= value < 1 << 64:
+            raise ValueError(f"Board {board} is not a 64-bit board")
+        return value
+    if not isinstance(board, list) or len(board) != 4 or any(not isinstance(row, list) or len(row) != 4
+                                                            for row in board):
+        raise ValueError("Board grid must be 4x4")
+    value = 0
+    for r, row in enumerate(board):
+        for c, tile in enumerate(row):
+            tile = int(tile)
+            if tile:
+                # Cells hold exponents up to 15
+                if tile & (tile - 1) or tile == 1 or tile < 0 or tile > 1 << 15:
+                    raise ValueError(f"Invalid tile {tile}")
+                value |= (tile.bit_length() - 1) << ((3 - r) * 16 + (3 - c) * 4)
+    return value
+
+def _get_heuristic(name: str) -> callable:
+    if not isinstance(name, str) or name not in HEURISTICS:
+        raise ValueError(f"Unknown heuristic {name}")
+    return HEURISTICS[name]
+
+def _deepening_search(board: int, board_class, deadline: float, max_depth: int, **options) -> dict:
+    # Iterative deepening: search one ply deeper for as long as the next search
+    # is expected to end before the deadline. Its cost is estimated from the
+    # growth in nodes of the last depth that added a ply of the same kind
+    # (max and chance plies branch very differently). The estimate can be
+    # wrong, so the searches after the first one also stop at the deadline
+    # (SearchTimeout), and the move of the last completed depth is returned.
+    result = {'move': None, 'depth': 0, 'nodes': 0}
+    growth = 8.0
+    # Nodes of the search of each completed depth
+    depth_nodes = []
+    for depth in range(1, max_depth + 1):
+        start_time = time.time()
+        ai_board = board_class(bp.Board(board), depth=depth, **options)
+        # Depth 1 always completes, so there is a move to return
+        ai_board.deadline = deadline if depth > 1 else None
+        try:
+            move = ai_board.get_best_move()
+        except SearchTimeout:
+            result['nodes'] += ai_board.nodes_expanded
+            break
+        finally:
+            if hasattr(ai_board, 'table_hits'):
+                result['table_hits'] = result.get('table_hits', 0) + ai_board.table_hits
+        elapsed = time.time() - start_time
+        result.update(move=move, depth=depth, nodes=result['nodes'] + ai_board.nodes_expanded)
+        if move is None:
+            break
+        depth_nodes.append(ai_board.nodes_expanded)
+        if len(depth_nodes) >= 3:
+            growth = max(1.0, depth_nodes[-2] / max(1, depth_nodes[-3]))
+        if time.time() + elapsed * growth > deadline:
+            break
+    return result
+
+def _timed_out(board: int) -> dict:
+    # Response to a request whose budget ran out before it could be searched
+    valid_moves = bp.Board(board).get_valid_moves()
+    return {'move': valid_moves[0] if valid_moves else None, 'depth': 0, 'nodes': 0, 'timed_out': True}
+
+def _solve(request: dict) -> dict:
+    board = parse_board(request['board'])
+    algorithm = request.get('algorithm', 'expectimax')
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unknown algorithm {algorithm}")
+    heuristic_name = request.get('heuristic', 'score_heuristic')
+    heuristic = _get_heuristic(heuristic_name)
+    deadline = request['deadline']
+    max_depth = int(request.get('max_depth', 8))
+    if time.time() >= deadline:
+        # The budget ran out while the request waited, e.g. behind the other
+        # requests of its batch, so answer at once instead of searching past it
+        return _timed_out(board)
+    if algorithm in DEEPENING_ALGORITHMS:
+        options = {'heuristic': heuristic}
+        if algorithm == 'expectimax':
+            # The worker's table is kept within the memory budget by _tidy_worker
+            search_table = _SearchTable(_tables.setdefault(heuristic_name, {}))
+            _new_entries.append((search_table.table, search_table))
+            options['transposition_table'] = search_table
+        return _deepening_search(board, agents.get_agent_class(algorithm), deadline, max_depth, **options)
+    agent = agents.make_agent(algorithm, bp.Board(board), heuristic=heuristic)
+    update = best_move_by(agent, max(0.001, deadline - time.time()))
+    return {'move': update.move, 'effort': update.effort}
+
+def _solve_batch(requests: list) -> list:
+    # Runs in a worker process
+    results = []
+    for i, request in enumerate(requests):
+        start_time = time.time()
+        # The requests after this one wait for it, so it only gets its share
+        # of the time left to the ones still to solve
+        if 'deadline' in request:
+            request['deadline'] = start_time + (request['deadline'] - start_time) / (len(requests) - i)
+        try:
+            result = _solve(request)
+        except Exception as e:
+            # Bad requests only fail themselves, not the rest of the batch
+            result = {'error': f"{type(e).__name__}: {e}"}
+        result['compute_ms'] = 1000 * (time.time() - start_time)
+        results.append(result)
+    return results
+
+
+class MoveServer:
+    def __init__(self, host: str = HOST, port: int = PORT, processes: int = None,
+                 batch_window: float = 0.002, max_batch: int = 32, verbose: bool = False):
+        self.host = host
+        self.port = port
+        self.processes = processes or os.cpu_count()
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.verbose = verbose
+        # One single process executor per worker so requests can be routed to
+        # the worker holding the matching transposition table
+        self.executors = [ProcessPoolExecutor(1, initializer=_start_worker) for _ in range(self.processes)]
+        self.queue = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+
+    async def serve(self):
+        # Start the workers now rather than on the first request, and load
+        # the tables answering late requests here
+        _init_worker()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(executor, _init_worker) for executor in self.executors])
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self._batcher())
+        server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        print(f"Serving moves on {self.host}:{self.port} with {self.processes} workers")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            for executor in self.executors:
+                executor.shutdown(cancel_futures=True)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        pending = set()
+        lock = asyncio.Lock()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self._respond(line, writer, lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, line: bytes, writer: asyncio.StreamWriter, lock: asyncio.Lock):
+        arrival = time.time()
+        try:
+            request = json.loads(line)
+            if request.get('type') == 'stats':
+                response = self.stats()
+            else:
+                response = await self._submit(request, arrival)
+            response['id'] = request.get('id')
+        except (ValueError, AttributeError) as e:
+            response = {'error': f"Bad request: {e}"}
+        async with lock:
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+
+    async def _submit(self, request: dict, arrival: float) -> dict:
+        budget_ms = request.get('budget_ms', 100)
+        if isinstance(budget_ms, bool) or not isinstance(budget_ms, (int, float)) or not 0 < budget_ms < math.inf:
+            raise ValueError(f"budget_ms must be a positive number, got {budget_ms!r}")
+        margin_ms = min(RESPONSE_MARGIN_MS, budget_ms / 2)
+        request['deadline'] = arrival + (budget_ms - margin_ms) / 1000
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        try:
+            # Shielded so that the worker can still set the result when it
+            # comes back late
+            response = await asyncio.wait_for(asyncio.shield(future),
+                                              request['deadline'] + margin_ms / 2000 - time.time())
+        except asyncio.TimeoutError:
+            response = _timed_out(parse_board(request['board']))
+        response['latency_ms'] = 1000 * (time.time() - arrival)
+        if 'error' not in response:
+            self.latencies.append(response['latency_ms'])
+        if self.verbose:
+            print(f"{request.get('algorithm', 'expectimax')} {response.get('move')} "
+                  f"depth={response.get('depth')} latency={response['latency_ms']:.1f}ms")
+        return response
+
+    def _worker(self, request: dict) -> int:
+        key = request.get('session', request['board'])
+        if isinstance(key, list):
+            key = parse_board(key)
+        return hash(key) % self.processes
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            end_time = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), end_time - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes.append(len(batch))
+            groups = {}
+            for request, future in batch:
+                try:
+                    worker = self._worker(request)
+                except (KeyError, TypeError, ValueError) as e:
+                    future.set_result({'error': f"{type(e).__name__}: {e}"})
+                    continue
+                groups.setdefault(worker, []).append((request, future))
+            for worker, items in groups.items():
+                asyncio.create_task(self._run_batch(worker, items))
+
+    async def _run_batch(self, worker: int, items: list):
+        loop = asyncio.get_running_loop()
+        requests = [request for request, _ in items]
+        try:
+            results = await loop.run_in_executor(self.executors[worker], _solve_batch, requests)
+        except Exception as e:
+            results = [{'error': f"{type(e).__name__}: {e}"}] * len(items)
+        for (_, future), result in zip(items, results):
+            future.set_result(result)
+        # After the responses, so that they don't wait for it
+        await loop.run_in_executor(self.executors[worker], _tidy_worker)
+
+    def stats(self) -> dict:
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {
+            'requests': len(self.latencies),
+            'latency_ms_p50': float(p50),
+            'latency_ms_p95': float(p95),
+            'latency_ms_p99': float(p99),
+            'latency_ms_max': float(latencies.max()),
+            'avg_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+        }
+
+
+async def load_client(host: str = HOST, port: int = PORT, requests: int = 200, concurrency: int = 8,
+                      algorithm: str = 'expectimax', budget_ms: float = 50, heuristic: str = 'score_heuristic'):
+    # Load generator: concurrency connections each sending requests one after
+    # another on positions from greedy games. Reports client side latencies.
+    from benchmarks import sample_positions
+    boards = sample_positions(min(requests, 50))
+    latencies = []
+
+    async def connection(n):
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in range(n, requests, concurrency):
+            request = {'id': i, 'board': hex(boards[i % len(boards)]), 'algorithm': algorithm,
+                       'budget_ms': budget_ms, 'heuristic': heuristic, 'session': n}
+            start_time = time.time()
+            writer.write((json.dumps(request) + '\n').encode())
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            if 'error' in response:
+                raise RuntimeError(response['error'])
+            latencies.append(1000 * (time.time() - start_time))
+        writer.close()
+
+    start_time = time.time()
+    await asyncio.gather(*[connection(n) for n in range(concurrency)])
+    elapsed = time.time() - start_time
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{requests} requests in {elapsed:.2f}s ({requests / elapsed:.1f} requests/s), "
+          f"latency p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms, max {max(latencies):.1f}ms")
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'{"type": "stats"}\n')
+    await writer.drain()
+    print("Server stats:", json.loads(await reader.readline()))
+    writer.close()
+
+
+if __name__ == '__main__':
+    # python3 server.py                             start the server
+    # python3 server.py client [requests] [concurrency] [budget_ms]
+    if len(sys.argv) > 1 and sys.argv[1] == 'client':
+        args = [float(arg) for arg in sys.argv[2:5]]
+        requests, concurrency, budget_ms = args + [200, 8, 50][len(args):]
+        asyncio.run(load_client(requests=int(requests), concurrency=int(concurrency), budget_ms=budget_ms))
+    else:
+        asyncio.run(MoveServer().serve())
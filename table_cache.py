@@ -0,0 +1,72 @@
+import os
+import numpy as np
+
+# Disk cache for precomputed lookup tables (merge tables, row feature tables...).
+# A table is built the first time it is needed and saved as a .npy file. Later
+# loads memory map the file read-only, so startup takes milliseconds and every
+# process using the table (e.g. the multiprocessing workers of analysis.py)
+# shares the same pages instead of holding its own copy. When the cache
+# directory can't be written (read-only install, shared checkout...), tables
+# are built in memory by every process instead.
+
+# Directory of the cache, cache/ next to the code unless TABLE_CACHE_DIR is set
+CACHE_DIR = os.environ.get('TABLE_CACHE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+# Bump when the code building any of the tables changes, so that stale
+# tables are rebuilt instead of loaded
+TABLE_VERSION = 2
+
+def table_path(name: str) -> str:
+    return os.path.join(CACHE_DIR, f'v{TABLE_VERSION}', f'{name}.npy')
+
+def _save(path: str, table: np.ndarray):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file first so that other processes never load a
+    # partially written table
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(table))
+        os.replace(temp_path, path)
+    except OSError:
+        # Don't leave a partial temporary file behind (e.g. on a full disk)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def _load(path: str) -> np.ndarray:
+    # A plain ndarray view of the memory map is faster to index than a memmap
+    return np.asarray(np.load(path, mmap_mode='r'))
+
+def load_table(name: str, builder: callable) -> np.ndarray:
+    # Read-only table, built by calling builder() if it isn't cached yet
+    path = table_path(name)
+    if not os.path.exists(path):
+        table = builder()
+        try:
+            _save(path, table)
+        except OSError:
+            return table
+    return _load(path)
+
+def load_tables(group: str, builder: callable) -> dict:
+    # Like load_table, for a builder returning a dict of named tables
+    # that are built together
+    names_path = table_path(group + '.names').replace('.npy', '.txt')
+    if not os.path.exists(names_path):
+        tables = builder()
+        try:
+            for name, table in tables.items():
+                _save(table_path(f'{group}.{name}'), table)
+            # The list of names is written last, it marks the group as complete
+            temp_path = f'{names_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                f.write('\n'.join(tables))
+            os.replace(temp_path, names_path)
+        except OSError:
+            return tables
+    with open(names_path, 'r') as f:
+        names = f.read().split('\n')
+    return {name: _load(table_path(f'{group}.{name}')) for name in names}
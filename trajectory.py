@@ -0,0 +1,140 @@
+import binary_puzzle as bp
+import numpy as np
+import os
+from visual import GameVisual
+
+# Compact binary recording of games. Every move is one fixed-width 10 byte
+# record: the 64-bit board the move was chosen on, the move, and the new tile
+# spawned after it. A game is its records in order followed by a terminal
+# record holding the final board.
+#
+# A trajectory file (.trj) is a short header followed by the records of all its
+# games. Next to it, an index (.idx.npy) holds the first record and record
+# count of each game, so any game and move can be read directly through a
+# memory map without reading the rest of the file.
+
+RECORD_DTYPE = np.dtype([('board', '<u8'), ('move', 'u1'), ('spawn', 'u1')])
+
+MAGIC = b'2048TRJ1'
+
+# Move of the terminal record, and spawn of a move that spawned no tile
+NO_MOVE = 0xFF
+NO_SPAWN = 0xFF
+
+def start_recording(board: bp.Board):
+    # Record every move made on the board from now on
+    board.trajectory = []
+
+def finish_recording(board: bp.Board) -> np.ndarray:
+    # Stop recording and return the records of the game
+    records = np.empty(len(board.trajectory) + 1, dtype=RECORD_DTYPE)
+    for i, (before, move, spawn) in enumerate(board.trajectory):
+        records[i] = (before, move, NO_SPAWN if spawn is None else spawn[0] | (spawn[1] << 4))
+    records[-1] = (int(board.board[0]), NO_MOVE, NO_SPAWN)
+    board.trajectory = None
+    return records
+
+def decode_spawn(spawn: int):
+    # (cell index, exponent) of a record's spawn, or None
+    if spawn == NO_SPAWN:
+        return None
+    return spawn & 0xF, spawn >> 4
+
+def _index_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.idx.npy'
+
+class TrajectoryWriter:
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.index = []
+        self.num_records = 0
+
+    def add_game(self, records: np.ndarray) -> int:
+        # Append a game and return its number in the file
+        records = np.asarray(records, dtype=RECORD_DTYPE)
+        records.tofile(self.file)
+        self.index.append((self.num_records, len(records)))
+        self.num_records += len(records)
+        return len(self.index) - 1
+
+    def close(self):
+        self.file.close()
+        np.save(_index_path(self.path), np.array(self.index, dtype=np.int64).reshape(-1, 2))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TrajectoryReader:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a trajectory file")
+        self.index = np.load(_index_path(path))
+        if self.index[:, 1].sum() > 0:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=len(MAGIC))
+        else:
+            self.records = np.empty(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def game(self, game: int) -> np.ndarray:
+        # All the records of a game
+        start, count = self.index[game]
+        return self.records[start:start + count]
+
+    def record(self, game: int, move: int):
+        # Record of one move of a game
+        start, count = self.index[game]
+        if not 0 <= move < count:
+            raise IndexError(f"Game {game} has no move {move}")
+        return self.records[start + move]
+
+def verify_game(records: np.ndarray) -> bool:
+    # Check that replaying each move and spawn gives the next recorded board
+    for current, following in zip(records[:-1], records[1:]):
+        board = bp.Board(int(current['board']))
+        board.swipe(bp.MOVES[current['move']])
+        spawn = decode_spawn(int(current['spawn']))
+        if spawn is not None:
+            board.board[0] |= np.uint64(spawn[1] << (spawn[0] * 4))
+        if int(board.board[0]) != int(following['board']):
+            return False
+    return True
+
+
+class VisualReplay(GameVisual):
+    def __init__(self, records: np.ndarray, delay=200):
+        super().__init__()
+        self.records = records
+        self.step = 0
+        self.delay = delay
+        self.board = bp.Board(int(records[0]['board']))
+        self.update_grid_cells()
+        self.after(self.delay, self.next_move)
+        self.mainloop()
+
+    def next_move(self):
+        self.step += 1
+        if self.step < len(self.records):
+            self.board = bp.Board(int(self.records[self.step]['board']), self.step)
+            self.update_grid_cells()
+            self.after(self.delay, self.next_move)
+        else:
+            self.show_game_over()
+
+
+if __name__ == '__main__':
+    import sys
+    # python3 trajectory.py results/expectimax_<timestamp>.trj [game]
+    reader = TrajectoryReader(sys.argv[1])
+    game = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    visual = VisualReplay(reader.game(game), delay=100)
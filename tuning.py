@@ -0,0 +1,125 @@
+import binary_puzzle as bp
+from greedy_ai import GreedyBoard
+from expectimax_ai import ExpectimaxBoard
+import heuristics
+import numpy as np
+import random
+import time
+import multiprocessing
+
+# Tuning of the CompositeHeuristic weights. A candidate weight vector is scored
+# by the mean score of a batch of headless games. Every candidate of a round is
+# played on the same seeds so the spawns they face are comparable, and all the
+# games of a round run in one multiprocessing Pool.
+
+def play_game(weights, seed, depth=0):
+    # Play one headless game with the given weights.
+    # depth 0 plays greedily, otherwise expectimax is used with that depth.
+    np.random.seed(seed)
+    random.seed(seed)
+    heuristic = heuristics.CompositeHeuristic(weights)
+    board = bp.Board()
+    if depth == 0:
+        ai_board = GreedyBoard(board, heuristic)
+    else:
+        ai_board = ExpectimaxBoard(board, depth=depth, heuristic=heuristic)
+    while not board.is_game_over():
+        ai_board.take_best_move()
+    return int(board.score())
+
+def _play_game_wrapper(args):
+    # Initialize Board's merge_array for this process
+    if bp.Board.merge_array is None:
+        bp.Board._initialize_merge_array()
+    return play_game(*args)
+
+def score_candidates(pool, candidates, seeds, depth=0):
+    # Mean game score of every candidate weight vector
+    tasks = [(list(map(float, weights)), seed, depth) for weights in candidates for seed in seeds]
+    scores = np.array(pool.map(_play_game_wrapper, tasks), dtype=np.float64)
+    return scores.reshape(len(candidates), len(seeds)).mean(axis=1)
+
+def random_search(iterations=20, population=16, games=8, sigma=0.5, depth=0, processes=8, seed=0):
+    # Sample candidates around the best weights found so far, scaling each
+    # weight by a log-normal factor so the signs of the weights are kept
+    rng = np.random.default_rng(seed)
+    best = np.array([heuristics.DEFAULT_WEIGHTS[name] for name in heuristics.FEATURES])
+    best_score = None
+    with multiprocessing.Pool(processes=processes) as pool:
+        for i in range(iterations):
+            seeds = rng.integers(0, 2**31, size=games).tolist()
+            candidates = best * np.exp(sigma * rng.standard_normal((population, len(best))))
+            # Re-score the incumbent on the new seeds to compare fairly
+            candidates[0] = best
+            scores = score_candidates(pool, candidates, seeds, depth)
+            top = int(np.argmax(scores))
+            best, best_score = candidates[top], scores[top]
+            print(f"Iteration {i + 1}: best score {best_score:.0f}, weights {np.round(best, 3).tolist()}")
+    return dict(zip(heuristics.FEATURES, best.tolist())), float(best_score)
+
+def cma_es(generations=20, population=16, games=8, sigma=0.5, depth=0, processes=8, seed=0):
+    # Covariance Matrix Adaptation Evolution Strategy (Hansen's standard
+    # (mu/mu_w, lambda) update with rank-one and rank-mu covariance updates)
+    rng = np.random.default_rng(seed)
+    n = len(heuristics.FEATURES)
+    mean = np.array([heuristics.DEFAULT_WEIGHTS[name] for name in heuristics.FEATURES])
+
+    mu = population // 2
+    ranks = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+    recombination = ranks / ranks.sum()
+    mu_eff = 1 / np.sum(recombination ** 2)
+
+    c_sigma = (mu_eff + 2) / (n + mu_eff + 5)
+    d_sigma = 1 + 2 * max(0, np.sqrt((mu_eff - 1) / (n + 1)) - 1) + c_sigma
+    c_c = (4 + mu_eff / n) / (n + 4 + 2 * mu_eff / n)
+    c_1 = 2 / ((n + 1.3) ** 2 + mu_eff)
+    c_mu = min(1 - c_1, 2 * (mu_eff - 2 + 1 / mu_eff) / ((n + 2) ** 2 + mu_eff))
+    chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+    p_sigma = np.zeros(n)
+    p_c = np.zeros(n)
+    cov = np.eye(n)
+    best, best_score = mean.copy(), None
+
+    with multiprocessing.Pool(processes=processes) as pool:
+        for g in range(generations):
+            eigenvalues, basis = np.linalg.eigh(cov)
+            scale = np.sqrt(np.maximum(eigenvalues, 1e-20))
+            inv_sqrt = basis @ np.diag(1 / scale) @ basis.T
+
+            z = rng.standard_normal((population, n))
+            steps = (z * scale) @ basis.T
+            candidates = mean + sigma * steps
+
+            seeds = rng.integers(0, 2**31, size=games).tolist()
+            start_time = time.time()
+            scores = score_candidates(pool, candidates, seeds, depth)
+            order = np.argsort(-scores)
+            if best_score is None or scores[order[0]] > best_score:
+                best, best_score = candidates[order[0]], scores[order[0]]
+
+            # Move the mean towards the weighted best half of the population
+            selected = steps[order[:mu]]
+            step = recombination @ selected
+            mean = mean + sigma * step
+
+            # Update the evolution paths, the covariance and the step size
+            p_sigma = (1 - c_sigma) * p_sigma + np.sqrt(c_sigma * (2 - c_sigma) * mu_eff) * (inv_sqrt @ step)
+            norm = np.linalg.norm(p_sigma)
+            stalled = norm / np.sqrt(1 - (1 - c_sigma) ** (2 * (g + 1))) < (1.4 + 2 / (n + 1)) * chi_n
+            p_c = (1 - c_c) * p_c + stalled * np.sqrt(c_c * (2 - c_c) * mu_eff) * step
+            rank_mu = (selected.T * recombination) @ selected
+            cov = ((1 - c_1 - c_mu) * cov + c_1 * (np.outer(p_c, p_c) + (not stalled) * c_c * (2 - c_c) * cov)
+                   + c_mu * rank_mu)
+            sigma *= np.exp((c_sigma / d_sigma) * (norm / chi_n - 1))
+
+            print(f"Generation {g + 1}: mean score {scores.mean():.0f}, best score {scores[order[0]]:.0f}, "
+                  f"sigma {sigma:.3f}, {len(candidates) * games / (time.time() - start_time):.1f} games/s")
+
+    return dict(zip(heuristics.FEATURES, best.tolist())), float(best_score)
+
+
+if __name__ == '__main__':
+    weights, score = cma_es(generations=20, population=16, games=8, depth=0)
+    print(f"\nBest weights: {weights}")
+    print(f"Best score: {score:.0f}")
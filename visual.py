@@ -3,8 +3,9 @@ import constants as c
 import binary_puzzle as bp
 
 class GameVisual(Frame):
-    def __init__(self):
+    def __init__(self, grid_len=c.GRID_LEN):
         Frame.__init__(self)
+        self.grid_len = grid_len
         self.grid()
         self.master.title('2048')
         self.grid_cells = []
@@ -15,14 +16,14 @@ class GameVisual(Frame):
         background = Frame(self, bg=c.BACKGROUND_COLOR_GAME,width=c.SIZE, height=c.SIZE)
         background.grid()
 
-        for i in range(c.GRID_LEN):
+        for i in range(self.grid_len):
             grid_row = []
-            for j in range(c.GRID_LEN):
+            for j in range(self.grid_len):
                 cell = Frame(
                     background,
                     bg=c.BACKGROUND_COLOR_CELL_EMPTY,
-                    width=c.SIZE / c.GRID_LEN,
-                    height=c.SIZE / c.GRID_LEN
+                    width=c.SIZE / self.grid_len,
+                    height=c.SIZE / self.grid_len
                 )
                 cell.grid(
                     row=i,
@@ -44,8 +45,8 @@ class GameVisual(Frame):
 
     def update_grid_cells(self):
         game_board = self.board.get_2048_board()
-        for i in range(c.GRID_LEN):
-            for j in range(c.GRID_LEN):
+        for i in range(self.grid_len):
+            for j in range(self.grid_len):
                 new_number = game_board[i][j]
                 if new_number == 0:
                     self.grid_cells[i][j].configure(text="",bg=c.BACKGROUND_COLOR_CELL_EMPTY)
@@ -60,3 +61,23 @@ class GameVisual(Frame):
     def show_game_over(self):
         self.grid_cells[1][1].configure(text="You", bg=c.BACKGROUND_COLOR_CELL_EMPTY)
         self.grid_cells[1][2].configure(text="Lose!", bg=c.BACKGROUND_COLOR_CELL_EMPTY)
+
+class VisualAgent(GameVisual):
+    # Window showing an agent (see agents.py) playing its board, one move
+    # every delay milliseconds
+    def __init__(self, agent, delay=1000):
+        super().__init__(grid_len=agent.board.size)
+        self.board = agent.board
+        self.agent = agent
+        self.delay = delay
+        self.update_grid_cells()
+        self.after(self.delay, self.ai_move)
+        self.mainloop()
+
+    def ai_move(self):
+        if self.agent.take_best_move():
+            self.update_grid_cells()
+            if self.board.is_game_over():
+                self.show_game_over()
+            else:
+                self.after(self.delay, self.ai_move)